@@ -0,0 +1,145 @@
+"""
+Single command for every stage of the pipeline
+
+Each subcommand imports the modules it runs only once it has been chosen, so no run pays for
+OpenCV, requests or TensorFlow it doesn't use. `process` and `dedup` ask the image store's
+index for work first and exit before importing OpenCV when there is none, and `predict --new`
+returns before loading TensorFlow, so scheduled runs that find nothing new finish in
+milliseconds. `bench --startup` times them.
+
+Usage:
+    python deer.py collect
+    python deer.py process
+    python deer.py dedup
+    python deer.py label
+    python deer.py export {csv,json,models} [PATH ...]
+    python deer.py predict [predict.py options]
+    python deer.py bench [--startup] [benchmark options]
+"""
+
+import os
+import sys
+import runpy
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def run_script(path: str, args: list) -> None:
+    """
+    Run one of the repo's scripts as if it was started from the command line.
+
+    Args:
+        path (str): The script.
+        args (list): Its command line arguments.
+    """
+    sys.argv = [path, *args]
+    sys.path.insert(0, os.path.dirname(path))
+    runpy.run_path(path, run_name="__main__")
+
+def collect(args) -> None:
+    """Download new images and their metadata."""
+    import image_collection
+
+    image_collection.build_images()
+
+def process(args) -> None:
+    """Process stored images that aren't processed at IMAGE_SIZE yet."""
+    import metadata_store
+    import image_store
+
+    conn = metadata_store.connect()
+    if not any(os.path.exists(image_store.raw_path(key)) for key in image_store.pending(conn, image_store.SIZE_TAG)):
+        print("No new images to process.")
+        return
+
+    import image_processing
+
+    image_processing.process_images()
+
+def dedup(args) -> None:
+    """Remove near-duplicates among the images processed since the last run."""
+    import metadata_store
+    import image_store
+
+    if not image_store.count_unchecked(metadata_store.connect()):
+        print("No new images to deduplicate.")
+        return
+
+    import image_processing
+
+    image_processing.remove_duplicates()
+    image_processing.clean_metadata()
+
+def label(args) -> None:
+    """Open the labeling tool."""
+    run_script(os.path.join(REPO_DIR, "image_labeling.py"), [])
+
+def export(args) -> None:
+    """Export the labeled images as CSV, the metadata as JSON or the saved models as TFLite."""
+    if args.what == "csv":
+        run_script(os.path.join(REPO_DIR, "helper", "json_to_csv.py"), [])
+
+    elif args.what == "json":
+        import metadata_store
+
+        metadata_store.export_json(metadata_store.connect(), args.paths[0] if args.paths else metadata_store.IMAGE_JSON)
+
+    else:
+        run_script(os.path.join(REPO_DIR, "export_model.py"), ["export", *args.paths])
+
+def predict(args) -> None:
+    """Score processed images with a saved model, see predict.py."""
+    run_script(os.path.join(REPO_DIR, "predict.py"), args.extra)
+
+def bench(args) -> None:
+    """Run the pipeline benchmark, or with --startup the startup time benchmark."""
+    if "--startup" in args.extra:
+        args.extra.remove("--startup")
+        run_script(os.path.join(REPO_DIR, "helper", "startup_benchmark.py"), args.extra)
+    else:
+        run_script(os.path.join(REPO_DIR, "helper", "benchmark.py"), args.extra)
+
+COMMANDS = {
+    "collect": collect,
+    "process": process,
+    "dedup": dedup,
+    "label": label,
+    "export": export,
+    "predict": predict,
+    "bench": bench,
+}
+
+# Their options belong to the script they run, including --help
+PASSTHROUGH = {"predict", "bench"}
+
+def main(argv: list = None) -> None:
+    """
+    Parse the command line and run the chosen subcommand.
+
+    Args:
+        argv (list): The arguments, sys.argv[1:] if not given.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name, fn in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=fn.__doc__, add_help=name not in PASSTHROUGH)
+
+        if name == "export":
+            subparser.add_argument("what", choices=["csv", "json", "models"])
+            subparser.add_argument("paths", nargs="*", help="The JSON file, or the saved models to export")
+
+    args, extra = parser.parse_known_args(argv)
+    if extra and args.command not in PASSTHROUGH:
+        parser.error(f'unrecognized arguments: {" ".join(extra)}')
+
+    args.extra = extra
+
+    # Same as image_collection.py, before any module reads its settings
+    import dotenv
+    dotenv.load_dotenv()
+
+    COMMANDS[args.command](args)
+
+if __name__ == "__main__":
+    main()
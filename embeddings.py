@@ -0,0 +1,237 @@
+"""
+Cached backbone embeddings for transfer learning
+
+Runs the frozen ResNet50 backbone once per packed image and keeps its pooled 2048-dim
+embedding in an on-disk cache keyed by a hash of the image's pixels, so rebuilding only
+computes images whose content hasn't been seen, and renamed or re-collected images are free.
+Transfer-learning heads then train on the cached vectors instead of running the backbone
+every epoch.
+
+Embeddings are stored as float16 in append-only shards, one or more per build, with the
+content keys of each shard next to it. `sources.json` remembers each packed image's key by
+its source file's mtime and size, so unchanged images aren't hashed again either.
+
+Usage:
+    python embeddings.py build
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import numpy as np
+import dataset
+
+EMBEDDINGS_DIR = os.getenv("EMBEDDINGS_DIR", "embeddings")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE") or 64)
+BACKBONE = "resnet50"
+
+# Embeddings per shard, about 16MB at float16
+SHARD_SIZE = 4096
+
+def cache_dir(embeddings_dir: str = EMBEDDINGS_DIR) -> str:
+    """
+    Get the cache directory of the backbone at the current image size.
+
+    Args:
+        embeddings_dir (str): The embeddings directory.
+
+    Returns:
+        str: The directory, one per backbone and input size since either changes the vectors.
+    """
+    width, height = dataset.IMAGE_SIZE
+    return os.path.join(embeddings_dir, f'{BACKBONE}-{width}x{height}')
+
+def content_key(pixels) -> str:
+    """
+    Hash an image's pixels.
+
+    Args:
+        pixels (numpy.ndarray): The packed uint8 image.
+
+    Returns:
+        str: A 32 character hex digest.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(pixels).tobytes(), digest_size=16).hexdigest()
+
+def load_backbone():
+    """
+    Build the frozen backbone with its preprocessing and average pooling.
+
+    Returns:
+        tf.keras.Model: Takes uint8-range images and returns pooled embeddings.
+    """
+    import tensorflow as tf
+    from tensorflow.keras.applications import ResNet50
+    from tensorflow.keras.applications.resnet50 import preprocess_input
+
+    width, height = dataset.IMAGE_SIZE
+    base_model = ResNet50(weights='imagenet', include_top=False, pooling='avg', input_shape=(height, width, 3))
+    base_model.trainable = False
+
+    inputs = tf.keras.layers.Input(shape=(height, width, 3))
+    return tf.keras.Model(inputs, base_model(preprocess_input(inputs), training=False))
+
+def load_shards(directory: str) -> tuple:
+    """
+    Map the cached shards.
+
+    Args:
+        directory (str): The cache directory.
+
+    Returns:
+        tuple: (index, shards) where index maps a content key to (shard, offset), and shards
+            are the memory-mapped float16 vectors.
+    """
+    index = dict()
+    shards = list()
+
+    # A shard counts once its keys are written, which happens after its vectors
+    for keys_path in sorted(glob.glob(os.path.join(directory, "keys-*.npy"))):
+        vectors_path = keys_path.replace("keys-", "vectors-")
+        shards.append(np.load(vectors_path, mmap_mode='r'))
+
+        for offset, key in enumerate(np.load(keys_path).tolist()):
+            index[key] = (len(shards) - 1, offset)
+
+    return index, shards
+
+def load_sources(directory: str) -> dict:
+    """
+    Load the content keys of packed images, by filename.
+
+    Args:
+        directory (str): The cache directory.
+
+    Returns:
+        dict: Per filename, [source mtime_ns, source size, content key].
+    """
+    try:
+        with open(os.path.join(directory, "sources.json"), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+def write_shard(directory: str, keys: list, vectors: list) -> None:
+    """
+    Save a shard of embeddings, vectors first so a partly written shard is never read.
+
+    Args:
+        directory (str): The cache directory.
+        keys (list): Content keys.
+        vectors (list): The aligned embeddings.
+    """
+    number = len(glob.glob(os.path.join(directory, "keys-*.npy")))
+
+    dataset.write_array(os.path.join(directory, f'vectors-{number:05d}.npy'), np.asarray(vectors, dtype=np.float16))
+    dataset.write_array(os.path.join(directory, f'keys-{number:05d}.npy'), np.array(keys, dtype=str))
+
+    print(f"Wrote shard {number} with {len(keys)} embeddings")
+
+def build_embeddings(embeddings_dir: str = EMBEDDINGS_DIR, dataset_dir: str = dataset.DATASET_DIR,
+                     batch_size: int = EMBED_BATCH_SIZE) -> int:
+    """
+    Compute embeddings for every packed image whose content isn't cached yet.
+
+    Args:
+        embeddings_dir (str): The embeddings directory.
+        dataset_dir (str): The packed dataset to embed, labeled or not.
+        batch_size (int): Images per backbone call.
+
+    Returns:
+        int: The number of embeddings computed.
+    """
+    directory = cache_dir(embeddings_dir)
+    os.makedirs(directory, exist_ok=True)
+
+    ds = dataset.load_dataset(dataset_dir, labeled_only=False)
+    manifest_rows = dataset.load_manifest(dataset_dir)["rows"]
+    index, _ = load_shards(directory)
+    old_sources = load_sources(directory)
+
+    # Hash only images whose source changed since the last build
+    sources = dict()
+    todo = dict()
+    for i, row in enumerate(ds.rows):
+        filename, mtime, size = manifest_rows[row]
+        source = old_sources.get(filename)
+
+        key = source[2] if source and source[:2] == [mtime, size] else content_key(ds.image(i))
+        sources[filename] = [mtime, size, key]
+
+        if key not in index and key not in todo:
+            todo[key] = i
+
+    print(f"{len(ds)} packed images, computing {len(todo)} embeddings that aren't cached yet...")
+
+    if todo:
+        model = load_backbone()
+        keys = list(todo)
+        positions = np.array(list(todo.values()))
+
+        pending_keys, pending_vectors = list(), list()
+        start_time = time.perf_counter()
+
+        for start in range(0, len(positions), batch_size):
+            batch = ds.images(positions[start:start + batch_size]).astype(np.float32)
+            pending_vectors.extend(np.asarray(model.predict_on_batch(batch)))
+            pending_keys.extend(keys[start:start + batch_size])
+
+            if len(pending_keys) >= SHARD_SIZE:
+                write_shard(directory, pending_keys, pending_vectors)
+                pending_keys, pending_vectors = list(), list()
+
+        if pending_keys:
+            write_shard(directory, pending_keys, pending_vectors)
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Embedded {len(todo)} images in {elapsed:.1f}s ({len(todo) / max(elapsed, 1e-9):.1f} images/sec)")
+
+    tmp_path = os.path.join(directory, "sources.json.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(sources, f)
+
+    os.replace(tmp_path, os.path.join(directory, "sources.json"))
+
+    return len(todo)
+
+def load_embeddings(filenames, embeddings_dir: str = EMBEDDINGS_DIR):
+    """
+    Gather the cached embeddings of images.
+
+    Args:
+        filenames (iterable): Image filenames, without extension.
+        embeddings_dir (str): The embeddings directory.
+
+    Returns:
+        numpy.ndarray: A (len(filenames), 2048) float32 matrix aligned with `filenames`.
+
+    Raises:
+        ValueError: If any image has no cached embedding.
+    """
+    directory = cache_dir(embeddings_dir)
+    index, shards = load_shards(directory)
+    sources = load_sources(directory)
+
+    filenames = list(filenames)
+    locations = [index.get(sources.get(filename, [None] * 3)[2]) for filename in filenames]
+
+    missing = sum(location is None for location in locations)
+    if missing:
+        raise ValueError(f"{missing} images have no cached embedding, run `python embeddings.py build` first.")
+
+    dim = shards[0].shape[1] if shards else 0
+    vectors = np.empty((len(filenames), dim), dtype=np.float32)
+    for i, (shard, offset) in enumerate(locations):
+        vectors[i] = shards[shard][offset]
+
+    return vectors
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "build":
+        print(__doc__.strip())
+        sys.exit(1)
+
+    build_embeddings()
@@ -0,0 +1,280 @@
+"""
+Vectorized evaluation of deer predictions
+
+Labels, scores and slice columns are turned into arrays once, then the confusion matrix,
+accuracy, precision, recall, F1, ROC AUC, a sweep over every distinct threshold and per-slice
+breakdowns (night vs day, moon phase, camera) are computed with sorts, cumulative sums and
+bincounts, so evaluating hundreds of thousands of images takes one inference pass and well
+under a second on top of it. The same cumulative sums evaluate a metadata-gated cascade at
+every uncertainty band.
+"""
+
+import numpy as np
+
+def safe_divide(a, b):
+    """Divide elementwise, giving 0 where the denominator is 0."""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b > 0)
+
+def confusion_matrix(y_true, y_pred):
+    """
+    Count true and false positives and negatives.
+
+    Args:
+        y_true (numpy.ndarray): True labels, 1 for deer.
+        y_pred (numpy.ndarray): Predicted labels.
+
+    Returns:
+        numpy.ndarray: [[tn, fp], [fn, tp]], like sklearn's confusion_matrix.
+    """
+    y_true = np.asarray(y_true, dtype=np.int64)
+    y_pred = np.asarray(y_pred, dtype=np.int64)
+    return np.bincount(2 * y_true + y_pred, minlength=4).reshape(2, 2)
+
+def count_metrics(tn, fp, fn, tp) -> dict:
+    """
+    Derive metrics from confusion counts, elementwise when given arrays.
+
+    Args:
+        tn, fp, fn, tp: Confusion counts.
+
+    Returns:
+        dict: 'accuracy', 'precision', 'recall' and 'f1', 0 where undefined like sklearn's zero_division.
+    """
+    precision = safe_divide(tp, tp + fp)
+    recall = safe_divide(tp, tp + fn)
+
+    return {
+        "accuracy": safe_divide(np.add(tp, tn), np.add(tp, tn) + np.add(fp, fn)),
+        "precision": precision,
+        "recall": recall,
+        "f1": safe_divide(2 * precision * recall, precision + recall),
+    }
+
+def roc_auc(y_true, y_score) -> float:
+    """
+    Compute the area under the ROC curve from the rank sum of the positives.
+
+    Args:
+        y_true (numpy.ndarray): True labels, 1 for deer.
+        y_score (numpy.ndarray): Predicted probabilities.
+
+    Returns:
+        float: The AUC, NaN when only one class is present.
+    """
+    y_true = np.asarray(y_true).astype(bool)
+    y_score = np.asarray(y_score, dtype=np.float64)
+
+    positives = int(y_true.sum())
+    negatives = len(y_true) - positives
+    if not positives or not negatives:
+        return float("nan")
+
+    # Tied scores share their average rank
+    _, inverse, counts = np.unique(y_score, return_inverse=True, return_counts=True)
+    ranks = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+
+    return float((ranks[y_true].sum() - positives * (positives + 1) / 2) / (positives * negatives))
+
+def threshold_sweep(y_true, y_score) -> dict:
+    """
+    Evaluate every distinct score as the threshold, predicting deer at or above it.
+
+    Args:
+        y_true (numpy.ndarray): True labels, 1 for deer.
+        y_score (numpy.ndarray): Predicted probabilities.
+
+    Returns:
+        dict: Arrays aligned by threshold, from highest to lowest.
+            - 'threshold': The thresholds
+            - 'tn', 'fp', 'fn', 'tp': Confusion counts
+            - 'accuracy', 'precision', 'recall', 'f1': Metrics
+    """
+    y_true = np.asarray(y_true, dtype=np.int64)
+    y_score = np.asarray(y_score, dtype=np.float64)
+
+    order = np.argsort(-y_score, kind="stable")
+    scores = y_score[order]
+    tp = np.cumsum(y_true[order])
+    fp = np.cumsum(1 - y_true[order])
+
+    # The last position of each distinct score counts everything at or above it
+    last = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1] if len(scores) else np.empty(0, dtype=np.int64)
+    tp, fp = tp[last], fp[last]
+    fn = int(y_true.sum()) - tp
+    tn = len(y_true) - int(y_true.sum()) - fp
+
+    return {"threshold": scores[last], "tn": tn, "fp": fp, "fn": fn, "tp": tp, **count_metrics(tn, fp, fn, tp)}
+
+def best_threshold(sweep: dict, metric: str = "f1") -> float:
+    """
+    Pick the threshold that maximizes a metric.
+
+    Args:
+        sweep (dict): The sweep from `threshold_sweep`.
+        metric (str): The metric to maximize.
+
+    Returns:
+        float: The threshold, 0.5 for an empty sweep.
+    """
+    if not len(sweep["threshold"]):
+        return 0.5
+
+    return float(sweep["threshold"][np.argmax(sweep[metric])])
+
+def cascade_sweep(y_true, gate_score, model_score, lows, highs, threshold: float = 0.5) -> dict:
+    """
+    Evaluate a cascade at every pair of band thresholds: images the gate scores at or below
+    `low` or at or above `high` keep the gate's prediction, the ones in between get the model's.
+
+    Args:
+        y_true (numpy.ndarray): True labels, 1 for deer.
+        gate_score (numpy.ndarray): Probabilities of the cheap gating model.
+        model_score (numpy.ndarray): Probabilities of the expensive model, for every image.
+        lows (numpy.ndarray): Lower band thresholds.
+        highs (numpy.ndarray): Upper band thresholds.
+        threshold (float): Scores above this count as deer.
+
+    Returns:
+        dict: Arrays aligned by (low, high) pair, pairs with low not below high are left out.
+            - 'low', 'high': The band
+            - 'accuracy': Accuracy of the cascade
+            - 'decoded': Share of images sent to the expensive model
+    """
+    y_true = np.asarray(y_true).reshape(-1).astype(bool)
+    gate_score = np.asarray(gate_score, dtype=np.float64).reshape(-1)
+    model_correct = (np.asarray(model_score, dtype=np.float64).reshape(-1) > threshold) == y_true
+    gate_correct = (gate_score > threshold) == y_true
+
+    order = np.argsort(gate_score, kind="stable")
+    scores = gate_score[order]
+    zero = np.zeros(1, dtype=np.int64)
+    gate_hits = np.r_[zero, np.cumsum(gate_correct[order])]
+    model_hits = np.r_[zero, np.cumsum(model_correct[order])]
+
+    low, high = np.meshgrid(np.asarray(lows, dtype=np.float64), np.asarray(highs, dtype=np.float64), indexing="ij")
+    keep = low < high
+    low, high = low[keep], high[keep]
+
+    # Positions in the sorted scores splitting the gate's decisions from the band
+    below = np.searchsorted(scores, low, side="right")
+    above = np.searchsorted(scores, high, side="left")
+
+    correct = gate_hits[below] + (gate_hits[-1] - gate_hits[above]) + (model_hits[above] - model_hits[below])
+    count = max(len(scores), 1)
+
+    return {"low": low, "high": high, "accuracy": correct / count, "decoded": (above - below) / count}
+
+def store_slices(store: dict, rows) -> dict:
+    """
+    Get the slices to break results down by from the feature store.
+
+    Args:
+        store (dict): The feature store.
+        rows (numpy.ndarray): Feature store rows of the evaluated images.
+
+    Returns:
+        dict: Per slice, (codes, names) with each image's code into names, -1 where unknown.
+    """
+    rows = np.asarray(rows)
+
+    return {
+        "time": (store["is_night"][rows].astype(np.int64), ["day", "night"]),
+        "moonPhase": (store["moonPhase"][rows].astype(np.int64), store["moonPhase_vocab"].tolist()),
+        "camera": (store["camera"][rows].astype(np.int64), store["camera_vocab"].tolist()),
+    }
+
+def slice_metrics(y_true, y_pred, y_score, codes, names: list) -> list:
+    """
+    Break metrics down by slice, counting every slice's confusion matrix in one bincount.
+
+    Args:
+        y_true (numpy.ndarray): True labels, 1 for deer.
+        y_pred (numpy.ndarray): Predicted labels.
+        y_score (numpy.ndarray): Predicted probabilities.
+        codes (numpy.ndarray): Each image's slice, -1 where unknown.
+        names (list): The slice names.
+
+    Returns:
+        list: Per non-empty slice, a dict with its 'slice' name, 'count', confusion counts and metrics.
+    """
+    y_true = np.asarray(y_true, dtype=np.int64)
+    y_pred = np.asarray(y_pred, dtype=np.int64)
+    names = list(names) + ["unknown"]
+
+    # Unknown images go in their own group at the end
+    groups = np.where(codes < 0, len(names) - 1, codes)
+    counts = np.bincount(4 * groups + 2 * y_true + y_pred, minlength=4 * len(names)).reshape(-1, 4)
+    tn, fp, fn, tp = counts.T
+    derived = count_metrics(tn, fp, fn, tp)
+
+    results = list()
+    for group in np.flatnonzero(counts.sum(axis=1)):
+        mask = groups == group
+        results.append({
+            "slice": names[group],
+            "count": int(counts[group].sum()),
+            "tn": int(tn[group]), "fp": int(fp[group]), "fn": int(fn[group]), "tp": int(tp[group]),
+            **{name: float(values[group]) for name, values in derived.items()},
+            "auc": roc_auc(y_true[mask], y_score[mask]),
+        })
+
+    return results
+
+def evaluate(y_true, y_score, slices: dict = None, threshold: float = 0.5) -> dict:
+    """
+    Evaluate predictions from a single inference pass.
+
+    Args:
+        y_true (numpy.ndarray): True labels, 1 for deer.
+        y_score (numpy.ndarray): Predicted probabilities, or 0/1 for hard predictions.
+        slices (dict): Optional slices from `store_slices` to break the results down by.
+        threshold (float): Scores above this count as deer, like the notebook's `> 0.5`.
+
+    Returns:
+        dict: The results.
+            - 'count', 'threshold', 'confusion': [[tn, fp], [fn, tp]]
+            - 'accuracy', 'precision', 'recall', 'f1', 'auc'
+            - 'sweep': The `threshold_sweep`
+            - 'slices': Per slice, the `slice_metrics`
+    """
+    y_true = np.asarray(y_true).reshape(-1).astype(np.int64)
+    y_score = np.asarray(y_score, dtype=np.float64).reshape(-1)
+    y_pred = (y_score > threshold).astype(np.int64)
+
+    confusion = confusion_matrix(y_true, y_pred)
+    (tn, fp), (fn, tp) = confusion
+
+    return {
+        "count": len(y_true),
+        "threshold": threshold,
+        "confusion": confusion.tolist(),
+        **{name: float(value) for name, value in count_metrics(tn, fp, fn, tp).items()},
+        "auc": roc_auc(y_true, y_score),
+        "sweep": threshold_sweep(y_true, y_score),
+        "slices": {
+            name: slice_metrics(y_true, y_pred, y_score, codes, names)
+            for name, (codes, names) in (slices or {}).items()
+        },
+    }
+
+def print_report(result: dict, name: str) -> None:
+    """
+    Print the results of `evaluate`.
+
+    Args:
+        result (dict): The results.
+        name (str): What was evaluated, such as the model's name.
+    """
+    (tn, fp), (fn, tp) = result["confusion"]
+
+    print(f'{name} - {result["count"]} images, Accuracy: {result["accuracy"]:.4f}, Precision: {result["precision"]:.4f}, '
+          f'Recall: {result["recall"]:.4f}, F1 Score: {result["f1"]:.4f}, AUC: {result["auc"]:.4f}')
+    print(f'{name} - Confusion at {result["threshold"]:g}: tn={tn} fp={fp} fn={fn} tp={tp}, '
+          f'best F1 threshold: {best_threshold(result["sweep"]):.4f}')
+
+    for slice_name, rows in result["slices"].items():
+        for row in rows:
+            print(f'    {slice_name:<10} {row["slice"]:<18} {row["count"]:>8} acc {row["accuracy"]:.4f} '
+                  f'recall {row["recall"]:.4f} f1 {row["f1"]:.4f} auc {row["auc"]:.4f}')
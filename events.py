@@ -0,0 +1,168 @@
+"""
+Grouping of processed images into trigger events
+
+Trail cameras fire a burst of frames a few seconds apart every time they trigger. Frames of
+the same camera join one event while each is at most EVENT_GAP_SECONDS after the previous
+one and its perceptual hash is within EVENT_MAX_DISTANCE bits of it, so a different scene
+seconds later still starts a new event. The events are saved in the metadata store, so
+inference can score one representative frame per event and labeling can tag a whole event
+with one keypress.
+
+The perceptual hashes come from the image store's index, only images neither duplicate removal
+nor an earlier build has hashed are hashed here, and their hashes are saved for the next ones.
+
+Usage:
+    python events.py build
+"""
+
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import metadata_store
+import image_store
+import image_dedup
+import metrics
+from dataset import capture_time
+from feature_store import CAMERA_FIELD
+
+# Largest gap between consecutive frames of one event
+EVENT_GAP_SECONDS = int(os.getenv("EVENT_GAP_SECONDS") or 10)
+
+# Largest Hamming distance between the 64 bit hashes of consecutive frames of one event
+EVENT_MAX_DISTANCE = int(os.getenv("EVENT_MAX_DISTANCE") or 16)
+
+# Longest event, so a camera triggering over and over on a static scene isn't one event
+EVENT_MAX_FRAMES = int(os.getenv("EVENT_MAX_FRAMES") or 10)
+
+def frame_hashes(conn, paths: dict) -> tuple:
+    """
+    Get the perceptual hashes of processed images.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        paths (dict): Processed image paths, keyed by camera file name.
+
+    Returns:
+        tuple: (hashes, computed), the hash of each readable image keyed by file name, and
+            the ones that weren't stored yet keyed by content key, for `image_store.set_hashes`.
+    """
+    stored = image_store.name_hashes(conn)
+    hashes = {name: stored[name] for name in paths if name in stored}
+    todo = [name for name in paths if name not in stored]
+
+    if todo:
+        print(f"Hashing {len(todo)} images the duplicate removal hasn't...")
+
+    def hash_image(name):
+        # An unreadable image becomes an event of its own, and is hashed again by the next build
+        try:
+            with metrics.timer("phash_seconds"):
+                return image_dedup.phash(paths[name])
+        except (ValueError, OSError, cv2.error) as e:
+            print(f"Skipping {name}: {e}")
+            metrics.inc("event_hash_failures_total")
+            return None
+
+    computed = dict()
+    with ThreadPoolExecutor() as executor:
+        for name, value in zip(todo, executor.map(hash_image, todo)):
+            if value is not None:
+                hashes[name] = value
+                computed[image_store.locate(conn, name)] = value
+
+    return hashes, computed
+
+def group_frames(frames: list, gap: int = EVENT_GAP_SECONDS, max_distance: int = EVENT_MAX_DISTANCE,
+                 max_frames: int = EVENT_MAX_FRAMES) -> list:
+    """
+    Group frames into trigger events.
+
+    Args:
+        frames (list): (filename, capture time, camera, hash) tuples, capture time -1 and hash
+            None where unknown. Frames without either are events of their own.
+        gap (int): The largest gap in seconds between consecutive frames of an event.
+        max_distance (int): The largest hash distance between consecutive frames of an event.
+        max_frames (int): The most frames in an event.
+
+    Returns:
+        list: Each event's filenames in capture order.
+    """
+    by_camera = defaultdict(list)
+    events = list()
+
+    for frame in frames:
+        if frame[1] < 0 or frame[3] is None:
+            events.append([frame[0]])
+        else:
+            by_camera[frame[2]].append(frame)
+
+    for camera_frames in by_camera.values():
+        camera_frames.sort(key=lambda frame: (frame[1], frame[0]))
+        event = previous = None
+
+        for frame in camera_frames:
+            if (
+                event is not None and len(event) < max_frames
+                and frame[1] - previous[1] <= gap
+                and (frame[3] ^ previous[3]).bit_count() <= max_distance
+            ):
+                event.append(frame[0])
+            else:
+                event = [frame[0]]
+                events.append(event)
+
+            previous = frame
+
+    return events
+
+def representative(frames: list) -> str:
+    """
+    Pick the frame scored on behalf of an event.
+
+    Args:
+        frames (list): The event's filenames in capture order.
+
+    Returns:
+        str: The middle frame, the animal that triggered the burst is most often well inside it.
+    """
+    return frames[len(frames) // 2]
+
+def build_events(conn=None) -> int:
+    """
+    Group every stored image with a processed file into trigger events and save them.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store, opened if not given.
+
+    Returns:
+        int: The number of events.
+    """
+    conn = conn or metadata_store.connect()
+
+    paths = image_store.processed_paths(conn)
+
+    images = list()
+    for filename, record in metadata_store.iter_images(conn):
+        name = record.get("fullFilename")
+        if name in paths:
+            images.append((filename, name, capture_time(record), record.get(CAMERA_FIELD)))
+
+    hashes, computed = frame_hashes(conn, {name: paths[name] for _, name, _, _ in images})
+    events = group_frames([(filename, created, camera, hashes.get(name)) for filename, name, created, camera in images])
+
+    with conn:
+        image_store.set_hashes(conn, computed)
+        metadata_store.set_events(conn, events)
+
+    print(f"Grouped {len(images)} images into {len(events)} events ({len(images) / max(len(events), 1):.1f} frames per event).")
+
+    return len(events)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "build":
+        print(__doc__.strip())
+        sys.exit(1)
+
+    build_events()
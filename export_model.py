@@ -0,0 +1,299 @@
+"""
+Quantized TFLite export of the saved models, and a CPU benchmark against Keras
+
+`export` converts each saved model to TFLite twice: with float16 weights, and with int8
+weights and activations calibrated on a sample of processed images. `bench` compares every
+variant with the Keras model on the notebook's validation split: accuracy, size on disk,
+cold start (a fresh process loading the model and scoring one image) and per-image latency.
+
+Usage:
+    python export_model.py export [MODEL ...]
+    python export_model.py bench [MODEL ...]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import numpy as np
+import metadata_store
+import features
+import predict
+import dataset
+
+DEFAULT_MODELS = [os.path.join("models", "image_model.keras"), os.path.join("models", "combined_model.keras")]
+
+# Processed images the int8 activation ranges are calibrated on
+CALIBRATION_SAMPLES = int(os.getenv("CALIBRATION_SAMPLES") or 200)
+
+# Validation images timed one at a time for the latency percentiles
+LATENCY_SAMPLES = 200
+
+QUANTIZATIONS = ["float16", "int8"]
+
+def tflite_path(model_path: str, quantization: str) -> str:
+    """
+    Get the path an exported variant of a model is saved to.
+
+    Args:
+        model_path (str): Path to the saved Keras model.
+        quantization (str): One of QUANTIZATIONS.
+
+    Returns:
+        str: The .tflite path.
+    """
+    return f'{os.path.splitext(model_path)[0]}.{quantization}.tflite'
+
+def source_model(path: str) -> str:
+    """
+    Get the Keras model an exported variant was converted from.
+
+    Args:
+        path (str): Path to a .keras or exported .tflite model.
+
+    Returns:
+        str: Path to the saved Keras model.
+    """
+    if not path.endswith(".tflite"):
+        return path
+
+    return f'{path[:-len(".tflite")].rsplit(".", 1)[0]}.keras'
+
+def calibration_inputs(conn, spec: dict, samples: int = CALIBRATION_SAMPLES) -> list:
+    """
+    Sample processed images, with their metadata features for combined models, for calibration.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        spec (dict): The feature spec for combined models, otherwise None.
+        samples (int): The number of images.
+
+    Returns:
+        list: (pixels, metadata) pairs, metadata is None without a spec.
+    """
+    images = predict.find_images(conn)
+    if spec is not None:
+        images = [item for item in images if features.is_complete(item[2])]
+
+    images = random.Random(0).sample(images, min(samples, len(images)))
+
+    inputs = list()
+    for filename, file_path, record in images:
+        pixels = dataset.decode_image(file_path).astype(np.float32) * (1 / 255.0)
+        metadata = features.encode_features([record], spec)[0] if spec is not None else None
+        inputs.append((pixels, metadata))
+
+    return inputs
+
+def export_model(model_path: str) -> list:
+    """
+    Convert a saved model to float16 and int8 TFLite models.
+
+    Inputs and outputs stay float32, so the exported models take the same normalized images
+    and metadata features as the Keras model.
+
+    Args:
+        model_path (str): Path to the saved Keras model.
+
+    Returns:
+        list: Paths of the exported models.
+    """
+    import tensorflow as tf
+
+    conn = metadata_store.connect()
+    model = predict.load_model(model_path)
+    spec = predict.load_spec(model_path) if predict.is_combined(model) else None
+
+    calibration = calibration_inputs(conn, spec)
+    if not calibration:
+        raise ValueError("No processed images to calibrate the int8 model on.")
+
+    print(f"Calibrating on {len(calibration)} processed images...")
+
+    def representative_dataset():
+        for pixels, metadata in calibration:
+            yield [pixels[None], metadata[None]] if spec is not None else [pixels[None]]
+
+    exported = list()
+    for quantization in QUANTIZATIONS:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+        if quantization == "float16":
+            converter.target_spec.supported_types = [tf.float16]
+        else:
+            converter.representative_dataset = representative_dataset
+
+        start = time.perf_counter()
+        path = tflite_path(model_path, quantization)
+
+        with open(path, 'wb') as f:
+            f.write(converter.convert())
+
+        print(f"Exported {path} ({os.path.getsize(path) / 2**20:.1f}MB) in {time.perf_counter() - start:.1f}s")
+        exported.append(path)
+
+    return exported
+
+def load_interpreter(path: str):
+    """
+    Load a TFLite model, preferring the standalone tflite-runtime when it is installed.
+
+    Args:
+        path (str): Path to the .tflite model.
+
+    Returns:
+        Interpreter: The interpreter with its tensors allocated.
+    """
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+
+    interpreter = Interpreter(model_path=path, num_threads=os.cpu_count())
+    interpreter.allocate_tensors()
+
+    return interpreter
+
+def load_variant(path: str, model=None):
+    """
+    Load a Keras or TFLite model and wrap it as a function scoring one image.
+
+    Args:
+        path (str): Path to the .keras or .tflite model.
+        model (tf.keras.Model): The already loaded Keras model, if `path` is one.
+
+    Returns:
+        function: Takes (pixels, metadata) and returns the deer probability.
+    """
+    if not path.endswith(".tflite"):
+        model = model or predict.load_model(path)
+
+        def score(pixels, metadata=None):
+            inputs = [pixels[None], metadata[None]] if predict.is_combined(model) else pixels[None]
+            return float(np.asarray(model.predict_on_batch(inputs)).reshape(-1)[0])
+
+        return score
+
+    interpreter = load_interpreter(path)
+    input_details = interpreter.get_input_details()
+    output_index = interpreter.get_output_details()[0]["index"]
+
+    def score(pixels, metadata=None):
+        # The converter doesn't keep the Keras input order, tell them apart by rank
+        for detail in input_details:
+            value = pixels if len(detail["shape"]) == 4 else metadata
+            interpreter.set_tensor(detail["index"], value[None].astype(np.float32))
+
+        interpreter.invoke()
+        return float(interpreter.get_tensor(output_index).reshape(-1)[0])
+
+    return score
+
+def cold_start(path: str) -> float:
+    """
+    Time a fresh process importing the runtime, loading a model and scoring one image.
+
+    Args:
+        path (str): Path to the .keras or .tflite model.
+
+    Returns:
+        float: Seconds until the first prediction.
+    """
+    output = subprocess.run([sys.executable, __file__, "coldstart", path], capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])["seconds"]
+
+def benchmark(model_paths: list) -> list:
+    """
+    Compare each model with its exported variants on the notebook's validation split.
+
+    Args:
+        model_paths (list): Paths to the saved Keras models.
+
+    Returns:
+        list: One result dict per variant, also saved to models/export-benchmark.json.
+    """
+    conn = metadata_store.connect()
+    ds = dataset.load_dataset()
+
+    rows, records = dataset.labeled_rows(ds, conn)
+    _, val = dataset.train_val_split(len(rows))
+    labels = ds.labels[rows[val]]
+
+    print(f"Benchmarking on {len(val)} validation images")
+
+    results = list()
+    for model_path in model_paths:
+        model = predict.load_model(model_path)
+        spec = predict.load_spec(model_path) if predict.is_combined(model) else None
+        metadata = features.encode_features([records[i] for i in val], spec) if spec is not None else [None] * len(val)
+
+        for path in [model_path] + [tflite_path(model_path, quantization) for quantization in QUANTIZATIONS]:
+            if not os.path.exists(path):
+                print(f"Skipping {path}, run `python export_model.py export` first")
+                continue
+
+            score = load_variant(path, model if path == model_path else None)
+
+            probabilities = list()
+            latencies = list()
+            for i, row in enumerate(rows[val]):
+                pixels = ds.image(row).astype(np.float32) * (1 / 255.0)
+
+                start = time.perf_counter()
+                probabilities.append(score(pixels, metadata[i]))
+                if i < LATENCY_SAMPLES:
+                    latencies.append(time.perf_counter() - start)
+
+            # The first call includes graph tracing and allocation
+            latencies = latencies[1:] or latencies
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if latencies else (0, 0)
+
+            result = {
+                "model": path,
+                "accuracy": float(np.mean((np.array(probabilities) > 0.5) == (labels == 1))) if len(labels) else 0.0,
+                "sizeMB": os.path.getsize(path) / 2**20,
+                "coldStartSeconds": cold_start(path),
+                "latencyP50Ms": float(p50),
+                "latencyP99Ms": float(p99),
+            }
+            results.append(result)
+
+            print(f'{path}: accuracy {result["accuracy"]:.4f}, {result["sizeMB"]:.1f}MB, '
+                  f'cold start {result["coldStartSeconds"]:.2f}s, latency p50 {p50:.2f}ms, p99 {p99:.2f}ms')
+
+    with open(os.path.join("models", "export-benchmark.json"), 'w') as f:
+        json.dump(results, f, indent=4)
+
+    return results
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "coldstart":
+        # Run by `cold_start` in a fresh process
+        start = time.perf_counter()
+        score = load_variant(sys.argv[2])
+        spec_path = predict.feature_spec_path(source_model(sys.argv[2]))
+        width, height = dataset.IMAGE_SIZE
+        metadata = None
+
+        if os.path.exists(spec_path):
+            metadata = np.zeros(len(features.feature_names(features.load_feature_spec(spec_path))), dtype=np.float32)
+
+        score(np.zeros((height, width, 3), dtype=np.float32), metadata)
+        print(json.dumps({"seconds": time.perf_counter() - start}))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Export the saved models to quantized TFLite and benchmark them.")
+    parser.add_argument("command", choices=["export", "bench"])
+    parser.add_argument("models", nargs="*", default=DEFAULT_MODELS, help="Saved Keras models")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        for model_path in args.models:
+            export_model(model_path)
+    else:
+        benchmark(args.models)
@@ -0,0 +1,332 @@
+"""
+Columnar feature store built from the metadata store, replacing the CSV export
+
+Every stored image becomes one row of typed columns: capture time, hour, day of week, night
+flag, the raw weather readings, whether the camera's own tags name a deer, and moon phase,
+pressure tendency and camera as codes into vocabularies that only grow. The columns are saved as one uncompressed .npz, optionally as
+Parquet too, with the feature spec (scaler and categories) fitted on the labeled rows next
+to it, so training and inference load them without parsing any JSON or CSV.
+
+Rebuilds are incremental: existing rows are kept, only new images' records are decoded, and
+the labels are refreshed from the store's label column.
+
+Usage:
+    python feature_store.py build [--parquet]
+"""
+
+import os
+import argparse
+import numpy as np
+import metadata_store
+import features
+from dataset import LABELS
+
+FEATURE_STORE_DIR = os.getenv("FEATURE_STORE_DIR", "feature-store")
+FEATURE_STORE_FILE = "features.npz"
+FEATURE_SPEC_FILE = "spec.json"
+
+# Record field identifying the camera an image came from, for per-camera evaluation
+CAMERA_FIELD = os.getenv("CAMERA_FIELD", "cameraId")
+
+# The camera's own tags count as a deer detection when their name contains one of these
+VENDOR_KEYWORDS = ["deer", "buck", "doe"]
+
+def empty_store() -> dict:
+    """
+    Create a feature store without rows.
+
+    Returns:
+        dict: Empty columns of the right types, and empty vocabularies.
+    """
+    store = {
+        "filename": np.empty(0, dtype=str),
+        "label": np.empty(0, dtype=np.int8),
+        "created": np.empty(0, dtype=np.int64),
+        "hour": np.empty(0, dtype=np.int8),
+        "day_of_week": np.empty(0, dtype=np.int8),
+        "is_night": np.empty(0, dtype=bool),
+        "complete": np.empty(0, dtype=bool),
+        "vendor_deer": np.empty(0, dtype=bool),
+        "camera": np.empty(0, dtype=np.int16),
+        "camera_vocab": np.empty(0, dtype=str),
+    }
+
+    for field in features.NUMERIC_FIELDS:
+        store[field] = np.empty(0, dtype=np.float64)
+
+    for field in features.CATEGORICAL_FIELDS:
+        store[field] = np.empty(0, dtype=np.int16)
+        store[f'{field}_vocab'] = np.empty(0, dtype=str)
+
+    return store
+
+def load_feature_store(store_dir: str = FEATURE_STORE_DIR) -> dict:
+    """
+    Load the columns built by `build_feature_store`.
+
+    Args:
+        store_dir (str): The feature store directory.
+
+    Returns:
+        dict: Arrays keyed by column, empty if the store hasn't been built.
+            - 'filename': Image filenames, without extension
+            - 'label': 1 for deer, 0 for not-deer, -1 when unlabeled or bad
+            - 'created': Capture time in seconds since the epoch, -1 if unknown
+            - 'hour', 'day_of_week', 'is_night': UTC capture time features
+            - 'complete': True if the row has every field the metadata features need
+            - 'vendor_deer': True if the camera's own tags name a deer
+            - 'camera': Codes into 'camera_vocab', -1 where unknown
+            - NUMERIC_FIELDS: The raw readings, NaN where missing
+            - CATEGORICAL_FIELDS: Codes into '<field>_vocab', -1 where missing
+    """
+    try:
+        with np.load(os.path.join(store_dir, FEATURE_STORE_FILE), allow_pickle=False) as npz:
+            return {name: npz[name] for name in npz.files}
+    except FileNotFoundError:
+        return empty_store()
+
+def load_spec(store_dir: str = FEATURE_STORE_DIR) -> dict:
+    """
+    Load the feature spec fitted when the store was built.
+
+    Args:
+        store_dir (str): The feature store directory.
+
+    Returns:
+        dict: The spec, as from `features.fit_feature_spec`.
+    """
+    return features.load_feature_spec(os.path.join(store_dir, FEATURE_SPEC_FILE))
+
+def vendor_deer(record: dict) -> bool:
+    """
+    Check whether the camera's own tags name a deer.
+
+    Args:
+        record (dict): The image record.
+
+    Returns:
+        bool: True if any 'imageTags' name contains one of VENDOR_KEYWORDS.
+    """
+    return any(keyword in (tag.get("name") or "").lower() for tag in record.get("imageTags") or [] for keyword in VENDOR_KEYWORDS)
+
+def category_codes(values: list, vocab: list):
+    """
+    Code values by their position in a vocabulary, appending unseen values to it.
+
+    Args:
+        values (list): The values, None where missing.
+        vocab (list): The known categories, extended in place.
+
+    Returns:
+        numpy.ndarray: int16 codes, -1 where missing.
+    """
+    index = {category: i for i, category in enumerate(vocab)}
+    codes = np.full(len(values), -1, dtype=np.int16)
+
+    for i, value in enumerate(values):
+        if value is not None:
+            codes[i] = index.setdefault(str(value), len(index))
+
+    vocab[:] = list(index)
+    return codes
+
+def encode_columns(filenames: list, records: list, vocab: dict) -> dict:
+    """
+    Turn image records into typed columns.
+
+    Args:
+        filenames (list): The images' filenames.
+        records (list): The aligned image records.
+        vocab (dict): Per categorical field, the known categories, extended in place with new ones.
+
+    Returns:
+        dict: The rows' columns, labels left unset.
+    """
+    times = features.parse_times(records)
+    created = np.where(np.isnat(times), -1, times.astype(np.int64))
+    hours = (created // 3600) % 24
+
+    # 1970-01-01 was a Thursday, shift so Monday is 0 like pandas' dayofweek
+    columns = {
+        "filename": np.array(filenames, dtype=str),
+        "label": np.full(len(records), -1, dtype=np.int8),
+        "created": created,
+        "hour": hours.astype(np.int8),
+        "day_of_week": ((created // 86400 + 3) % 7).astype(np.int8),
+        "is_night": (hours < 6) | (hours > 18),
+        "complete": np.array([features.is_complete(record) for record in records], dtype=bool),
+        "vendor_deer": np.array([vendor_deer(record) for record in records], dtype=bool),
+        "camera": category_codes([record.get(CAMERA_FIELD) for record in records], vocab["camera"]),
+    }
+
+    for field in features.NUMERIC_FIELDS:
+        values = [record.get(field) for record in records]
+        columns[field] = np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+
+    for field in features.CATEGORICAL_FIELDS:
+        columns[field] = category_codes([record.get(field) for record in records], vocab[field])
+
+    return columns
+
+def fit_spec(store: dict, mask=None) -> dict:
+    """
+    Fit the scaler and categories on rows of the store, the same as `features.fit_feature_spec`
+    does on their records.
+
+    Args:
+        store (dict): The feature store.
+        mask (numpy.ndarray): Rows to fit on, by default the labeled complete rows.
+
+    Returns:
+        dict: The spec.
+    """
+    if mask is None:
+        mask = (store["label"] >= 0) & store["complete"]
+
+    scaler = dict()
+    for field in features.NUMERIC_FIELDS:
+        values = store[field][mask]
+        std = values.std() if len(values) else 0.0
+        scaler[field] = [float(values.mean()) if len(values) else 0.0, float(std) if std > 0 else 1.0]
+
+    categories = {
+        field: sorted(store[f'{field}_vocab'][np.unique(store[field][mask])].tolist())
+        for field in features.CATEGORICAL_FIELDS
+    }
+
+    return {"scaler": scaler, "categories": categories}
+
+def feature_matrix(store: dict, spec: dict, rows=None):
+    """
+    Encode rows of the store into the metadata feature matrix, matching `features.encode_features`.
+
+    Args:
+        store (dict): The feature store.
+        spec (dict): The spec the model was trained with.
+        rows (numpy.ndarray): Row positions to encode, all rows by default.
+
+    Returns:
+        numpy.ndarray: A (len(rows), len(features.feature_names(spec))) float32 matrix.
+    """
+    rows = np.arange(len(store["filename"])) if rows is None else np.asarray(rows)
+    if not len(rows):
+        return np.empty((0, len(features.feature_names(spec))), dtype=np.float32)
+
+    columns = [store["hour"][rows], store["day_of_week"][rows], store["is_night"][rows]]
+
+    for field in features.NUMERIC_FIELDS:
+        mean, std = spec["scaler"][field]
+        columns.append((store[field][rows] - mean) / std)
+
+    for field in features.CATEGORICAL_FIELDS:
+        # Map vocabulary codes to the spec's categories, unseen and missing ones to the dropped first
+        index = {category: i for i, category in enumerate(spec["categories"][field])}
+        lookup = np.array([index.get(category, 0) for category in store[f'{field}_vocab']] + [0], dtype=np.int64)
+        codes = lookup[store[field][rows]]
+        columns.extend(codes == i for i in range(1, len(index)))
+
+    return np.column_stack(columns).astype(np.float32)
+
+def rows_for(store: dict, filenames):
+    """
+    Find the rows of the given images.
+
+    Args:
+        store (dict): The feature store.
+        filenames (iterable): Image filenames, without extension.
+
+    Returns:
+        numpy.ndarray: The row of each image, -1 where it isn't in the store.
+    """
+    positions = {filename: i for i, filename in enumerate(store["filename"].tolist())}
+    return np.array([positions.get(filename, -1) for filename in filenames], dtype=np.int64)
+
+def write_parquet(store: dict, path: str) -> None:
+    """
+    Save the columns as Parquet, with the categorical fields as dictionary columns.
+
+    Args:
+        store (dict): The feature store.
+        path (str): Destination path.
+
+    Raises:
+        ImportError: If pyarrow isn't installed.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = {name: pa.array(store[name]) for name in ["filename", "label", "created", "hour", "day_of_week", "is_night", "complete", "vendor_deer"]}
+
+    for field in features.NUMERIC_FIELDS:
+        columns[field] = pa.array(store[field], from_pandas=True)
+
+    for field in [*features.CATEGORICAL_FIELDS, "camera"]:
+        codes = pa.array(store[field], mask=store[field] < 0)
+        columns[field] = pa.DictionaryArray.from_arrays(codes, pa.array(store[f'{field}_vocab']))
+
+    tmp_path = f'{path}.tmp'
+    pq.write_table(pa.table(columns), tmp_path)
+    os.replace(tmp_path, path)
+
+def build_feature_store(store_dir: str = FEATURE_STORE_DIR, parquet: bool = False) -> int:
+    """
+    Build or incrementally update the feature store from the metadata store.
+
+    Rows of images that are still stored are kept as they are, since the metadata of an image
+    doesn't change after collection. Only new images' records are decoded, and every label is
+    refreshed from the store's indexed label column. The spec is refitted on the labeled rows.
+
+    Args:
+        store_dir (str): The feature store directory.
+        parquet (bool): Also write the columns as Parquet.
+
+    Returns:
+        int: The number of rows.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+
+    conn = metadata_store.connect()
+    store = load_feature_store(store_dir)
+    if set(store) != set(empty_store()):
+        print("Feature store columns changed, rebuilding.")
+        store = empty_store()
+
+    labels = dict(metadata_store.iter_labels(conn))
+
+    keep = np.array([filename in labels for filename in store["filename"].tolist()], dtype=bool)
+    known = set(store["filename"][keep].tolist())
+    new = [filename for filename in labels if filename not in known]
+
+    print(f"{len(known)} images already in the feature store, adding {len(new)}...")
+
+    vocab = {field: store[f'{field}_vocab'].tolist() for field in [*features.CATEGORICAL_FIELDS, "camera"]}
+    records = metadata_store.get_images(conn, new)
+    columns = encode_columns(new, [records[filename] for filename in new], vocab)
+
+    store = {name: np.concatenate([store[name][keep], column]) for name, column in columns.items()}
+    for field, categories in vocab.items():
+        store[f'{field}_vocab'] = np.array(categories, dtype=str)
+
+    store["label"] = np.array([LABELS.get(labels[filename], -1) for filename in store["filename"].tolist()], dtype=np.int8)
+
+    tmp_path = os.path.join(store_dir, f'{FEATURE_STORE_FILE}.tmp.npz')
+    np.savez(tmp_path, **store)
+    os.replace(tmp_path, os.path.join(store_dir, FEATURE_STORE_FILE))
+
+    features.save_feature_spec(fit_spec(store), os.path.join(store_dir, FEATURE_SPEC_FILE))
+
+    if parquet:
+        write_parquet(store, os.path.join(store_dir, "features.parquet"))
+
+    labeled = int(np.sum((store["label"] >= 0) & store["complete"]))
+    print(f"Feature store has {len(store['filename'])} images, {labeled} labeled with complete metadata")
+
+    return len(store["filename"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the columnar feature store from the metadata store.")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--parquet", action="store_true", help="Also write features.parquet, requires pyarrow")
+    args = parser.parse_args()
+
+    build_feature_store(parquet=args.parquet)
@@ -0,0 +1,152 @@
+"""
+Metadata features for the metadata-only and combined models
+
+Encodes image records the same way the notebook's preprocessing does: hour, day of week and
+a night flag from the capture time, standardized weather readings, and one-hot encoded moon
+phase and pressure tendency. The fitted scaler and categories are kept as a spec so the
+same encoding can be applied at inference time.
+"""
+
+import json
+import numpy as np
+from datetime import datetime
+
+# Standardized numeric fields, in the notebook's column order
+NUMERIC_FIELDS = ["pressure", "temperature", "wind", "windDirection"]
+
+# One-hot encoded fields, each dropping its first category like `pd.get_dummies(drop_first=True)`
+CATEGORICAL_FIELDS = ["moonPhase", "pressureTendency"]
+
+def parse_times(records: list):
+    """
+    Parse the capture times of image records.
+
+    Args:
+        records (list): Image records.
+
+    Returns:
+        numpy.ndarray: datetime64[s] UTC capture times, NaT where missing.
+    """
+    times = np.full(len(records), np.datetime64("NaT"), dtype="datetime64[s]")
+
+    for i, record in enumerate(records):
+        created = record.get("createdDateTime")
+        if created:
+            parsed = datetime.fromisoformat(created.replace("Z", "+00:00"))
+            times[i] = np.datetime64(int(parsed.timestamp()), "s")
+
+    return times
+
+def is_complete(record: dict) -> bool:
+    """
+    Check that a record has every field the features need, like the notebook's `dropna`.
+
+    Args:
+        record (dict): The image record.
+
+    Returns:
+        bool: True if the record can be encoded.
+    """
+    return all(record.get(field) is not None for field in ["createdDateTime", *NUMERIC_FIELDS, *CATEGORICAL_FIELDS])
+
+def fit_feature_spec(records: list) -> dict:
+    """
+    Fit the scaler and category vocabulary on a set of records.
+
+    Args:
+        records (list): Complete image records, usually the labeled training set.
+
+    Returns:
+        dict: The spec.
+            - 'scaler': Per numeric field, [mean, standard deviation]
+            - 'categories': Per categorical field, the sorted categories
+    """
+    scaler = dict()
+    for field in NUMERIC_FIELDS:
+        values = np.array([float(record[field]) for record in records], dtype=np.float64)
+        std = values.std()
+        scaler[field] = [float(values.mean()), float(std) if std > 0 else 1.0]
+
+    categories = {
+        field: sorted({str(record[field]) for record in records})
+        for field in CATEGORICAL_FIELDS
+    }
+
+    return {"scaler": scaler, "categories": categories}
+
+def feature_names(spec: dict) -> list:
+    """
+    Name the columns produced by `encode_features`.
+
+    Args:
+        spec (dict): The spec from `fit_feature_spec`.
+
+    Returns:
+        list: Column names.
+    """
+    names = ["hour", "day_of_week", "is_night", *NUMERIC_FIELDS]
+    for field in CATEGORICAL_FIELDS:
+        names.extend(f'{field}_{category}' for category in spec["categories"][field][1:])
+
+    return names
+
+def encode_features(records: list, spec: dict):
+    """
+    Encode records into the metadata feature matrix.
+
+    Categories that weren't seen when the spec was fitted encode as all zeros, the same as the
+    dropped first category.
+
+    Args:
+        records (list): Complete image records.
+        spec (dict): The spec from `fit_feature_spec`.
+
+    Returns:
+        numpy.ndarray: A (len(records), len(feature_names(spec))) float32 matrix.
+    """
+    if not records:
+        return np.empty((0, len(feature_names(spec))), dtype=np.float32)
+
+    times = parse_times(records)
+    hours = (times.astype("datetime64[h]") - times.astype("datetime64[D]")).astype(np.int64)
+
+    # 1970-01-01 was a Thursday, shift so Monday is 0 like pandas' dayofweek
+    days = (times.astype("datetime64[D]").astype(np.int64) + 3) % 7
+
+    columns = [hours, days, (hours < 6) | (hours > 18)]
+
+    for field in NUMERIC_FIELDS:
+        mean, std = spec["scaler"][field]
+        values = np.array([float(record[field]) for record in records], dtype=np.float64)
+        columns.append((values - mean) / std)
+
+    for field in CATEGORICAL_FIELDS:
+        index = {category: i for i, category in enumerate(spec["categories"][field])}
+        codes = np.array([index.get(str(record[field]), 0) for record in records])
+        columns.extend(codes == i for i in range(1, len(index)))
+
+    return np.column_stack(columns).astype(np.float32)
+
+def save_feature_spec(spec: dict, path: str) -> None:
+    """
+    Save a spec as JSON.
+
+    Args:
+        spec (dict): The spec from `fit_feature_spec`.
+        path (str): Destination path.
+    """
+    with open(path, 'w') as f:
+        json.dump(spec, f, indent=4)
+
+def load_feature_spec(path: str) -> dict:
+    """
+    Load a spec saved by `save_feature_spec`.
+
+    Args:
+        path (str): Path to the spec.
+
+    Returns:
+        dict: The spec.
+    """
+    with open(path, 'r') as f:
+        return json.load(f)
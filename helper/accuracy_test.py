@@ -1,43 +1,25 @@
 import os 
-import json 
+import sys
+import numpy as np
 
-IMAGE_JSON = os.path.join(os.getcwd(), "images.json")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import feature_store
+import evaluation
 
-with open(IMAGE_JSON, 'r') as f: 
-    image_json = json.load(f)
+# Picks up images labeled since the last build, the labels and camera tags are columns from there on
+feature_store.build_feature_store()
+store = feature_store.load_feature_store()
 
-num_correct = 0 
-num_miss = 0 
-num_deer = 0 
+rows = np.flatnonzero(store["label"] >= 0)
+y_true = store["label"][rows] == 1
+pred_deer = store["vendor_deer"][rows]
 
-for image_dict in image_json.values(): 
-    if not image_dict.get("newTags"): 
-        continue
+result = evaluation.evaluate(y_true, pred_deer, evaluation.store_slices(store, rows))
+(tn, fp), (fn, tp) = result["confusion"]
 
-    deer = image_dict.get("newTags")[0]
-    pred_deer = False
+print(f'Num correct: {tn + tp}')
+print(f'Num miss: {fn + fp}')
+print(f'Accuracy: {result["accuracy"]}')
+print(f'Num deer: {int(y_true.sum())}')
 
-    for tag in image_dict.get("imageTags"): 
-        if any(keyword in tag.get("name", "").lower() for keyword in ["deer", "buck", "doe"]):
-            pred_deer = True 
-            
-    if deer == "deer": 
-        num_deer += 1 
-
-        if pred_deer: 
-            num_correct += 1
-            continue
-
-        num_miss += 1
-        continue
-
-    if pred_deer: 
-        num_miss += 1
-        continue
-
-    num_correct += 1
-
-print(f'Num correct: {num_correct}')
-print(f'Num miss: {num_miss}')
-print(f'Accuracy: {num_correct / (num_correct + num_miss)}')
-print(f'Num deer: {num_deer}')
+evaluation.print_report(result, "Camera tags")
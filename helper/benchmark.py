@@ -0,0 +1,300 @@
+"""
+End-to-end pipeline benchmark against the local stub camera API
+
+Runs every stage of the pipeline at several dataset sizes, each size in a fresh working
+directory and process, against a stub serving a distinct scene per burst of three images:
+
+- get_image_range: paging through the metadata
+- collect: a full `image_collection.build_images()` sync, and a no-op re-sync
+- process_image: single image latency
+- process_images: the full processing run (without duplicate removal), and a no-op re-run
+- remove_duplicates, clean_metadata, json_to_csv
+- events: grouping the processed images into trigger events
+- feature_store: building the feature columns
+- dataset_build, dataset_load: packing the dataset, then mapping and streaming it
+
+Results are written to results/benchmarks/<commit>.json so runs can be compared across commits:
+
+Usage:
+    python helper/benchmark.py --sizes 1000,10000,100000
+    python helper/benchmark.py --sizes 1000 --stages get_image_range,collect
+    python helper/benchmark.py --compare results/benchmarks/abc1234.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import runpy
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from stub_api import start_stub_server
+
+RESULTS_DIR = os.path.join(REPO_DIR, "results", "benchmarks")
+
+STAGES = ["get_image_range", "collect", "collect_noop", "process_image", "process_images", "process_images_noop",
+          "remove_duplicates", "clean_metadata", "json_to_csv", "events", "feature_store", "dataset_build", "dataset_load"]
+
+# Images timed one at a time for the process_image latency percentiles
+LATENCY_SAMPLES = 500
+
+def git_commit() -> str:
+    """
+    Identify the checked out commit, marking uncommitted changes.
+
+    Returns:
+        str: The short commit hash, with a '-dirty' suffix when tracked files are modified.
+    """
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+
+    return f'{commit or "unknown"}{"-dirty" if dirty else ""}'
+
+def timed(fn, items: int) -> dict:
+    """
+    Time one stage.
+
+    Args:
+        fn (function): Runs the stage.
+        items (int or function): The number of items the stage handles, or a function counting them afterwards.
+
+    Returns:
+        dict: 'seconds', 'items' and 'perSecond'.
+    """
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+
+    items = items() if callable(items) else items
+    return {"seconds": seconds, "items": items, "perSecond": items / max(seconds, 1e-9)}
+
+def run_stages(size: int, stages: list) -> dict:
+    """
+    Run the selected stages in the current directory, which the stages use as their workspace.
+
+    Pipeline modules are imported here, since they resolve their paths from the working directory.
+
+    Args:
+        size (int): The number of images the stub serves.
+        stages (list): Names from STAGES to time, the others still run when later stages need their output.
+
+    Returns:
+        dict: Results keyed by stage.
+    """
+    import image_collection
+    import image_processing
+    import image_dedup
+    import metadata_store
+    import image_store
+    import feature_store
+    import events
+    import dataset
+
+    results = dict()
+
+    def record(name, result):
+        results[name] = result
+        print(f'{name}: {result["items"]} in {result["seconds"]:.2f}s ({result["perSecond"]:.1f}/sec)', file=sys.stderr)
+
+    def stage(name, fn, items):
+        if name in stages:
+            record(name, timed(fn, items))
+        else:
+            fn()
+
+    take = image_collection.TAKE_AMOUNT
+    if "get_image_range" in stages:
+        record("get_image_range", timed(lambda: [image_collection.get_image_range(skip, take) for skip in range(0, size, take)], size))
+
+    # Everything after depends on the collected images
+    conn = metadata_store.connect()
+    stage("collect", image_collection.build_images, lambda: image_store.count_blobs(conn))
+    stage("collect_noop", image_collection.build_images, size)
+
+    # Label every image from the camera's own tags, so the export and dataset stages have work to do
+    with conn:
+        for filename, image in list(metadata_store.iter_images(conn)):
+            metadata_store.set_tags(conn, filename, ["deer" if image.get("imageTags") else "not-deer"])
+
+    if "process_image" in stages:
+        image_processing.preflight_checks()
+        keys = image_store.pending(conn, image_processing.SIZE_TAG)[:LATENCY_SAMPLES]
+        latencies = list()
+
+        # Not marked processed in the index, so the full run below still processes them
+        for key in keys:
+            start = time.perf_counter()
+            image_processing.process_image(image_store.raw_path(key), image_store.processed_path(key))
+            latencies.append(time.perf_counter() - start)
+
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if latencies else (0, 0)
+        record("process_image", {
+            "seconds": sum(latencies), "items": len(latencies), "perSecond": len(latencies) / max(sum(latencies), 1e-9),
+            "p50Ms": float(p50), "p99Ms": float(p99),
+        })
+
+        # The full run below should start from nothing processed
+        shutil.rmtree(image_processing.IMAGE_PROCESSED_DIR)
+
+    stage("process_images", image_processing.process_images, lambda: image_store.count_blobs(conn, processed=True))
+    stage("process_images_noop", image_processing.process_images, size)
+
+    processed = image_store.count_blobs(conn, processed=True)
+    stage("remove_duplicates", image_dedup.remove_duplicates, processed)
+
+    processed = image_store.count_blobs(conn, processed=True)
+    stage("clean_metadata", image_processing.clean_metadata, size)
+    stage("json_to_csv", lambda: runpy.run_path(os.path.join(REPO_DIR, "helper", "json_to_csv.py")), processed)
+    stage("events", events.build_events, processed)
+    stage("feature_store", feature_store.build_feature_store, size)
+    stage("dataset_build", dataset.build_dataset, processed)
+
+    def load_and_stream():
+        ds = dataset.load_dataset()
+        for _ in dataset.iter_batches(ds, np.arange(len(ds)), batch_size=64, shuffle=True):
+            pass
+
+    stage("dataset_load", load_and_stream, processed)
+
+    return results
+
+def run_size(size: int, stages: list, width: int, height: int, verbose: bool = False, keep: bool = False) -> dict:
+    """
+    Benchmark one dataset size in a fresh working directory and process.
+
+    Args:
+        size (int): The number of images the stub serves.
+        stages (list): Names from STAGES to time.
+        width (int): Width of the served images.
+        height (int): Height of the served images.
+        verbose (bool): Show the stages' own output.
+        keep (bool): Keep the working directory.
+
+    Returns:
+        dict: Results keyed by stage.
+    """
+    workdir = tempfile.mkdtemp(prefix=f'deer-benchmark-{size}-')
+    server = start_stub_server(size, width=width, height=height, bursts=True)
+
+    env = dict(
+        os.environ,
+        API_URL=f'http://127.0.0.1:{server.server_address[1]}',
+        API_BEARER="benchmark",
+        IMAGE_TOTAL=str(size),
+        PROCESS_ON_DOWNLOAD="false",
+        KEEP_RAW="true",
+        REMOVE_DUPLICATES="false",
+        IMAGES_DB="images.db",
+        IMAGES_JSON="images.json",
+        IMAGE_PROCESSED_DIR="processed-images",
+        DATASET_DIR="dataset",
+        FEATURE_STORE_DIR="feature-store",
+    )
+
+    output = os.path.join(workdir, "benchmark-results.json")
+
+    try:
+        print(f"Benchmarking {size} images in {workdir}...")
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", str(size), "--output", output, "--stages", ",".join(stages)],
+            cwd=workdir, env=env, check=True, stdout=None if verbose else subprocess.DEVNULL,
+        )
+
+        with open(output, 'r') as f:
+            return json.load(f)
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Print the throughput of each stage relative to a baseline run.
+
+    Args:
+        results (dict): This run's results.
+        baseline (dict): The results to compare against.
+        tolerance (float): Largest accepted drop in throughput, as a fraction.
+
+    Returns:
+        bool: True if no stage regressed beyond the tolerance.
+    """
+    print(f'\nCompared to {baseline["commit"]}:')
+    passed = True
+
+    for size, stages in results["sizes"].items():
+        for name, result in stages.items():
+            before = baseline["sizes"].get(size, {}).get(name)
+            if not before:
+                continue
+
+            ratio = result["perSecond"] / max(before["perSecond"], 1e-9)
+            regressed = ratio < 1 - tolerance
+            passed = passed and not regressed
+
+            print(f'{size:>8} {name:<20} {before["perSecond"]:>10.1f} -> {result["perSecond"]:>10.1f}/sec '
+                  f'({ratio - 1:+.0%}){"  REGRESSION" if regressed else ""}')
+
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma separated dataset sizes")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated stages to time")
+    parser.add_argument("--width", type=int, default=1280, help="Width of the served images")
+    parser.add_argument("--height", type=int, default=720, help="Height of the served images")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Throughput drop reported as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Show the stages' own output")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directories")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    stages = [name for name in args.stages.split(",") if name]
+
+    if args.worker:
+        # Run by `run_size` inside the working directory
+        with open(args.output, 'w') as f:
+            json.dump(run_stages(args.worker, stages), f)
+        sys.exit(0)
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "imageSize": [args.width, args.height],
+        "sizes": dict(),
+    }
+
+    # Read before saving, the baseline may be an earlier run of this same commit
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        results["sizes"][str(size)] = run_size(size, stages, args.width, args.height, args.verbose, args.keep)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR, f'{results["commit"]}.json')
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    print(f"Saved results to {results_path}")
+
+    if baseline:
+        sys.exit(0 if compare(results, baseline, args.tolerance) else 1)
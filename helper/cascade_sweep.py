@@ -0,0 +1,109 @@
+"""
+Sweep of the cascade's uncertainty band, trading accuracy against images decoded
+
+Scores the notebook's validation split once with the metadata-only model (from the feature
+store) and once with the image model (from the packed dataset), then evaluates
+`predict.py --cascade` at every band from the two sets of scores. Prints the bands on the
+accuracy vs. images decoded frontier and saves every band to models/cascade-sweep.json.
+
+Usage:
+    python helper/cascade_sweep.py [--model MODEL] [--metadata-model MODEL] [--step 0.05]
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metadata_store
+import feature_store
+import evaluation
+import predict
+import dataset
+
+def validation_scores(model_path: str, gate_path: str, batch_size: int = predict.BATCH_SIZE) -> tuple:
+    """
+    Score the notebook's validation split with both models of the cascade.
+
+    Args:
+        model_path (str): Path to the saved image or combined model.
+        gate_path (str): Path to the saved metadata-only model.
+        batch_size (int): Images per batch.
+
+    Returns:
+        tuple: (y_true, gate_score, model_score) arrays aligned by validation image.
+    """
+    conn = metadata_store.connect()
+    ds = dataset.load_dataset()
+
+    rows, _ = dataset.labeled_rows(ds, conn)
+    _, val = dataset.train_val_split(len(rows))
+    rows = rows[val]
+
+    # Picks up images labeled since the last build
+    feature_store.build_feature_store()
+    store = feature_store.load_feature_store()
+    store_rows = feature_store.rows_for(store, ds.filenames[rows])
+
+    print(f"Scoring {len(rows)} validation images with {gate_path} and {model_path}...")
+
+    gate = predict.load_model(gate_path)
+    gate_spec = predict.load_spec(gate_path)
+    gate_score = np.asarray(gate.predict_on_batch(feature_store.feature_matrix(store, gate_spec, store_rows))).reshape(-1)
+
+    model = predict.load_model(model_path)
+    spec = predict.load_spec(model_path) if predict.is_combined(model) else None
+
+    model_score = list()
+    for start in range(0, len(rows), batch_size):
+        pixels = ds.images(rows[start:start + batch_size]).astype(np.float32) * (1 / 255.0)
+        inputs = [pixels, feature_store.feature_matrix(store, spec, store_rows[start:start + batch_size])] if spec is not None else pixels
+        model_score.extend(np.asarray(model.predict_on_batch(inputs)).reshape(-1))
+
+    return ds.labels[rows] == 1, gate_score, np.array(model_score)
+
+def frontier(sweep: dict) -> np.ndarray:
+    """
+    Find the bands no other band beats on both accuracy and images decoded.
+
+    Args:
+        sweep (dict): The sweep from `evaluation.cascade_sweep`.
+
+    Returns:
+        numpy.ndarray: Positions of the frontier's bands, by images decoded.
+    """
+    order = np.lexsort((-sweep["accuracy"], sweep["decoded"]))
+    best = np.maximum.accumulate(sweep["accuracy"][order])
+    improves = np.r_[True, best[1:] > best[:-1]]
+
+    return order[improves]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep the cascade's uncertainty band on the validation split.")
+    parser.add_argument("--model", default=predict.MODEL_PATH, help="Saved image or combined model (default: MODEL_PATH)")
+    parser.add_argument("--metadata-model", default=predict.METADATA_MODEL_PATH, help="Saved metadata-only model (default: METADATA_MODEL_PATH)")
+    parser.add_argument("--step", type=float, default=0.05, help="Spacing of the band thresholds")
+    args = parser.parse_args()
+
+    y_true, gate_score, model_score = validation_scores(args.model, args.metadata_model)
+
+    thresholds = np.round(np.arange(0, 1 + args.step / 2, args.step), 6)
+    sweep = evaluation.cascade_sweep(y_true, gate_score, model_score, thresholds, thresholds)
+
+    print(f'Metadata model alone: accuracy {evaluation.evaluate(y_true, gate_score)["accuracy"]:.4f}, 0% decoded')
+    print(f'Image model alone:    accuracy {evaluation.evaluate(y_true, model_score)["accuracy"]:.4f}, 100% decoded')
+    print(f'{"low":>6} {"high":>6} {"accuracy":>9} {"decoded":>8}')
+
+    for i in frontier(sweep):
+        print(f'{sweep["low"][i]:>6.2f} {sweep["high"][i]:>6.2f} {sweep["accuracy"][i]:>9.4f} {sweep["decoded"][i]:>8.1%}')
+
+    os.makedirs("models", exist_ok=True)
+    with open(os.path.join("models", "cascade-sweep.json"), 'w') as f:
+        json.dump([
+            {"low": float(low), "high": float(high), "accuracy": float(accuracy), "decoded": float(decoded)}
+            for low, high, accuracy, decoded in zip(sweep["low"], sweep["high"], sweep["accuracy"], sweep["decoded"])
+        ], f, indent=4)
+
+    print("Saved every band to models/cascade-sweep.json")
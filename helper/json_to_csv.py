@@ -1,36 +1,32 @@
-import json 
 import os 
+import sys
+import csv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metadata_store
+import image_store
 
-IMAGE_JSON = os.path.join(os.getcwd(), "images.json")
 IMAGE_CSV = os.path.join(os.getcwd(), 'images.csv')
-IMAGE_PROCESSED_DIR = os.getenv("IMAGE_PROCESSED_DIR", "processed-images")
 
-with open(IMAGE_JSON, 'r') as i, open(IMAGE_CSV, 'w') as o:
-    i = json.load(i)
-    o.writelines(",".join(["image_path,label,timestamp","moonPhase","pressure","pressureTendency","temperature","wind","windDirection"]))
-    o.writelines("\n")
+# Training reads `python feature_store.py build` instead, this export is for inspecting the data
+COLUMNS = ["image_path", "label", "timestamp", "moonPhase", "pressure", "pressureTendency", "temperature", "wind", "windDirection"]
+
+with open(IMAGE_CSV, 'w', newline='') as o:
+    conn = metadata_store.connect()
+    writer = csv.writer(o)
+    writer.writerow(COLUMNS)
+    paths = image_store.processed_paths(conn)
     
-    for line in i.values(): 
+    for _, line in metadata_store.iter_images(conn, labeled=True): 
         deer_tag = line.get("newTags")
 
         # Skip if bad
-        if not deer_tag or deer_tag == "bad": 
+        if not deer_tag or deer_tag[0] == "bad" or line.get("fullFilename") not in paths: 
             continue
         
-        else: 
-            deer_tag = deer_tag[0]
-            
-        o_line = list() 
-        o_line.append(os.path.join(IMAGE_PROCESSED_DIR, line.get("fullFilename")))
-        o_line.append(deer_tag)
-        o_line.append(line.get("createdDateTime"))
-        o_line.append(line.get("moonPhase"))
-        o_line.append(line.get("pressure"))
-        o_line.append(line.get("pressureTendency"))
-        o_line.append(line.get("temperature"))
-        o_line.append(line.get("wind"))
-        o_line.append(line.get("windDirection"))
-
-        o_line = [str(l) for l in o_line]
-
-        o.writelines(",".join(o_line) + "\n")
+        writer.writerow([
+            paths[line.get("fullFilename")],
+            deer_tag[0],
+            line.get("createdDateTime"),
+            *(line.get(column) for column in COLUMNS[3:]),
+        ])
@@ -0,0 +1,154 @@
+"""
+Load test for serve.py, comparing micro-batch settings
+
+Starts the service once per batch/deadline setting, sharing one loaded model, and fires
+requests at it from concurrent clients. Reports throughput, tail latency and the mean batch
+size each setting achieved. Requests carry synthetic images and metadata from the stub API.
+
+Usage:
+    python helper/serve_load_test.py --model models/combined_model.keras --settings 1:0,8:5,32:10,64:20
+    python helper/serve_load_test.py --url http://127.0.0.1:8080  # An already running service
+"""
+
+import os
+import sys
+import time
+import base64
+import argparse
+import threading
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import predict
+import serve
+from stub_api import synthetic_jpegs, image_record
+
+def make_payloads(count: int = 64) -> list:
+    """
+    Build request bodies from the stub's synthetic images and records.
+
+    Args:
+        count (int): The number of distinct payloads.
+
+    Returns:
+        list: JSON request bodies.
+    """
+    jpegs = synthetic_jpegs(224, 224)
+    payloads = list()
+
+    for i in range(count):
+        record = {k: v for k, v in image_record(i, "").items() if k != "imageUrl"}
+        record["image"] = base64.b64encode(jpegs[i % len(jpegs)]).decode()
+        payloads.append(record)
+
+    return payloads
+
+def run_load(url: str, payloads: list, total: int, concurrency: int) -> dict:
+    """
+    Send `total` requests from `concurrency` clients, each keeping its connection alive.
+
+    Args:
+        url (str): The service's base URL.
+        payloads (list): Request bodies, cycled through.
+        total (int): The number of requests.
+        concurrency (int): Concurrent clients.
+
+    Returns:
+        dict: The results.
+            - 'requests': Successful requests
+            - 'errors': Failed requests
+            - 'throughput': Successful requests per second
+            - 'p50', 'p95', 'p99': Request latency in milliseconds
+            - 'meanBatchSize': Mean micro-batch size reported by the service
+    """
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+    latencies = list()
+    errors = [0]
+
+    def client():
+        session = requests.Session()
+
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+
+            start = time.perf_counter()
+            try:
+                response = session.post(f'{url}/predict', json=payloads[i % len(payloads)], timeout=60)
+                response.raise_for_status()
+            except requests.RequestException:
+                with counter_lock:
+                    errors[0] += 1
+                continue
+
+            latencies.append(time.perf_counter() - start)
+
+    before = requests.get(f'{url}/health', timeout=10).json()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    after = requests.get(f'{url}/health', timeout=10).json()
+    batches = after["batches"] - before["batches"]
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if latencies else (0, 0, 0)
+
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput": len(latencies) / max(elapsed, 1e-9),
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+        "meanBatchSize": len(latencies) / batches if batches else 0,
+    }
+
+def print_result(setting: str, result: dict) -> None:
+    """
+    Print one setting's results as a table row.
+
+    Args:
+        setting (str): The batch:wait setting.
+        result (dict): The results from `run_load`.
+    """
+    print(f'{setting:>10} {result["throughput"]:>10.1f} {result["p50"]:>9.1f} {result["p95"]:>9.1f} '
+          f'{result["p99"]:>9.1f} {result["meanBatchSize"]:>10.1f} {result["errors"]:>7}')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=predict.MODEL_PATH, help="Saved Keras model (default: MODEL_PATH)")
+    parser.add_argument("--url", help="Test an already running service instead of starting one per setting")
+    parser.add_argument("--settings", default="1:0,8:5,32:10,64:20", help="Comma separated max-batch:max-wait-ms pairs")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per setting")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients")
+    args = parser.parse_args()
+
+    payloads = make_payloads()
+
+    print(f'{"setting":>10} {"req/sec":>10} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"mean batch":>10} {"errors":>7}')
+
+    if args.url:
+        print_result("external", run_load(args.url, payloads, args.requests, args.concurrency))
+        sys.exit(0)
+
+    model = predict.load_model(args.model)
+
+    for setting in args.settings.split(","):
+        max_batch, max_wait_ms = setting.split(":")
+        server = serve.start_server(args.model, 0, int(max_batch), float(max_wait_ms), model=model)
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+
+        # Warm up so the first batch's graph tracing isn't counted
+        run_load(url, payloads, args.concurrency, args.concurrency)
+        print_result(setting, run_load(url, payloads, args.requests, args.concurrency))
+
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,123 @@
+"""
+Startup time of the `deer.py` subcommands
+
+Times fresh processes, the way cron starts them, in an empty working directory where the
+incremental subcommands find nothing new, next to a bare interpreter and the imports the
+subcommands defer until there is work. Each command is first run once with `-X importtime`,
+and the benchmark fails if it imports a module it should defer, such as OpenCV.
+
+Usage:
+    python helper/startup_benchmark.py [--repeats 10]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEER = os.path.join(REPO_DIR, "deer.py")
+
+# Name, interpreter arguments and the modules the command must not import
+PROBES = [
+    ("python", ["-c", "pass"], []),
+    ("deer --help", [DEER, "--help"], ["cv2", "tensorflow"]),
+    ("deer process (nothing new)", [DEER, "process"], ["cv2", "tensorflow"]),
+    ("deer dedup (nothing new)", [DEER, "dedup"], ["cv2", "tensorflow"]),
+    ("deer predict --new (nothing new)", [DEER, "predict", "--new"], ["tensorflow"]),
+    ("import image_collection", ["-c", "import image_collection"], ["cv2", "tensorflow"]),
+    ("import image_processing", ["-c", "import image_processing"], ["cv2", "tensorflow"]),
+    ("import predict", ["-c", "import predict"], ["tensorflow"]),
+    ("import tensorflow", ["-c", "import tensorflow"], []),
+]
+
+def imported_modules(args: list, cwd: str, env: dict) -> set:
+    """
+    Find the top-level modules a command imports.
+
+    Args:
+        args (list): Arguments to the interpreter.
+        cwd (str): The working directory.
+        env (dict): The environment.
+
+    Returns:
+        set: Module names, from the interpreter's `-X importtime` report.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=cwd, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    return {
+        line.rsplit("|", 1)[1].strip().split(".")[0]
+        for line in result.stderr.splitlines() if line.startswith("import time:") and "|" in line
+    }
+
+def time_command(args: list, cwd: str, env: dict, repeats: int):
+    """
+    Time a command in fresh processes.
+
+    Args:
+        args (list): Arguments to the interpreter.
+        cwd (str): The working directory.
+        env (dict): The environment.
+        repeats (int): Runs to time.
+
+    Returns:
+        numpy.ndarray: Seconds per run, None if the command failed.
+    """
+    seconds = list()
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, *args], cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+
+        if result.returncode != 0:
+            return None
+
+    return np.array(seconds)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=10, help="Runs timed per command")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="deer-startup-")
+    env = dict(
+        os.environ,
+        PYTHONPATH=REPO_DIR,
+        IMAGES_DB="images.db",
+        IMAGES_JSON="images.json",
+        IMAGE_PROCESSED_DIR="processed-images",
+    )
+
+    eager = list()
+
+    try:
+        print(f'{"command":<34} {"median":>9} {"min":>9}')
+
+        for name, probe, deferred in PROBES:
+            if deferred:
+                loaded = sorted(set(deferred) & imported_modules(probe, workdir, env))
+                if loaded:
+                    eager.append(f'{name} imports {", ".join(loaded)}')
+
+            seconds = time_command(probe, workdir, env, args.repeats)
+
+            if seconds is None:
+                print(f'{name:<34} {"failed":>9}')
+            else:
+                print(f'{name:<34} {np.median(seconds) * 1000:>7.0f}ms {seconds.min() * 1000:>7.0f}ms')
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for message in eager:
+        print(f"Not deferred: {message}")
+
+    if eager:
+        sys.exit(1)
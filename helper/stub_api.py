@@ -0,0 +1,265 @@
+"""
+Local stub of the stealthcamcommand.com file-manager API for testing the collector
+
+Serves paginated image metadata and synthetic JPEGs:
+- POST /api/v3/file-manager/images/count
+- POST /api/v4/file-manager/images
+- GET /files/<fullFilename>
+
+Throttling can be injected to exercise the collector's adaptive concurrency: requests beyond
+`--capacity` concurrent ones and a random `--error-rate` share are answered with 429 and 503
+and a Retry-After, and `--latency-ms` adds service time to every request.
+
+Usage:
+    python helper/stub_api.py --images 1000 --port 8000
+    python helper/stub_api.py --images 1000 --capacity 8 --error-rate 0.02 --latency-ms 50
+    API_URL=http://127.0.0.1:8000 API_BEARER=test python image_collection.py
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import time
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+MOON_PHASES = ["New Moon", "Waxing Crescent", "First Quarter", "Waxing Gibbous",
+               "Full Moon", "Waning Gibbous", "Last Quarter", "Waning Crescent"]
+PRESSURE_TENDENCIES = ["Rising", "Falling", "Steady"]
+START_TIME = datetime(2024, 11, 1, tzinfo=timezone.utc)
+
+def synthetic_jpegs(width, height, variants=8):
+    """
+    Encode a handful of noisy gradient JPEGs to serve as camera images.
+
+    Args:
+        width (int): Width of each image in pixels.
+        height (int): Height of each image in pixels.
+        variants (int): How many distinct images to generate.
+
+    Returns:
+        list[bytes]: The encoded JPEGs.
+    """
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 200, width, dtype=np.float32)[None, :, None]
+
+    jpegs = list()
+    for _ in range(variants):
+        noise = rng.normal(0, 25, (height, width, 3)).astype(np.float32)
+        img = np.clip(gradient + noise + rng.integers(0, 55), 0, 255).astype(np.uint8)
+        jpegs.append(cv2.imencode(".jpg", img)[1].tobytes())
+
+    return jpegs
+
+def burst_jpeg(index, width, height, burst=3):
+    """
+    Encode the camera image at `index`, where each trigger burst of `burst` images repeats the same
+    scene, so duplicate removal has realistic work to do.
+
+    Args:
+        index (int): The position of the image in the listing.
+        width (int): Width of the image in pixels.
+        height (int): Height of the image in pixels.
+        burst (int): Images per burst.
+
+    Returns:
+        bytes: The encoded JPEG.
+    """
+    return scene_jpeg(index // burst, width, height)
+
+@functools.lru_cache(maxsize=256)
+def scene_jpeg(scene, width, height):
+    """Encode one burst's scene, cached since every image of the burst is the same."""
+    scene = np.random.default_rng(scene).uniform(0, 255, (12, 12, 3)).astype(np.float32)
+    img = cv2.resize(scene, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    return cv2.imencode(".jpg", img.astype(np.uint8))[1].tobytes()
+
+def image_record(index, base_url):
+    """
+    Build the API record for the image at `index`, newest first.
+
+    Args:
+        index (int): The position of the image in the listing.
+        base_url (str): The URL the stub is reachable at.
+
+    Returns:
+        dict: A record shaped like the real `/api/v4/file-manager/images` entries.
+    """
+    filename = f'STC_{index:07d}'
+    created = START_TIME - timedelta(seconds=37 * index)
+
+    return {
+        "filename": filename,
+        "fullFilename": f'{filename}.JPG',
+        "imageUrl": f'{base_url}/files/{filename}.JPG',
+        "createdDateTime": created.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "imageGuid": f'00000000-0000-4000-8000-{index:012d}',
+        "imageTags": [{"name": "Deer"}] if index % 3 == 0 else [],
+        "moonPhase": MOON_PHASES[index % len(MOON_PHASES)],
+        "pressure": round(29.5 + (index % 17) * 0.05, 2),
+        "pressureTendency": PRESSURE_TENDENCIES[index % len(PRESSURE_TENDENCIES)],
+        "temperature": 20 + index % 40,
+        "wind": index % 15,
+        "windDirection": (index * 45) % 360,
+        "cameraId": f'CAM{index % 4}',
+    }
+
+def make_handler(image_total, jpegs, bursts=None, throttle=None):
+    """
+    Create a request handler class serving `image_total` images.
+
+    Args:
+        image_total (int): The number of images the stub reports.
+        jpegs (list[bytes]): The JPEG payloads served for downloads.
+        bursts (tuple): Optional (width, height) to serve a distinct scene per burst from
+            `burst_jpeg` instead of cycling through `jpegs`.
+        throttle (dict): Optional throttling to inject.
+            - 'capacity': Concurrent requests served, the rest get a 429
+            - 'errorRate': Share of requests answered with a 503
+            - 'retryAfter': Seconds sent in the Retry-After of throttled requests
+            - 'latency': Seconds added to every request
+
+    Returns:
+        type: A `BaseHTTPRequestHandler` subclass.
+    """
+    throttle = throttle or {}
+    active = [0]
+    active_lock = threading.Lock()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        # HTTP/1.1 so clients can keep connections alive
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, body, content_type, headers=None):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def serve(self, handle):
+            # Count the request as active while it is served, throttling it when injected
+            body = self.read_json()
+
+            with active_lock:
+                active[0] += 1
+                status = 429 if throttle.get("capacity") and active[0] > throttle["capacity"] else None
+
+            try:
+                if status is None and random.random() < throttle.get("errorRate", 0):
+                    status = 503
+
+                if status is None:
+                    time.sleep(throttle.get("latency", 0))
+                    handle(body)
+                    return
+
+                self.send_response(status)
+                self.send_header("Retry-After", f'{throttle.get("retryAfter", 1):g}')
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            finally:
+                with active_lock:
+                    active[0] -= 1
+
+        def do_POST(self):
+            self.serve(self.post)
+
+        def do_GET(self):
+            self.serve(self.get)
+
+        def post(self, body):
+            base_url = f'http://{self.headers.get("Host")}'
+
+            if self.path == "/api/v3/file-manager/images/count":
+                self.send_body(json.dumps(image_total).encode(), "application/json")
+
+            elif self.path == "/api/v4/file-manager/images":
+                skip = int(body.get("skipcount", 0))
+                take = int(body.get("takeCount", 50))
+                images = [image_record(i, base_url) for i in range(skip, min(skip + take, image_total))]
+                self.send_body(json.dumps({"images": images}).encode(), "application/json")
+
+            else:
+                self.send_error(404)
+
+        def get(self, body):
+            if not self.path.startswith("/files/"):
+                self.send_error(404)
+                return
+
+            index = int(self.path.rsplit("_", 1)[-1].split(".")[0])
+            jpeg = burst_jpeg(index, *bursts) if bursts else jpegs[index % len(jpegs)]
+
+            # Single-part S3 objects use the MD5 as their ETag
+            self.send_body(jpeg, "image/jpeg", {"ETag": f'"{hashlib.md5(jpeg).hexdigest()}"'})
+
+    return StubHandler
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is expected, not worth a traceback
+        pass
+
+def start_stub_server(image_total, port=0, width=1280, height=720, bursts=False, throttle=None):
+    """
+    Start the stub API on a background thread.
+
+    Args:
+        image_total (int): The number of images the stub reports.
+        port (int): The port to listen on, 0 picks a free one.
+        width (int): Width of the served images.
+        height (int): Height of the served images.
+        bursts (bool): Serve a distinct scene per burst of images instead of a few repeating ones.
+        throttle (dict): Optional throttling to inject, see `make_handler`.
+
+    Returns:
+        ThreadingHTTPServer: The running server, stop it with `shutdown()`.
+    """
+    jpegs = [] if bursts else synthetic_jpegs(width, height)
+    server = StubServer(("127.0.0.1", port), make_handler(image_total, jpegs, (width, height) if bursts else None, throttle))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=1000, help="Number of images to serve")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--bursts", action="store_true", help="Serve a distinct scene per burst of 3 images")
+    parser.add_argument("--capacity", type=int, help="Concurrent requests served before answering 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds of throttled requests")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Service time added to every request")
+    args = parser.parse_args()
+
+    throttle = {"capacity": args.capacity, "errorRate": args.error_rate, "retryAfter": args.retry_after, "latency": args.latency_ms / 1000}
+    server = start_stub_server(args.images, args.port, args.width, args.height, args.bursts, throttle)
+    print(f'Serving {args.images} images on http://127.0.0.1:{server.server_address[1]}')
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
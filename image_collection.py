@@ -4,9 +4,23 @@ Get all images from stealthcamcommand.com for training
 
 import requests 
 import json
+import io
 import os 
+import re
+import time
+import base64
+import random
+import hashlib
+import queue
+import threading
 import dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import metadata_store
+import image_store
+import metrics
+import rate_limit
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 
 dotenv.load_dotenv()
 
@@ -16,11 +30,22 @@ API_BEARER = os.getenv("API_BEARER")
 
 # Defaults to checking if None
 IMAGE_TOTAL = os.getenv("IMAGE_TOTAL", None)
+IMAGE_TOTAL = int(IMAGE_TOTAL) if IMAGE_TOTAL not in (None, "", "None") else None
 
 # Default values
 TAKE_AMOUNT = int(os.getenv("TAKE_AMOUNT") or 50)
-IMAGE_DIR = os.path.join(os.getcwd(), "images")
-IMAGE_JSON = os.path.join(os.getcwd(), "images.json")
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT") or 5)
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY") or 32)
+REQUEUE_LIMIT = int(os.getenv("REQUEUE_LIMIT") or 3)
+PAGE_PREFETCH = int(os.getenv("PAGE_PREFETCH") or 2)
+PROCESS_ON_DOWNLOAD = os.getenv("PROCESS_ON_DOWNLOAD", "false").lower() == "true"
+KEEP_RAW = os.getenv("KEEP_RAW", "true").lower() == "true"
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES") or 3)
+DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF") or 1.0)
+DOWNLOAD_CHUNK = 64 * 1024
+REQUEST_TIMEOUT = 30
+CAMERA_FIELD = os.getenv("CAMERA_FIELD", "cameraId")
+IMAGE_DIR = image_store.IMAGE_DIR
 
 post_headers = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36",
@@ -30,6 +55,30 @@ post_headers = {
 
 }
 
+def build_session(pool_size):
+    """
+    Create a requests session that keeps connections alive between calls.
+
+    Auth headers are deliberately not attached to the session since image URLs are
+    pre-signed and reject an extra Authorization header.
+
+    Args:
+        pool_size (int): The maximum number of pooled connections per host.
+
+    Returns:
+        requests.Session: A session with a connection pool sized for `pool_size` concurrent requests.
+    """
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    new_session = requests.Session()
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+
+    return new_session
+
+# Shared across threads so page fetches and downloads reuse connections
+session = build_session(MAX_CONCURRENCY + 1)
+
 def preflight_checks(): 
     """
     Perform preflight checks to validate the environment variables and ensure necessary directories exist.
@@ -56,12 +105,16 @@ def preflight_checks():
 
     print("Conditions met")
 
-def get_image_count(): 
+def get_image_count(api_url=None, headers=None): 
     """
     Fetch the total number of images available from the API.
 
     Sends a request to the API to retrieve the image count.
 
+    Args:
+        api_url (str): The account's API, API_URL if not given.
+        headers (dict): Headers with the account's token, the API_BEARER headers if not given.
+
     Returns:
         int: The total number of images available in the system.
 
@@ -70,10 +123,10 @@ def get_image_count():
     """
     print("Requesting image count...")
 
-    post_url = f'{API_URL}/api/v3/file-manager/images/count'
+    post_url = f'{api_url or API_URL}/api/v3/file-manager/images/count'
     post_body = json.dumps({"skipcount": 0})
 
-    res = requests.post(post_url, headers=post_headers, data=post_body)
+    res = session.post(post_url, headers=headers or post_headers, data=post_body)
     res.raise_for_status()
 
     image_count = res.json()
@@ -82,13 +135,15 @@ def get_image_count():
 
     return image_count
 
-def get_image_range(skip, take): 
+def get_image_range(skip, take, api_url=None, headers=None): 
     """
     Fetch a range of image data from the API starting at the specified skip value.
 
     Args:
         skip (int): The starting index (offset) for fetching the images.
         take (int): The amount of images to take when fetching the images.
+        api_url (str): The account's API, API_URL if not given.
+        headers (dict): Headers with the account's token, the API_BEARER headers if not given.
 
     Returns:
         dict: A dictionary where each key is an image GUID, and the value is another dictionary with details about the image.
@@ -103,21 +158,25 @@ def get_image_range(skip, take):
             - 'temperature': Temperature recorded during image capture
             - 'wind': Wind speed recorded
             - 'windDirection': Wind direction recorded as an integer (degrees)
+            - CAMERA_FIELD: The camera that took the image
 
     Raises:
         HTTPError: If the request to the API fails.
     """
-    print(f'Requesting image range {skip}...')
+    metrics.debug(f'Requesting image range {skip}...')
 
-    post_url = f'{API_URL}/api/v4/file-manager/images'
+    post_url = f'{api_url or API_URL}/api/v4/file-manager/images'
     post_body = json.dumps({"skipcount": skip, "takeCount": take})
 
-    res = requests.post(post_url, headers=post_headers, data=post_body)
-    res.raise_for_status()
+    with metrics.timer("api_page_seconds"), rate_limit.limiter_for(post_url).request():
+        res = session.post(post_url, headers=headers or post_headers, data=post_body, timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
 
-    image_res = res.json()
+        image_res = res.json()
 
-    print(f'Found {len(image_res.get("images"))} images for {skip}')
+    metrics.inc("api_pages_total")
+    metrics.inc("api_images_listed_total", len(image_res.get("images")))
+    metrics.debug(f'Found {len(image_res.get("images"))} images for {skip}')
 
     image_dict = dict() 
     for image in image_res.get("images"): 
@@ -133,38 +192,268 @@ def get_image_range(skip, take):
             "temperature": image.get("temperature"),
             "wind": image.get("wind"),
             "windDirection": image.get("windDirection"), 
+            CAMERA_FIELD: image.get(CAMERA_FIELD),
 
         }
 
     return image_dict
 
+def download_to(url, f):
+    """
+    Stream an image from the URL into an open file, verifying it arrived complete.
+
+    The body is written in DOWNLOAD_CHUNK sized pieces so memory stays flat no matter the
+    image size. The byte count is checked against Content-Length and, when the server sends
+    one, the MD5 against Content-MD5 or a single-part S3 ETag. The request holds a slot of
+    the host's adaptive concurrency limit until the body is read.
+
+    Args:
+        url (str): The URL from which the image will be downloaded.
+        f (file): A binary file object to write the image to.
+
+    Raises:
+        HTTPError: If the request fails.
+        IOError: If the body is truncated or fails the checksum.
+    """
+    with rate_limit.limiter_for(url).request(), session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as res:
+        res.raise_for_status()
+
+        digest = hashlib.md5()
+        size = 0
+
+        for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK):
+            f.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+
+        expected_size = res.headers.get("Content-Length")
+        if expected_size and not res.headers.get("Content-Encoding") and size != int(expected_size):
+            raise IOError(f'Truncated download, got {size} of {expected_size} bytes')
+
+        expected_md5 = None
+        if res.headers.get("Content-MD5"):
+            expected_md5 = base64.b64decode(res.headers["Content-MD5"]).hex()
+
+        elif re.fullmatch(r'"?[0-9a-f]{32}"?', res.headers.get("ETag", "")):
+            expected_md5 = res.headers["ETag"].strip('"')
+
+        if expected_md5 and digest.hexdigest() != expected_md5:
+            raise IOError(f'Checksum mismatch, got {digest.hexdigest()} expected {expected_md5}')
+
+        metrics.inc("download_bytes_total", size)
+
+def with_retries(attempt, fullFilename):
+    """
+    Call `attempt` until it succeeds, retrying up to DOWNLOAD_RETRIES times with exponential backoff,
+    or after the host's Retry-After when it sent one.
+
+    Args:
+        attempt (callable): Performs one download attempt and returns its result.
+        fullFilename (str): The name of the image, used for reporting.
+
+    Returns:
+        The result of the first successful attempt.
+
+    Raises:
+        Exception: The last error if every attempt failed or the error isn't retryable.
+    """
+    for retry in range(DOWNLOAD_RETRIES + 1):
+        try:
+            return attempt()
+
+        except (requests.RequestException, IOError) as e:
+            # Client errors such as an expired URL won't succeed on retry
+            response = getattr(e, "response", None)
+            retryable = rate_limit.is_throttle(getattr(response, "status_code", None))
+
+            if retry == DOWNLOAD_RETRIES or not retryable:
+                print(f'Failed to download image: {e}')
+                metrics.inc("download_failures_total")
+                raise
+
+            metrics.inc("download_retries_total")
+            backoff = rate_limit.retry_after(response)
+            if backoff is None:
+                backoff = DOWNLOAD_BACKOFF * 2 ** retry * random.uniform(0.5, 1.5)
+            print(f'Retrying {fullFilename} in {backoff:.1f}s: {e}')
+            time.sleep(backoff)
+
 def get_image(url, fullFilename):
     """
-    Download an image from the provided URL and save it to the IMAGE_DIR directory.
+    Download an image from the provided URL and save it to the image store.
+
+    The image is streamed to a temporary file and only moved into the store once verified,
+    so a stored image is always a complete download. Content that is already stored under
+    another name is not stored twice. Failed attempts are retried up to DOWNLOAD_RETRIES
+    times with exponential backoff.
+
+    Args:
+        url (str): The URL from which the image will be downloaded.
+        fullFilename (str): The name of the image, used for the temporary file and reporting.
+
+    Returns:
+        tuple: (key, size) of the stored image, see `image_store.store_raw_file`.
+
+    Raises:
+        Exception: The last error if every attempt failed.
+    """
+    metrics.debug(f'Getting image {fullFilename}...')
+    # Unique per writer, workers of `work_queue.py` may download the same name at once
+    tmp_path = os.path.join(IMAGE_DIR, f'{fullFilename}.{os.getpid()}-{threading.get_ident()}.part')
+
+    def attempt():
+        try:
+            with open(tmp_path, 'wb') as f:
+                download_to(url, f)
+
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        # Atomic, the image either exists complete or not at all
+        return image_store.store_raw_file(tmp_path)
+
+    with metrics.timer("download_seconds"):
+        key, size = with_retries(attempt, fullFilename)
+
+    metrics.inc("downloads_total")
+    metrics.debug(f'Image {fullFilename} saved as {key}')
+
+    return key, size
+
+def fetch_image(url, fullFilename):
+    """
+    Download an image from the provided URL into memory, with the same verification and retries as `get_image`.
 
     Args:
         url (str): The URL from which the image will be downloaded.
-        fullFilename (str): The name with which the image will be saved in the local directory.
+        fullFilename (str): The name of the image, used for reporting.
+
+    Returns:
+        bytes: The encoded image.
+
+    Raises:
+        Exception: The last error if every attempt failed.
+    """
+    metrics.debug(f'Getting image {fullFilename}...')
+
+    def attempt():
+        buffer = io.BytesIO()
+        download_to(url, buffer)
+        return buffer.getvalue()
+
+    with metrics.timer("download_seconds"):
+        data = with_retries(attempt, fullFilename)
+
+    metrics.inc("downloads_total")
+    return data
+
+def load_sync_state(conn):
     """
-    print(f'Getting image {fullFilename}...')
-    file_path = os.path.join(IMAGE_DIR, fullFilename)
+    Load the sync checkpoint left by a previous run.
 
-    if os.path.exists(file_path):
-        print(f'Image {fullFilename} already exists, skipping')
-        return
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+
+    Returns:
+        dict: The sync state.
+            - 'skip': Offset of the first page not yet committed by the current run
+            - 'newest': createdDateTime/imageGuid of the newest image from the last completed run
+            - 'runNewest': createdDateTime/imageGuid of the newest image seen by the current run
+            - 'runFailed': Whether an image of the current run failed to download
+    """
+    state = {"skip": 0, "newest": None, "runNewest": None, "runFailed": False}
+    state.update(metadata_store.get_state(conn, "sync", {}))
+
+    return state
+
+def image_key(image):
+    """
+    Order images by capture time, breaking ties on GUID.
+
+    Args:
+        image (dict): An image record with 'createdDateTime' and 'imageGuid'.
+
+    Returns:
+        tuple: A sortable (datetime, guid) key.
+    """
+    created = datetime.fromisoformat(image.get("createdDateTime").replace("Z", "+00:00"))
+    return created, image.get("imageGuid") or ""
+
+def fetch_pages(skip, take, image_total, newest, pages, stop):
+    """
+    Fetch image pages ahead of the downloads and put them on the `pages` queue.
+
+    Runs on its own thread so the next page is already waiting when the downloads of the
+    current one finish. The queue is bounded, which keeps this at most PAGE_PREFETCH pages
+    ahead. A `None` is put on the queue once every page has been fetched or on failure.
+
+    The API lists images newest first, so once a page reaches the `newest` image of the last
+    completed sync everything after it is already known and fetching stops.
+
+    A page that fails with a throttling or server error is requested again, after the host's
+    Retry-After or an exponential backoff, up to REQUEUE_LIMIT times in a row.
+
+    Args:
+        skip (int): The offset to start fetching from.
+        take (int): The amount of images per page.
+        image_total (int): The total number of images to fetch.
+        newest (dict): createdDateTime/imageGuid of the last synced image, None for a full crawl.
+        pages (queue.Queue): Receives (skip, take, images) for each page.
+        stop (threading.Event): Set by the consumer to stop fetching early.
+    """
+    newest_key = image_key(newest) if newest else None
+    requeues = 0
 
     try:
-        res = requests.get(url, stream=True)
-        res.raise_for_status()
-        
-        # Save image to the original directory
-        with open(file_path, 'wb') as f:
-            f.write(res.content)
+        while skip < image_total and not stop.is_set():
+            take = min(take, image_total - skip)
+
+            metrics.debug(f'Getting images {skip}/{image_total}...')
+
+            try:
+                res_images = get_image_range(skip, take)
+
+            except requests.RequestException as e:
+                response = getattr(e, "response", None)
+                if requeues >= REQUEUE_LIMIT or not rate_limit.is_throttle(getattr(response, "status_code", None)):
+                    raise
+
+                backoff = rate_limit.retry_after(response)
+                if backoff is None:
+                    backoff = DOWNLOAD_BACKOFF * 2 ** requeues * random.uniform(0.5, 1.5)
+
+                requeues += 1
+                metrics.inc("pages_requeued_total")
+                print(f'Requeued image range {skip}, retrying in {backoff:.1f}s: {e}')
+                stop.wait(backoff)
+                continue
+
+            requeues = 0
+
+            if newest_key is not None:
+                new_images = {
+                    k: v for k, v in res_images.items()
+                    if v.get("imageGuid") != newest.get("imageGuid") and image_key(v) >= newest_key
+                }
+
+                pages.put((skip, take, new_images))
 
-        print(f'Image {fullFilename} saved')
+                if len(new_images) < len(res_images):
+                    print(f'Reached last synced image at {skip}')
+                    break
+
+            else:
+                pages.put((skip, take, res_images))
+
+            skip += take
 
     except Exception as e:
-        print(f'Failed to download image: {e}')
+        print(f'Failed to fetch image range {skip}: {e}')
+        pages.put(e)
+
+    finally:
+        pages.put(None)
 
 def build_images(): 
     """
@@ -173,64 +462,290 @@ def build_images():
     This function performs the following steps:
     - Verifies that all required conditions (e.g., environment variables and directories) are met.
     - Retrieves the total number of images available from the API.
-    - Iteratively fetches batches of images and downloads them concurrently to the local 'images' directory.
-    - Continues fetching images until all available images have been downloaded.
+    - Fetches pages of image data on a background thread, up to PAGE_PREFETCH pages ahead.
+    - Downloads images from every page on one shared pool, reusing keep-alive connections. Requests
+      in flight per host start at MAX_IN_FLIGHT and adapt to the host's latency and throttling,
+      see `rate_limit`. A download that still fails with a retryable error after its retries
+      goes back into the queue, up to REQUEUE_LIMIT times, instead of failing its page.
+    - Stores each image once per distinct content in the sharded image store, see `image_store`.
+    - Commits each page's metadata, its entries in the image store's index and the sync checkpoint
+      to the metadata store in one transaction once all of its downloads finish, so an interrupted
+      run resumes from the last committed page.
+    - After a completed sync, later runs only fetch images newer than the last one seen.
+
+    With PROCESS_ON_DOWNLOAD set, each image is downloaded into memory and handed to the
+    processing stage through a bounded queue instead of being written to IMAGE_DIR (unless
+    KEEP_RAW), and its cleaned metadata record is committed once the processed image is saved.
+    Content already processed at IMAGE_SIZE, by an earlier run or under another name, is not
+    processed again. Images whose content is being processed for another name wait for it, and
+    fail with it.
 
     Raises:
         ValueError: If the preflight checks fail (e.g., missing environment variables).
-        HTTPError: If any API request fails.
+        HTTPError: If a page request fails with a client error, or keeps failing after REQUEUE_LIMIT requeues.
     """
     preflight_checks()
 
-    skip = 0
-    take = TAKE_AMOUNT
     image_total = IMAGE_TOTAL
 
-    all_images = dict() 
-
     # Set default amount of images to get if not set
     if not image_total:
         image_total = get_image_count()
 
-    while True:         
-        if (skip + take) > image_total:
-            take = image_total - skip
+    conn = metadata_store.connect()
+    state = load_sync_state(conn)
+
+    # Images already handed out this run, in case shifting offsets repeat one across pages
+    seen = set()
+
+    if state["skip"]:
+        print(f'Resuming sync from {state["skip"]}/{image_total}')
+
+    if state["newest"]:
+        print(f'Syncing images newer than {state["newest"]["createdDateTime"]}')
+
+    pages = queue.Queue(maxsize=max(PAGE_PREFETCH, 1))
+    stop = threading.Event()
+    fetcher = threading.Thread(
+        target=fetch_pages, args=(state["skip"], TAKE_AMOUNT, image_total, state["newest"], pages, stop), daemon=True
+    )
+
+    # Bounds queued + running downloads so a fast page fetcher can't pile up futures
+    in_flight = threading.BoundedSemaphore(MAX_CONCURRENCY * 2)
+    counts = {"done": 0, "failed": 0}
+
+    # Sized for the largest adaptive limit, the limiter decides how many threads actually download
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+
+    # Pages commit strictly in order once all of their downloads have finished
+    pending = dict()
+    uncommitted = list()
+    failed_images = set()
+    stored = dict()
+    commit_lock = threading.Lock()
+    committed = threading.Condition(commit_lock)
+
+    def commit_pages():
+        while uncommitted and pending[uncommitted[0][0]] == 0:
+            skip, take, res_images = uncommitted.pop(0)
+            del pending[skip]
+
+            # Failed images stay out of the store, so the next run doesn't take them for known and fetches them again
+            if any(k in failed_images for k in res_images):
+                res_images = {k: v for k, v in res_images.items() if k not in failed_images}
+                state["runFailed"] = True
+
+            files = {stored[k][0]: stored.pop(k)[1] for k in res_images if k in stored}
+
+            run_newest = max(res_images.values(), key=image_key, default=None)
+            if run_newest and (not state["runNewest"] or image_key(run_newest) > image_key(state["runNewest"])):
+                state["runNewest"] = {k: run_newest.get(k) for k in ("createdDateTime", "imageGuid")}
+
+            state["skip"] = skip + take
+
+            # Metadata and checkpoint commit together, a crash can't separate them
+            with metrics.timer("store_commit_seconds"), conn:
+                metadata_store.add_images(conn, res_images)
+                image_store.index_files(conn, files)
+                if PROCESS_ON_DOWNLOAD:
+                    image_store.set_processed(conn, [key for key, _, _ in files.values() if key in done_keys], image_processing.SIZE_TAG)
+                metadata_store.set_state(conn, "sync", state)
+
+            metrics.inc("pages_committed_total")
+
+    def finish(skip, filename, failed):
+        with commit_lock:
+            counts["failed" if failed else "done"] += 1
+            if failed:
+                failed_images.add(filename)
 
-        print(f'Getting images {skip}/{image_total}...')
+            pending[skip] -= 1
+            commit_pages()
+            committed.notify_all()
 
-        res_images = get_image_range(skip, take)
-        print(f'Received {len(res_images)}. Saving...')
+    if PROCESS_ON_DOWNLOAD:
+        import image_processing
+        image_processing.preflight_checks()
 
-        all_images.update(res_images) 
+        # Bounded so downloads wait on processing instead of holding every image in memory
+        to_process = queue.Queue(maxsize=MAX_IN_FLIGHT * 2)
 
-        # Use ThreadPoolExecutor for concurrent downloads
-        with ThreadPoolExecutor(max_workers=5) as executor:  # Adjust `max_workers` as needed
-            future_to_image = {
-                executor.submit(get_image, image.get("imageUrl"), image.get("fullFilename")): image
-                for image in res_images.values()
-            }
+        # Content processed at IMAGE_SIZE, content handed to a processor, and the images of
+        # the same content waiting on it, by key
+        done_keys = image_store.processed_keys(conn, image_processing.SIZE_TAG)
+        claimed = set(done_keys)
+        waiting = dict()
+
+        def process_worker():
+            while (item := to_process.get()) is not None:
+                skip, filename, image, key = item[:4]
 
-            for future in as_completed(future_to_image):
-                image = future_to_image[future]
                 try:
-                    future.result()  # Raises exception if download failed
-                    print(f"Saved image: {image.get('fullFilename')}")
+                    with metrics.timer("process_seconds"):
+                        image_processing.process_image_bytes(item[4], image_store.processed_path(key))
+                    metrics.inc("images_processed_total")
+                    failed = False
+
                 except Exception as e:
-                    print(f"Failed to save image {image.get('fullFilename')}: {e}")
+                    print(f"Failed to process image {image.get('fullFilename')}: {e}")
+                    metrics.inc("process_failures_total")
+                    failed = True
+
+                # A failed key is free for the next download of its content to claim
+                with commit_lock:
+                    if failed:
+                        claimed.discard(key)
+                    else:
+                        done_keys.add(key)
+                    waiters = waiting.pop(key, [])
+
+                finish(skip, filename, failed)
+                for waiter in waiters:
+                    finish(*waiter, failed)
+
+        metrics.track("process_queue_depth", to_process.qsize)
+
+        processors = [threading.Thread(target=process_worker, daemon=True) for _ in range(os.cpu_count() or 1)]
+        for processor in processors:
+            processor.start()
+
+    def submit(skip, filename, image, requeues=0):
+        in_flight.acquire()
+
+        try:
+            executor.submit(download, skip, filename, image, requeues)
+        except RuntimeError:
+            # The run was stopped before a requeued download came due
+            in_flight.release()
+            finish(skip, filename, True)
+
+    def download(skip, filename, image, requeues=0):
+        metrics.add_gauge("downloads_active", 1)
+
+        try:
+            if not PROCESS_ON_DOWNLOAD:
+                key, size = get_image(image.get("imageUrl"), image.get("fullFilename"))
+                stored[filename] = (image.get("fullFilename"), (key, image.get("imageGuid"), size))
+
+            else:
+                data = fetch_image(image.get("imageUrl"), image.get("fullFilename"))
+                key = image_store.store_raw(data) if KEEP_RAW else image_store.content_key(data)
+
+                with commit_lock:
+                    stored[filename] = (image.get("fullFilename"), (key, image.get("imageGuid"), len(data)))
+                    new = key not in claimed
+                    claimed.add(key)
+
+                    # Its page commits with the claimer's result, as processed or failed
+                    wait = not new and key not in done_keys
+                    if wait:
+                        waiting.setdefault(key, []).append((skip, filename))
+
+                if new:
+                    to_process.put((skip, filename, image, key, data))
+                    return
+
+                if wait:
+                    return
+
+                metrics.debug(f'Image {image.get("fullFilename")} already processed as {key}, skipping')
+                metrics.inc("downloads_skipped_total")
+
+            failed = False
+
+        except Exception as e:
+            response = getattr(e, "response", None)
+
+            if requeues < REQUEUE_LIMIT and rate_limit.is_throttle(getattr(response, "status_code", None)):
+                # Back into the queue once the host has had time to recover, the page stays pending
+                backoff = rate_limit.retry_after(response)
+                if backoff is None:
+                    backoff = DOWNLOAD_BACKOFF * 2 ** (DOWNLOAD_RETRIES + requeues) * random.uniform(0.5, 1.5)
+
+                metrics.inc("downloads_requeued_total")
+                print(f"Requeued image {image.get('fullFilename')}, retrying in {backoff:.1f}s: {e}")
+                threading.Timer(backoff, submit, args=(skip, filename, image, requeues + 1)).start()
+                return
+
+            print(f"Failed to save image {image.get('fullFilename')}: {e}")
+            failed = True
+
+        finally:
+            metrics.add_gauge("downloads_active", -1)
+            in_flight.release()
+
+        finish(skip, filename, failed)
+
+    # Share of the download workers busy is downloads_active / download_workers
+    metrics.set_gauge("download_workers", MAX_CONCURRENCY)
+    metrics.track("page_queue_depth", pages.qsize)
+    stop_reporter = metrics.start_reporter("collect")
+
+    start = time.perf_counter()
+    fetcher.start()
+
+    try:
+        while (page := pages.get()) is not None:
+            if isinstance(page, Exception):
+                raise page
+
+            skip, take, res_images = page
+
+            with commit_lock:
+                known = metadata_store.known_filenames(conn, res_images) | seen
+                res_images = {k: v for k, v in res_images.items() if k not in known}
+                seen.update(res_images)
+
+                metrics.debug(f'Received {len(res_images)} new. Saving...')
+
+                pending[skip] = len(res_images)
+                uncommitted.append((skip, take, res_images))
+                commit_pages()
+
+            for filename, image in res_images.items():
+                submit(skip, filename, image)
+
+            elapsed = time.perf_counter() - start
+            metrics.debug(f'Saved {counts["done"]} images ({counts["done"] / elapsed:.1f} images/sec)')
+
+        # Requeued downloads are submitted later, wait for every page to commit before closing the pool
+        with committed:
+            committed.wait_for(lambda: not uncommitted)
+
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+        if PROCESS_ON_DOWNLOAD:
+            for _ in processors:
+                to_process.put(None)
+
+            for processor in processors:
+                processor.join()
+
+            metrics.untrack("process_queue_depth")
 
-        print('Saved all images')
+        metrics.untrack("page_queue_depth")
+        stop_reporter()
 
-        skip += take
+    elapsed = time.perf_counter() - start
+    print(f'Saved all images: {counts["done"]} saved, {counts["failed"]} failed in {elapsed:.1f}s '
+          f'({counts["done"] / elapsed:.1f} images/sec)')
 
-        if skip > (image_total - 1): 
-            break
+    # Sync finished, later runs only need images newer than this one. After a failure the
+    # watermark stays put, so the next run pages back over the failed images.
+    if state["runFailed"]:
+        print("Some images failed, keeping the previous sync watermark so the next run retries them")
+        newest = state["newest"]
+    else:
+        newest = state["runNewest"] or state["newest"]
 
-    print(f'Saving image dictionary to JSON...')
+    state = {"skip": 0, "newest": newest, "runNewest": None, "runFailed": False}
 
-    with open(IMAGE_JSON, 'w') as f: 
-        json.dump(all_images, f, indent=6)
+    with conn:
+        metadata_store.set_state(conn, "sync", state)
 
-    print(f'Saved') 
+    print(f'Saved, {metadata_store.count_images(conn)} images in the metadata store') 
 
 if __name__ == "__main__": 
     build_images()
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""
+Incremental near-duplicate removal for processed images
+
+Perceptual hashes are kept in the image store's index so only new images are hashed, and
+duplicates are found through a BK-tree over Hamming distance instead of comparing every pair.
+"""
+
+import os
+import contextlib
+import cv2
+import numpy as np
+import image_store
+import metadata_store
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+
+# Largest Hamming distance between 64 bit hashes still treated as the same image
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE") or 4)
+
+def phash(file_path: str) -> int:
+    """
+    Compute the 64 bit DCT perceptual hash of an image.
+
+    The image is reduced to 32x32 grayscale, and each of the 8x8 lowest frequency DCT
+    coefficients becomes one bit, set when it is above their median.
+
+    Args:
+        file_path (str): The full path to the image file.
+
+    Returns:
+        int: The hash.
+
+    Raises:
+        ValueError: If the image could not be read.
+    """
+    img = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError("Image file could not be read.")
+
+    small = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    bits = low > np.median(low)
+
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+class BKTree:
+    """
+    Metric tree over Hamming distance answering "everything within d of h" without a full scan.
+
+    Each child edge is labelled with its distance to the parent, so by the triangle inequality
+    a query only descends edges within `max_distance` of the query's distance to the parent.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value: int, name: str) -> None:
+        """
+        Insert a hash.
+
+        Args:
+            value (int): The hash.
+            name (str): The image the hash belongs to.
+        """
+        if self.root is None:
+            self.root = (value, name, dict())
+            return
+
+        node = self.root
+        while True:
+            distance = (value ^ node[0]).bit_count()
+            child = node[2].get(distance)
+
+            if child is None:
+                node[2][distance] = (value, name, dict())
+                return
+
+            node = child
+
+    def search(self, value: int, max_distance: int) -> list:
+        """
+        Find every hash within `max_distance` of `value`.
+
+        Args:
+            value (int): The hash to query.
+            max_distance (int): The largest Hamming distance to match.
+
+        Returns:
+            list: (distance, name) tuples for each match.
+        """
+        matches = list()
+        stack = [self.root] if self.root else []
+
+        while stack:
+            node = stack.pop()
+            distance = (value ^ node[0]).bit_count()
+
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+
+        return matches
+
+def remove_duplicates(max_distance: int = DEDUP_MAX_DISTANCE) -> list:
+    """
+    Remove processed images within `max_distance` of an image that is already kept.
+
+    Only images processed since the last run are unchecked, and only those events.py hasn't
+    hashed yet are hashed. Images kept by earlier runs are already unique among themselves, so
+    only the new ones are queried against the tree, in filename order so the earliest frame of
+    a burst is the one kept. Removed images are marked in the index as duplicates, so they
+    aren't processed again.
+
+    Args:
+        max_distance (int): The largest Hamming distance treated as a duplicate.
+
+    Returns:
+        list: (removed, kept) filename pairs.
+    """
+    conn = metadata_store.connect()
+    images = list(image_store.iter_hashes(conn))
+    new_images = [(key, name, value) for key, name, value, deduped in images if not deduped]
+    todo = [(key, name) for key, name, value in new_images if value is None]
+
+    print(f"Hashing {len(todo)} of {len(new_images)} new images...")
+
+    def hash_image(item):
+        # One unreadable image is left unchecked for the next run instead of failing the pass
+        try:
+            with metrics.timer("phash_seconds"):
+                return phash(image_store.processed_path(item[0]))
+        except (ValueError, OSError, cv2.error) as e:
+            print(f"Skipping {item[1]} ({item[0]}): {e}")
+            metrics.inc("dedup_failures_total")
+            return None
+
+    with ThreadPoolExecutor() as executor:
+        computed = dict(zip((key for key, _ in todo), executor.map(hash_image, todo)))
+
+    keys = {name: key for key, name, _, _ in images}
+    tree = BKTree()
+    for key, name, value, deduped in images:
+        if deduped and value is not None:
+            tree.add(int(value, 16), name)
+
+    removed = list()
+    hashes = dict()
+    duplicates = dict()
+    for key, name, value in new_images:
+        value = computed[key] if value is None else int(value, 16)
+        if value is None:
+            continue
+
+        hashes[key] = value
+        matches = tree.search(value, max_distance)
+
+        if matches:
+            kept = min(matches)[1]
+            duplicates[key] = keys[kept]
+            removed.append((name, kept))
+            metrics.debug(f"Removed duplicate: {name} of {kept}")
+            metrics.inc("duplicates_removed_total")
+            continue
+
+        tree.add(value, name)
+
+    with conn:
+        image_store.set_hashes(conn, hashes)
+        image_store.set_deduped(conn, hashes)
+        image_store.set_duplicates(conn, duplicates)
+
+    # Deleted once the index marks them, a file already gone, or left by a crash here, is still a duplicate
+    for key in duplicates:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(image_store.processed_path(key))
+
+    print(f"Removed {len(removed)} duplicates within distance {max_distance}.")
+
+    return removed
+
+if __name__ == "__main__":
+    remove_duplicates()
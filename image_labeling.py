@@ -1,50 +1,261 @@
 import tkinter as tk
 import tkinter.messagebox
 from PIL import Image, ImageTk
+from collections import OrderedDict
+import threading
+import sqlite3
 import json
 import os
+import metadata_store
+import image_store
+import metrics
 
 # Environment variable paths
-IMAGE_JSON = os.getenv("IMAGES_JSON", "images.json")
-IMAGE_PROCESSED_DIR = os.getenv("IMAGE_PROCESSED_DIR", "processed-images")
+LABEL_JOURNAL = os.getenv("LABEL_JOURNAL", "labels.journal")
+THUMBNAIL_DIR = os.getenv("THUMBNAIL_DIR")  # Optional on-disk cache of resized images
 
-def load_json_data():
-    """Load image data from the JSON file."""
-    if os.path.exists(IMAGE_JSON):
+# Seconds between folding the journal into the metadata store
+COMPACT_INTERVAL = 5
+
+# Images decoded ahead of and behind the cursor, and how many decoded images to keep
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD") or 8)
+PREFETCH_BEHIND = 2
+CACHE_SIZE = 4 * PREFETCH_AHEAD
+
+DISPLAY_SIZE = (int(1.5 * 512), int(1.5 * 272))  # Resize to fit the window
+
+journal_lock = threading.Lock()
+compact_lock = threading.Lock()
+
+image_cache = OrderedDict()
+cache_lock = threading.Lock()
+prefetch_ready = threading.Condition()
+prefetch_target = None
+
+def load_metadata():
+    """Load image data from the metadata store and build the navigation index, keeping the frames of each trigger event together."""
+    global image_ids, image_positions, image_events, image_paths, untagged_cursor
+
+    image_paths = image_store.processed_paths(store)
+
+    # Records of duplicates stay in the store for collection, but there is nothing to show
+    data = {
+        image_id: record for image_id, record in metadata_store.iter_images(store)
+        if record.get("fullFilename") in image_paths
+    }
+    print(f"Loaded {len(data)} images from {metadata_store.IMAGES_DB}")
+
+    # Every frame maps to its whole event, images in no event are left out
+    image_events = dict()
+    for frames in metadata_store.load_events(store).values():
+        frames = [image_id for image_id in frames if image_id in data]
+        for image_id in frames:
+            image_events[image_id] = frames
+
+    # Ordered ids plus their positions, so navigation never scans the list
+    image_ids = list()
+    for image_id in data:
+        if image_id not in image_events:
+            image_ids.append(image_id)
+        elif image_events[image_id][0] == image_id:
+            image_ids.extend(image_events[image_id])
+
+    image_positions = {image_id: i for i, image_id in enumerate(image_ids)}
+    untagged_cursor = 0
+
+    return data
+
+def replay_journal(path):
+    """Apply every label in a journal file to the metadata store in one transaction."""
+    if not os.path.exists(path):
+        return 0
+
+    labels = dict()
+    with open(path, 'r') as file:
+        for line in file:
+            # A crash mid-append can only leave the last line truncated
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+
+            labels[entry["id"]] = entry["tags"]
+
+    with store:
+        for image_id, tags in labels.items():
+            try:
+                metadata_store.set_tags(store, image_id, tags)
+            except KeyError:
+                print(f"Skipping label for unknown image {image_id}")
+
+    os.remove(path)
+    return len(labels)
+
+def compact_journal():
+    """Fold the label journal into the metadata store."""
+    global journal
+
+    compacting = f"{LABEL_JOURNAL}.compacting"
+
+    with compact_lock:
+        # Swap in a fresh journal so tagging never waits on the store
+        with journal_lock:
+            if journal.tell() == 0 and not os.path.exists(compacting):
+                return 0
+
+            journal.close()
+
+            # A failed replay leaves its labels behind, the newer ones go after them instead of replacing them
+            if os.path.exists(compacting):
+                with open(LABEL_JOURNAL, 'r') as live, open(compacting, 'a') as pending:
+                    pending.write(live.read())
+                os.remove(LABEL_JOURNAL)
+            else:
+                os.replace(LABEL_JOURNAL, compacting)
+
+            journal = open(LABEL_JOURNAL, 'a')
+
+        with metrics.timer("journal_compact_seconds"):
+            return replay_journal(compacting)
+
+def run_compactor():
+    """Periodically compact the journal on a background thread."""
+    while not compactor_stop.wait(COMPACT_INTERVAL):
         try:
-            with open(IMAGE_JSON, 'r') as file:
-                data = json.load(file)
-                print(f"Loaded JSON data from {IMAGE_JSON}")
-                return data
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON: {e}")
-    else:
-        print(f"JSON file not found: {IMAGE_JSON}")
-    return {}
+            compact_journal()
+        except (IOError, sqlite3.Error) as e:
+            print(f"Error compacting label journal: {e}")
+
+def open_journal():
+    """Recover labels left by an earlier session, then open the journal and start compacting it."""
+    global journal, compactor_stop
+
+    recovered = replay_journal(f"{LABEL_JOURNAL}.compacting") + replay_journal(LABEL_JOURNAL)
+    if recovered:
+        print(f"Recovered {recovered} labels from the journal")
+
+    journal = open(LABEL_JOURNAL, 'a')
+    compactor_stop = threading.Event()
+    threading.Thread(target=run_compactor, daemon=True).start()
 
 def save_tags():
-    """Save the tagged images back to the JSON file."""
+    """Fold the labels journaled so far into the metadata store."""
     try:
-        with open(IMAGE_JSON, 'w') as file:
-            json.dump(image_data, file, indent=4)
-        print("Tags saved successfully.")
+        saved = compact_journal()
+        print(f"Tags saved successfully ({saved} updated).")
         tkinter.messagebox.showinfo("Save Tags", "Tags have been saved successfully.")
-    except IOError as e:
+    except (IOError, sqlite3.Error) as e:
         print(f"Error saving tags: {e}")
         tkinter.messagebox.showerror("Error", f"Could not save tags: {e}")
 
+def close_window(window):
+    """Compact the journal one last time and close the tool."""
+    compactor_stop.set()
+    compact_journal()
+    stop_reporter()
+    window.destroy()
+
+def decode_image(image_id):
+    """Decode and resize an image for display, using the thumbnail cache when enabled."""
+    image_info = image_data.get(image_id, {})
+    image_path = image_paths.get(image_info.get("fullFilename"))
+    if image_path is None:
+        raise FileNotFoundError(f"No processed image for {image_id}")
+
+    if THUMBNAIL_DIR:
+        thumbnail_path = os.path.join(THUMBNAIL_DIR, image_info.get("fullFilename"))
+        if os.path.exists(thumbnail_path) and os.path.getmtime(thumbnail_path) >= os.path.getmtime(image_path):
+            try:
+                with Image.open(thumbnail_path) as img:
+                    return img.convert("RGB")
+            except (IOError, ValueError) as e:
+                print(f"Rebuilding unreadable thumbnail {thumbnail_path}: {e}")
+
+    with metrics.timer("label_decode_seconds"), Image.open(image_path) as img:
+        # Let the JPEG decoder downscale while decoding when the source is larger than the display
+        img.draft("RGB", DISPLAY_SIZE)
+        img = img.convert("RGB").resize(DISPLAY_SIZE)
+
+    if THUMBNAIL_DIR:
+        os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+
+        # Written aside and swapped in, the prefetch thread and the Tk thread may decode the same image at once
+        tmp_path = f'{thumbnail_path}.{os.getpid()}-{threading.get_ident()}.part'
+        img.save(tmp_path, format="JPEG", quality=90)
+        os.replace(tmp_path, thumbnail_path)
+
+    return img
+
+def cache_image(image_id, img):
+    """Add a decoded image to the LRU cache, evicting the least recently used."""
+    with cache_lock:
+        image_cache[image_id] = img
+        image_cache.move_to_end(image_id)
+
+        while len(image_cache) > CACHE_SIZE:
+            image_cache.popitem(last=False)
+
+def cached_image(image_id):
+    """Get a decoded image from the cache, or None."""
+    with cache_lock:
+        img = image_cache.get(image_id)
+        if img is not None:
+            image_cache.move_to_end(image_id)
+
+        return img
+
+def prefetch_around(index):
+    """Ask the prefetch worker to decode the images around the given position."""
+    global prefetch_target
+
+    with prefetch_ready:
+        prefetch_target = index
+        prefetch_ready.notify()
+
+def run_prefetcher():
+    """Decode images ahead of (and just behind) the cursor on a background thread."""
+    global prefetch_target
+
+    while True:
+        with prefetch_ready:
+            while prefetch_target is None:
+                prefetch_ready.wait()
+
+            index, prefetch_target = prefetch_target, None
+
+        window = list(range(index + 1, index + 1 + PREFETCH_AHEAD)) + list(range(index - 1, index - 1 - PREFETCH_BEHIND, -1))
+
+        for i in window:
+            # The cursor moved, start over around the new position
+            if prefetch_target is not None:
+                break
+
+            if not 0 <= i < len(image_ids) or cached_image(image_ids[i]) is not None:
+                continue
+
+            try:
+                cache_image(image_ids[i], decode_image(image_ids[i]))
+            except (IOError, ValueError) as e:
+                print(f"Failed to prefetch {image_ids[i]}: {e}")
+
 def load_image(image_id):
     """Load and display the current image."""
-    image_info = image_data.get(image_id, {})
-    image_path = os.path.join(IMAGE_PROCESSED_DIR, image_info.get("fullFilename"))
-    
-    try:
-        img = Image.open(image_path)
-        img = img.resize((int(1.5 * 512), int(1.5 * 272)))  # Resize to fit the window
-        return ImageTk.PhotoImage(img)
-    except FileNotFoundError:
-        print(f"Image not found: {image_path}")
-        return None
+    img = cached_image(image_id)
+    metrics.inc("label_cache_misses_total" if img is None else "label_cache_hits_total")
+
+    if img is None:
+        try:
+            img = decode_image(image_id)
+            cache_image(image_id, img)
+        except FileNotFoundError as e:
+            print(f"Image not found: {e}")
+            return None
+        except (IOError, ValueError) as e:
+            print(f"Failed to load {image_id}: {e}")
+            return None
+
+    # PhotoImage has to be created on the Tk thread, but from a decoded image it is cheap
+    return ImageTk.PhotoImage(img)
 
 def update_image_info(image_id):
     """Update the image info display."""
@@ -52,6 +263,10 @@ def update_image_info(image_id):
     image_info_text.config(state=tk.NORMAL)
     image_info_text.delete(1.0, tk.END)
     image_info_text.insert(tk.END, f"ID: {image_id}\nFile: {image_info.get('fullFilename', 'Unknown')}")
+
+    frames = image_events.get(image_id)
+    if frames and len(frames) > 1:
+        image_info_text.insert(tk.END, f"\nEvent: frame {frames.index(image_id) + 1} of {len(frames)}")
     image_info_text.config(state=tk.DISABLED)
 
 def update_tags_display(image_id):
@@ -66,13 +281,62 @@ def update_progress(current_index, total_images):
     """Update the progress label."""
     progress_label.config(text=f"Progress: {current_index + 1}/{total_images}")
 
-def tag_image(tag, image_id):
-    """Tag the current image with the given tag."""
-    image_data[image_id]["newTags"] = [tag]
-    print(f"Tagged image {image_id} with '{tag}'")
+def journal_tags(tag, tagged_ids):
+    """Durably append the tag of one or more images to the journal."""
+    for image_id in tagged_ids:
+        image_data[image_id]["newTags"] = [tag]
 
+    with metrics.timer("journal_append_seconds"), journal_lock:
+        journal.write("".join(json.dumps({"id": image_id, "tags": [tag]}) + "\n" for image_id in tagged_ids))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    metrics.inc("labels_total", len(tagged_ids))
+    metrics.debug(f"Tagged {', '.join(tagged_ids)} with '{tag}'")
+
+def tag_image(tag, image_id):
+    """Tag the current image with the given tag, durably appending it to the journal."""
+    journal_tags(tag, [image_id])
     show_next_image()
 
+def tag_event(tag, image_id):
+    """Tag every frame of the current image's trigger event with the given tag, then skip past the event."""
+    frames = image_events.get(image_id, [image_id])
+    journal_tags(tag, frames)
+    metrics.inc("events_labeled_total")
+
+    last_index = image_positions[frames[-1]]
+    if last_index < len(image_ids) - 1:
+        show_image(last_index + 1)
+
+def show_image(index):
+    """Display the image at the given position."""
+    global current_image_id, current_image
+
+    image_id = image_ids[index]
+    img = load_image(image_id)
+    if not img:
+        print(f"Image {image_id} failed to load.")
+        return
+
+    current_image_id = image_id
+    current_image = img  # Keep a reference to the image
+    image_label.config(image=current_image)
+    update_progress(index, len(image_ids))
+    update_tags_display(current_image_id)
+    update_image_info(current_image_id)
+    prefetch_around(index)
+
+def next_untagged():
+    """Find the first untagged image, resuming from where the last search stopped."""
+    global untagged_cursor
+
+    # Images only ever become tagged, so the cursor never has to move back
+    while untagged_cursor < len(image_ids) and "newTags" in image_data[image_ids[untagged_cursor]]:
+        untagged_cursor += 1
+
+    return image_ids[untagged_cursor] if untagged_cursor < len(image_ids) else None
+
 def create_gui():
     """Set up the GUI and run the application."""
     global image_label, progress_label, tags_text, image_info_text, current_image
@@ -109,6 +373,16 @@ def create_gui():
     bad_button = tk.Button(button_frame, text="Bad Image", command=lambda: tag_image("bad", current_image_id), width=15)
     bad_button.grid(row=0, column=3, padx=10)
 
+    # Event buttons tag every frame of the burst at once
+    deer_event_button = tk.Button(button_frame, text="Deer (Event)", command=lambda: tag_event("deer", current_image_id), width=15)
+    deer_event_button.grid(row=1, column=0, padx=10, pady=5)
+
+    not_deer_event_button = tk.Button(button_frame, text="Not Deer (Event)", command=lambda: tag_event("not-deer", current_image_id), width=15)
+    not_deer_event_button.grid(row=1, column=1, padx=10, pady=5)
+
+    bad_event_button = tk.Button(button_frame, text="Bad (Event)", command=lambda: tag_event("bad", current_image_id), width=15)
+    bad_event_button.grid(row=1, column=3, padx=10, pady=5)
+
     # Navigation buttons
     back_button = tk.Button(window, text="Back", command=show_previous_image, width=20)
     back_button.pack(pady=10)
@@ -121,6 +395,13 @@ def create_gui():
     window.bind('n', lambda event: tag_image("not-deer", current_image_id))
     window.bind('m', lambda event: tag_image("deer", current_image_id))
     window.bind('v', lambda event: tag_image("bad", current_image_id))
+    window.bind('N', lambda event: tag_event("not-deer", current_image_id))
+    window.bind('M', lambda event: tag_event("deer", current_image_id))
+    window.bind('V', lambda event: tag_event("bad", current_image_id))
+
+    window.protocol("WM_DELETE_WINDOW", lambda: close_window(window))
+
+    threading.Thread(target=run_prefetcher, daemon=True).start()
 
     # Start the application
     load_next_image()
@@ -129,64 +410,37 @@ def create_gui():
 
 def load_next_image():
     """Load the next image."""
-    global current_image_id, current_image
-
     if not image_data:
         print("No images to display.")
         return
 
     # Find the next image without tags (start with the first untagged image)
-    current_image_id = next((img_id for img_id, info in image_data.items() if "newTags" not in info), None)
-
-    if current_image_id:
-        img = load_image(current_image_id)
-        if img:
-            current_image = img  # Keep a reference to the image
-            image_label.config(image=current_image)
-            update_progress(list(image_data).index(current_image_id), len(image_data))
-            update_tags_display(current_image_id)
-            update_image_info(current_image_id)
-        else:
-            print(f"Image {current_image_id} failed to load.")
+    image_id = next_untagged()
+
+    if image_id:
+        show_image(image_positions[image_id])
     else:
         print("All images tagged.")
         tkinter.messagebox.showinfo("End of Images", "You have tagged all images.")
 
 def show_previous_image():
     """Go back to the previous image."""
-    global current_image_id, current_image
-    image_ids = list(image_data.keys())
-    current_index = image_ids.index(current_image_id)
-    
-    # Make sure the previous image is loaded and properly handles going up and down
+    current_index = image_positions[current_image_id]
+
     if current_index > 0:
-        current_image_id = image_ids[current_index - 1]
-        img = load_image(current_image_id)
-        if img:
-            current_image = img  # Keep a reference to the image
-            image_label.config(image=current_image)
-            update_tags_display(current_image_id)
-            update_image_info(current_image_id)
-            update_progress(current_index - 1, len(image_data))
+        show_image(current_index - 1)
 
 def show_next_image():
     """Go to the next image."""
-    global current_image_id, current_image
-    image_ids = list(image_data.keys())
-    current_index = image_ids.index(current_image_id)
-    
-    # Make sure the next image is loaded and properly handles going up and down
+    current_index = image_positions[current_image_id]
+
     if current_index < len(image_ids) - 1:
-        current_image_id = image_ids[current_index + 1]
-        img = load_image(current_image_id)
-        if img:
-            current_image = img  # Keep a reference to the image
-            image_label.config(image=current_image)
-            update_tags_display(current_image_id)
-            update_image_info(current_image_id)
-            update_progress(current_index + 1, len(image_data))
+        show_image(current_index + 1)
 
 # Driver code
 if __name__ == "__main__":
-    image_data = load_json_data()  # Load image data at the start
+    store = metadata_store.connect()
+    open_journal()  # Apply labels left by an earlier session first
+    image_data = load_metadata()  # Load image data at the start
+    stop_reporter = metrics.start_reporter("label")
     create_gui()
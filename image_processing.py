@@ -1,15 +1,33 @@
 import os
-import cv2
-import json
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-from duplicate_images.duplicate import get_matches
-from duplicate_images.pair_finder_options import PairFinderOptions
-
-# Define paths for processed images
-IMAGE_DIR = os.path.join(os.getcwd(), "images")  # Path for original images
-IMAGE_PROCESSED_DIR = os.path.join(os.getcwd(), "processed-images")  # Directory for processed images
-IMAGE_JSON = os.path.join(os.getcwd(), "images.json")
+import time
+import threading
+import numpy as np
+import image_store
+import metadata_store
+import metrics
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Raw and processed images live in the content-addressed store
+IMAGE_DIR = image_store.IMAGE_DIR
+IMAGE_PROCESSED_DIR = image_store.IMAGE_PROCESSED_DIR
+
+# Output size, and its tag in the store index
+IMAGE_SIZE = image_store.IMAGE_SIZE
+SIZE_TAG = image_store.SIZE_TAG
+
+# Processed images marked in the index per transaction, so an interrupted run keeps its progress
+COMMIT_EVERY = 500
+
+REMOVE_DUPLICATES = image_store.REMOVE_DUPLICATES
+
+# Height of the camera's metadata border at full resolution
+CROP_BOTTOM = 35
+
+# JPEG start-of-frame markers, which hold the image dimensions
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# OpenCV decode flags by name, OpenCV is only imported once an image is processed
+REDUCED_FLAGS = {8: "IMREAD_REDUCED_COLOR_8", 4: "IMREAD_REDUCED_COLOR_4", 2: "IMREAD_REDUCED_COLOR_2"}
 
 def preflight_checks() -> None:
     """
@@ -23,126 +41,319 @@ def preflight_checks() -> None:
     else:
         print(f"Directory already exists: {IMAGE_PROCESSED_DIR}")
 
-def process_image(file_path: str, filename: str) -> None:
+def jpeg_size(data: bytes):
+    """
+    Read the dimensions of a JPEG from its header without decoding it.
+
+    Args:
+        data (bytes): The encoded image.
+
+    Returns:
+        tuple: (width, height), or None if the data isn't a JPEG.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+
+        marker = data[i + 1]
+        if marker in SOF_MARKERS:
+            return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+
+    return None
+
+def reduction_factor(data: bytes) -> int:
+    """
+    Pick the largest JPEG DCT scaling factor that still decodes at least IMAGE_SIZE after cropping.
+
+    Decoding at 1/2, 1/4 or 1/8 scale skips most of the IDCT work, which dominates when the
+    output is much smaller than the camera's resolution.
+
+    Args:
+        data (bytes): The encoded image.
+
+    Returns:
+        int: 1, 2, 4 or 8.
+    """
+    size = jpeg_size(data)
+    if not IMAGE_SIZE or not size:
+        return 1
+
+    width, height = size
+    for factor in (8, 4, 2):
+        if width // factor >= IMAGE_SIZE[0] and (height - CROP_BOTTOM) // factor >= IMAGE_SIZE[1]:
+            return factor
+
+    return 1
+
+def decode_image(data: bytes):
+    """
+    Decode an image at the smallest resolution that still covers IMAGE_SIZE.
+
+    Args:
+        data (bytes): The encoded image.
+
+    Returns:
+        tuple: (image, factor) with the decoded image and the scale it was decoded at.
+
+    Raises:
+        ValueError: If the image could not be decoded.
+    """
+    import cv2
+
+    factor = reduction_factor(data)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), getattr(cv2, REDUCED_FLAGS.get(factor, "IMREAD_COLOR")))
+    if img is None:
+        raise ValueError("Image data could not be decoded.")
+
+    return img, factor
+
+def crop_image(img, factor: int = 1):
+    """
+    Crop the camera's metadata border off the bottom of a decoded image and resize it to IMAGE_SIZE.
+
+    The crop is a view, so the resize reads straight from the original pixels in a single pass.
+
+    Args:
+        img (numpy.ndarray): The decoded image.
+        factor (int): The scale the image was decoded at.
+
+    Returns:
+        numpy.ndarray: The cropped and resized image.
+    """
+    import cv2
+
+    img_cropped = img[:-(-CROP_BOTTOM // factor), :]
+
+    if not IMAGE_SIZE:
+        return img_cropped
+
+    return cv2.resize(img_cropped, IMAGE_SIZE, interpolation=cv2.INTER_AREA)
+
+def save_image(img, processed_file_path: str) -> None:
     """
-    Process an image by cropping, resizing, and saving it to the processed directory.
+    Atomically write a processed image to the processed store.
+
+    Args:
+        img (numpy.ndarray): The processed image.
+        processed_file_path (str): Where to save it, from `image_store.processed_path`.
+    """
+    import cv2
+
+    ok, encoded = cv2.imencode(os.path.splitext(processed_file_path)[1], img)
+    if not ok:
+        raise ValueError("Image could not be encoded.")
+
+    os.makedirs(os.path.dirname(processed_file_path), exist_ok=True)
+
+    # Unique per writer, workers of `work_queue.py` may process the same content at once
+    tmp_path = f'{processed_file_path}.{os.getpid()}-{threading.get_ident()}.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(encoded.tobytes())
+
+    os.replace(tmp_path, processed_file_path)
+
+def process_image(file_path: str, processed_file_path: str) -> dict:
+    """
+    Process an image by cropping, resizing, and saving it to the processed store.
 
     Args:
         file_path (str): The full path to the original image file.
-        filename (str): The name of the file to save the processed image under.
+        processed_file_path (str): Where to save the processed image.
+
+    Returns:
+        dict: Seconds spent in each stage.
+            - 'stages': Seconds spent reading, decoding, transforming and encoding
+
+    Raises:
+        ValueError: If the image could not be decoded or encoded.
     """
-    try:
-        img = cv2.imread(file_path)
-        if img is None:
-            raise ValueError("Image file could not be read.")
+    start = time.perf_counter()
 
-        # Crop the bottom 25 pixels
-        img_cropped = img[:-35, :]
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    read = time.perf_counter()
 
-        # Save the processed image
-        processed_file_path = os.path.join(IMAGE_PROCESSED_DIR, filename)
-        cv2.imwrite(processed_file_path, img_cropped)
+    img, factor = decode_image(data)
+    decoded = time.perf_counter()
 
-        print(f"Processed and saved: {filename}")
-    except Exception as e:
-        print(f"Failed to process {file_path}: {e}")
+    img = crop_image(img, factor)
+    transformed = time.perf_counter()
+
+    save_image(img, processed_file_path)
+    encoded = time.perf_counter()
+
+    return {
+        "stages": {
+            "read": read - start,
+            "decode": decoded - read,
+            "transform": transformed - decoded,
+            "encode": encoded - transformed,
+        },
+    }
+
+def process_image_bytes(data: bytes, processed_file_path: str) -> None:
+    """
+    Process an image that is already in memory, such as one just downloaded.
+
+    Args:
+        data (bytes): The encoded original image.
+        processed_file_path (str): Where to save the processed image.
+
+    Raises:
+        ValueError: If the image could not be decoded or encoded.
+    """
+    with metrics.timer("process_decode_seconds"):
+        img, factor = decode_image(data)
+
+    with metrics.timer("process_transform_seconds"):
+        img = crop_image(img, factor)
+
+    with metrics.timer("process_encode_seconds"):
+        save_image(img, processed_file_path)
+
+    metrics.debug(f"Processed and saved: {processed_file_path}")
+
+def init_worker() -> None:
+    """
+    Keep OpenCV single threaded in each worker, the pool already uses every core.
+    """
+    import cv2
+
+    cv2.setNumThreads(1)
 
 def remove_duplicates() -> None:
     """
-    Identify and remove duplicate images in the processed images directory.
+    Identify and remove near-duplicate images in the processed images directory.
     
-    Uses the `duplicate_images` library to find duplicates based on image hashes.
-    Retains only the first image in each duplicate group.
+    Uses `image_dedup` to hash only new images and match them against the kept ones
+    within DEDUP_MAX_DISTANCE. Retains the first image of each burst.
     """
+    import image_dedup
+
     print("Searching for duplicates...")
     try:
-        dup_options = PairFinderOptions(
-            max_distance=0,
-            hash_size=None,
-            show_progress_bars=False,
-            parallel=True,
-            slow=False,
-            group=True,
-        )
-
-        duplicates = get_matches(
-            [Path(IMAGE_PROCESSED_DIR)], 'phash', dup_options, None, None
-        )
-
-        for duplicate_group in duplicates:
-            # Keep the first image, delete the rest
-            for duplicate in duplicate_group[1:]:
-                os.remove(duplicate)
-                print(f"Removed duplicate: {duplicate}")
-
+        image_dedup.remove_duplicates()
         print("Duplicate removal complete.")
     except Exception as e:
         print(f"Error during duplicate removal: {e}")
 
-def clean_json() -> None:
+def clean_metadata() -> None:
     """
-    Update the JSON file to include only the images currently in the processed directory.
+    Remove the records of images that aren't stored or failed processing, so the next
+    collection downloads them again.
 
-    Loads existing image data from the JSON file, filters it to match current processed images,
-    and saves the updated data back to the file.
+    Records of duplicates, identical downloads or near-duplicates, are kept so collection
+    knows them, readers leave them out through `image_store.processed_paths`.
     """
-    print("Saving new JSON to file...")
-
-    all_images = dict()
-    cur_images = [
-        f for f in os.listdir(IMAGE_PROCESSED_DIR)
-        if f.lower().endswith(('.png', '.jpg', '.jpeg'))
-    ]
-
-    try:
-        with open(IMAGE_JSON, 'r') as f:
-            all_images.update(json.load(f))
-    except FileNotFoundError:
-        print("JSON file not found. Creating a new one.")
+    print("Cleaning metadata store...")
 
-    final_images = {key: value for key, value in all_images.items() if f'{key}.JPG' in cur_images}
+    conn = metadata_store.connect()
+    settled = image_store.settled_names(conn)
 
-    # Delete imageUrl since it is crazy long with AWS access token
-    for k, v in final_images.items(): 
-        if "imageUrl" in v:
-            del v["imageUrl"]
+    missing = [
+        filename for filename, full_filename in metadata_store.iter_filenames(conn)
+        if (full_filename or f'{filename}.JPG') not in settled
+    ]
 
-    with open(IMAGE_JSON, 'w') as f:
-        json.dump(final_images, f, indent=6)
+    with conn:
+        metadata_store.delete_images(conn, missing)
 
-    print("Done saving to file.")
+    print(f"Removed {len(missing)} records, {metadata_store.count_images(conn)} images remain.")
 
 def process_images() -> None:
     """
     Orchestrate the full image processing workflow:
     - Ensure necessary directories exist.
-    - Process all images in the `IMAGE_DIR` directory.
-    - Remove duplicate images from the processed directory.
-    - Update the JSON file with the current processed images.
+    - Process every stored image the index doesn't list as processed at IMAGE_SIZE.
+    - Remove near-duplicate images from the processed store, unless REMOVE_DUPLICATES is false.
+    - Drop the records of images that failed processing, so they are collected again.
     """
     preflight_checks()
     print("Starting image processing...")
 
-    # List of valid image files
-    image_files = [
-        f for f in os.listdir(IMAGE_DIR)
-        if f.lower().endswith(('.png', '.jpg', '.jpeg'))
-    ]
+    conn = metadata_store.connect()
+    total = image_store.count_blobs(conn)
 
-    if not image_files:
-        print("No images found in the directory.")
+    if not total:
+        print("No images found in the store.")
         return
 
-    # Process images in parallel
-    with ThreadPoolExecutor() as executor:
-        for filename in image_files:
-            file_path = os.path.join(IMAGE_DIR, filename)
-            executor.submit(process_image, file_path, filename)
+    # Duplicates removed by earlier runs are left out of the index query, so they aren't recreated
+    to_process = [key for key in image_store.pending(conn, SIZE_TAG) if os.path.exists(image_store.raw_path(key))]
+
+    print(f"Skipping {total - len(to_process)} processed images, processing {len(to_process)}...")
+
+    # Process images in parallel, one process per core since decoding is CPU bound
+    stage_totals = dict()
+    failed = 0
+    remaining = len(to_process)
+    workers = os.cpu_count()
+    done = list()
+
+    # Workers busy is min(pending, workers) while the pool drains
+    metrics.set_gauge("process_workers", workers)
+    metrics.track("process_pending", lambda: remaining)
+    stop_reporter = metrics.start_reporter("process")
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = {
+            executor.submit(process_image, image_store.raw_path(key), image_store.processed_path(key)): key
+            for key in to_process
+        }
+
+        for future in as_completed(futures):
+            key = futures[future]
+            remaining -= 1
+
+            try:
+                entry = future.result()
+            except Exception as e:
+                print(f"Failed to process {key}: {e}")
+                metrics.inc("process_failures_total")
+                failed += 1
+                continue
+
+            # Workers run in other processes, so their stage timings are recorded here
+            for stage, seconds in entry.pop("stages").items():
+                stage_totals[stage] = stage_totals.get(stage, 0) + seconds
+                metrics.observe(f"process_{stage}_seconds", seconds)
+
+            metrics.inc("images_processed_total")
+            done.append(key)
+
+            if len(done) >= COMMIT_EVERY:
+                with conn:
+                    image_store.set_processed(conn, done, SIZE_TAG)
+                done = list()
+
+    with conn:
+        image_store.set_processed(conn, done, SIZE_TAG)
+
+    elapsed = time.perf_counter() - start
+    processed = len(to_process) - failed
+    metrics.untrack("process_pending")
+
+    print(f"Processed {processed} images, {failed} failed in {elapsed:.1f}s "
+          f"({processed / max(elapsed, 1e-9):.1f} images/sec)")
+
+    # Per-stage rate for a single worker, the slowest stage is the one worth optimizing
+    for stage, seconds in stage_totals.items():
+        print(f"  {stage}: {seconds:.1f} worker-seconds ({processed / max(seconds, 1e-9):.1f} images/sec per worker)")
 
     print("Image processing complete. Now removing duplicates...")
 
-    # remove_duplicates()
-    clean_json()
+    if REMOVE_DUPLICATES:
+        remove_duplicates()
+
+    clean_metadata()
+    stop_reporter()
 
 if __name__ == "__main__":
     process_images()
@@ -0,0 +1,435 @@
+"""
+Content-addressed, sharded storage for raw and processed images
+
+Every image is stored once per distinct content, named by the SHA-1 of its bytes and sharded
+into two levels of subdirectories (`images/ab/cd/abcd....jpg`), so identical downloads are
+stored and processed once and no directory grows past a few hundred entries. The processed
+image of a raw one lives under the same key in the processed directory.
+
+The index lives in the metadata store next to the records: `files` maps each camera filename
+and GUID to its content key, and `blobs` holds per key the size, the image size it was
+processed at, its perceptual hash, whether duplicate removal has checked it and the key it
+duplicates. Stages query the index instead of listing directories.
+
+Usage:
+    python image_store.py import  # Move images from the old flat directories into the store
+"""
+
+import os
+import sys
+import json
+import hashlib
+import threading
+import metadata_store
+
+IMAGE_DIR = os.path.join(os.getcwd(), "images")  # Raw images
+IMAGE_PROCESSED_DIR = os.getenv("IMAGE_PROCESSED_DIR", os.path.join(os.getcwd(), "processed-images"))
+
+# Output size as WIDTHxHEIGHT, empty to keep the cropped resolution
+IMAGE_SIZE = os.getenv("IMAGE_SIZE", "224x224")
+IMAGE_SIZE = tuple(int(v) for v in IMAGE_SIZE.lower().split("x")) if IMAGE_SIZE else None
+
+# Identical downloads are read as one image, the first camera filename stands for the rest
+REMOVE_DUPLICATES = os.getenv("REMOVE_DUPLICATES", "true").lower() == "true"
+
+# Written by earlier versions of image_processing.py, used to carry processed images over
+PROCESSED_MANIFEST = os.path.join(os.getcwd(), "processed-manifest.json")
+
+def size_tag_for(image_size) -> str:
+    """
+    Get the tag the index records for images processed at an output size.
+
+    Args:
+        image_size (tuple): (width, height), None to keep the cropped resolution.
+
+    Returns:
+        str: Such as '224x224', or 'crop'.
+    """
+    return "x".join(str(v) for v in image_size) if image_size else "crop"
+
+# Recorded in the index, so changing the output size reprocesses everything
+SIZE_TAG = size_tag_for(IMAGE_SIZE)
+
+def content_key(data: bytes) -> str:
+    """
+    Hash an image's bytes.
+
+    Args:
+        data (bytes): The encoded image.
+
+    Returns:
+        str: The 40 character hex SHA-1.
+    """
+    return hashlib.sha1(data).hexdigest()
+
+def object_path(root: str, key: str) -> str:
+    """
+    Get the sharded path of an image.
+
+    Args:
+        root (str): IMAGE_DIR or IMAGE_PROCESSED_DIR.
+        key (str): The content key.
+
+    Returns:
+        str: The path, two directory levels from the first four hex digits.
+    """
+    return os.path.join(root, key[:2], key[2:4], f'{key}.jpg')
+
+def raw_path(key: str) -> str:
+    """Get the path of a raw image."""
+    return object_path(IMAGE_DIR, key)
+
+def processed_path(key: str) -> str:
+    """Get the path of a processed image."""
+    return object_path(IMAGE_PROCESSED_DIR, key)
+
+def write_object(path: str, data: bytes) -> bool:
+    """
+    Atomically write an image unless it is already stored.
+
+    Args:
+        path (str): The object path.
+        data (bytes): The encoded image.
+
+    Returns:
+        bool: True if the image was written, False if identical content was already there.
+    """
+    if os.path.exists(path):
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+
+    os.replace(tmp_path, path)
+    return True
+
+def store_raw(data: bytes) -> str:
+    """
+    Store a raw image held in memory.
+
+    Args:
+        data (bytes): The encoded image.
+
+    Returns:
+        str: Its content key.
+    """
+    key = content_key(data)
+    write_object(raw_path(key), data)
+
+    return key
+
+def store_raw_file(tmp_path: str) -> tuple:
+    """
+    Move a downloaded file into the store, dropping it when identical content is already stored.
+
+    Args:
+        tmp_path (str): The complete download.
+
+    Returns:
+        tuple: (key, size) of the image.
+    """
+    digest = hashlib.sha1()
+    with open(tmp_path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+
+    key = digest.hexdigest()
+    size = os.path.getsize(tmp_path)
+    path = raw_path(key)
+
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    return key, size
+
+def index_files(conn, files: dict) -> None:
+    """
+    Record where images are stored.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        files (dict): Per camera filename (with extension), (key, image GUID, size).
+    """
+    conn.executemany("INSERT OR IGNORE INTO blobs (key, size) VALUES (?, ?)", [(key, size) for key, _, size in files.values()])
+    conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", [(name, guid, key) for name, (key, guid, _) in files.items()])
+
+def locate(conn, name: str = None, guid: str = None) -> str:
+    """
+    Look up an image's content key by camera filename or GUID.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        name (str): The camera filename, with extension.
+        guid (str): The image GUID, used when no name is given.
+
+    Returns:
+        str: The key, None if the image isn't stored.
+    """
+    if name is not None:
+        row = conn.execute("SELECT key FROM files WHERE name = ?", (name,)).fetchone()
+    else:
+        row = conn.execute("SELECT key FROM files WHERE image_guid = ?", (guid,)).fetchone()
+
+    return row[0] if row else None
+
+def count_blobs(conn, processed: bool = False) -> int:
+    """
+    Count the distinct images stored.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        processed (bool): Only count processed images that aren't duplicates.
+
+    Returns:
+        int: The number of images.
+    """
+    query = "SELECT COUNT(*) FROM blobs"
+    if processed:
+        query += " WHERE processed IS NOT NULL AND duplicate_of IS NULL"
+
+    return conn.execute(query).fetchone()[0]
+
+def count_unchecked(conn) -> int:
+    """
+    Count the processed images duplicate removal hasn't checked yet.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+
+    Returns:
+        int: The number of images.
+    """
+    return conn.execute(
+        "SELECT COUNT(*) FROM blobs WHERE processed IS NOT NULL AND duplicate_of IS NULL AND deduped = 0"
+    ).fetchone()[0]
+
+def pending(conn, size_tag: str) -> list:
+    """
+    List the images still to process at an output size.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        size_tag (str): The output size, such as '224x224'.
+
+    Returns:
+        list: Content keys of images never processed or processed at another size, duplicates
+            left out, in order of their first camera filename.
+    """
+    rows = conn.execute(
+        "SELECT b.key FROM blobs b JOIN files f ON f.key = b.key "
+        "WHERE (b.processed IS NULL OR b.processed != ?) AND b.duplicate_of IS NULL "
+        "GROUP BY b.key ORDER BY MIN(f.name)",
+        (size_tag,),
+    )
+    return [row[0] for row in rows]
+
+def processed_keys(conn, size_tag: str) -> set:
+    """
+    Get the images already processed at an output size.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        size_tag (str): The output size.
+
+    Returns:
+        set: Their content keys.
+    """
+    return {row[0] for row in conn.execute("SELECT key FROM blobs WHERE processed = ?", (size_tag,))}
+
+def set_processed(conn, keys, size_tag: str) -> None:
+    """
+    Mark images as processed, clearing perceptual hashes and duplicate checks of the previous output.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        keys (iterable): Content keys.
+        size_tag (str): The output size they were processed at.
+    """
+    conn.executemany("UPDATE blobs SET processed = ?, phash = NULL, deduped = 0 WHERE key = ?", [(size_tag, key) for key in keys])
+
+def processed_paths(conn, unique: bool = REMOVE_DUPLICATES) -> dict:
+    """
+    Find the processed image of every stored camera file, leaving out near-duplicates.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        unique (bool): Only keep the first camera filename of content stored under several,
+            by default unless REMOVE_DUPLICATES is false.
+
+    Returns:
+        dict: Per camera filename (with extension), the processed image's path.
+    """
+    rows = conn.execute(
+        "SELECT f.name, f.key FROM files f JOIN blobs b ON b.key = f.key "
+        "WHERE b.processed IS NOT NULL AND b.duplicate_of IS NULL ORDER BY f.name"
+    )
+
+    paths = dict()
+    seen = set()
+    for name, key in rows:
+        if unique and key in seen:
+            continue
+
+        seen.add(key)
+        paths[name] = processed_path(key)
+
+    return paths
+
+def settled_names(conn) -> set:
+    """
+    Get the camera filenames whose image is processed or was removed as a near-duplicate.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+
+    Returns:
+        set: Camera filenames, with extension.
+    """
+    rows = conn.execute(
+        "SELECT f.name FROM files f JOIN blobs b ON b.key = f.key "
+        "WHERE b.processed IS NOT NULL OR b.duplicate_of IS NOT NULL"
+    )
+    return {row[0] for row in rows}
+
+def iter_hashes(conn):
+    """
+    Iterate over the processed images that aren't duplicates, for duplicate removal.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+
+    Yields:
+        tuple: (key, first camera filename, perceptual hash as hex or None, whether duplicate
+            removal checked it) in filename order.
+    """
+    yield from conn.execute(
+        "SELECT b.key, MIN(f.name), b.phash, b.deduped FROM blobs b JOIN files f ON f.key = b.key "
+        "WHERE b.processed IS NOT NULL AND b.duplicate_of IS NULL GROUP BY b.key ORDER BY MIN(f.name)"
+    )
+
+def set_hashes(conn, hashes: dict) -> None:
+    """
+    Save perceptual hashes.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        hashes (dict): Per content key, the 64 bit hash.
+    """
+    conn.executemany("UPDATE blobs SET phash = ? WHERE key = ?", [(f'{value:016x}', key) for key, value in hashes.items()])
+
+def set_deduped(conn, keys) -> None:
+    """
+    Mark images as checked by duplicate removal.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        keys (iterable): Content keys.
+    """
+    conn.executemany("UPDATE blobs SET deduped = 1 WHERE key = ?", [(key,) for key in keys])
+
+def set_duplicates(conn, duplicates: dict) -> None:
+    """
+    Mark images as near-duplicates, so they are neither processed nor used again.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        duplicates (dict): Per content key, the key of the image it duplicates.
+    """
+    conn.executemany("UPDATE blobs SET duplicate_of = ? WHERE key = ?", [(kept, key) for key, kept in duplicates.items()])
+
+def name_hashes(conn) -> dict:
+    """
+    Get the saved perceptual hashes of processed images by camera filename.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+
+    Returns:
+        dict: Per camera filename (with extension), the 64 bit hash.
+    """
+    rows = conn.execute(
+        "SELECT f.name, b.phash FROM files f JOIN blobs b ON b.key = f.key "
+        "WHERE b.phash IS NOT NULL AND b.duplicate_of IS NULL"
+    )
+    return {name: int(value, 16) for name, value in rows}
+
+def import_flat(conn) -> int:
+    """
+    Move images from the flat directories of earlier versions into the store.
+
+    Raw images at the top of IMAGE_DIR are hashed and moved into their shards. A processed
+    image with the same name moves along, marked processed when processed-manifest.json says
+    it is current and otherwise left to be processed again. Nothing is deleted: processed
+    images without a raw one, or whose place in the store is taken, stay where they are.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+
+    Returns:
+        int: The number of imported images.
+    """
+    try:
+        with open(PROCESSED_MANIFEST, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = dict()
+
+    processed_tag = size_tag_for(manifest.get("imageSize"))
+    current = manifest.get("images", dict())
+
+    filenames = {full_filename: filename for filename, full_filename in metadata_store.iter_filenames(conn)}
+    names = [
+        entry.name for entry in os.scandir(IMAGE_DIR)
+        if entry.is_file() and entry.name.lower().endswith(('.png', '.jpg', '.jpeg'))
+    ] if os.path.isdir(IMAGE_DIR) else []
+
+    print(f"Importing {len(names)} images from {IMAGE_DIR}...")
+
+    files = dict()
+    processed = list()
+    unprocessed = 0
+    for name in names:
+        key, size = store_raw_file(os.path.join(IMAGE_DIR, name))
+        record = metadata_store.get_image(conn, filenames.get(name, os.path.splitext(name)[0])) or {}
+        files[name] = (key, record.get("imageGuid"), size)
+
+        flat_processed = os.path.join(IMAGE_PROCESSED_DIR, name)
+        if os.path.isfile(flat_processed):
+            if name in current:
+                os.makedirs(os.path.dirname(processed_path(key)), exist_ok=True)
+                os.replace(flat_processed, processed_path(key))
+                processed.append(key)
+            elif not os.path.exists(processed_path(key)):
+                # Not known to be current, so processing overwrites it, but until then it is kept
+                os.makedirs(os.path.dirname(processed_path(key)), exist_ok=True)
+                os.replace(flat_processed, processed_path(key))
+                unprocessed += 1
+
+    with conn:
+        index_files(conn, files)
+        set_processed(conn, processed, processed_tag)
+
+    print(f"Imported {len(files)} images as {len(set(key for key, _, _ in files.values()))} distinct, "
+          f"{len(processed)} already processed, {unprocessed} to process again.")
+
+    left = [
+        entry.name for entry in os.scandir(IMAGE_PROCESSED_DIR)
+        if entry.is_file() and entry.name.lower().endswith(('.png', '.jpg', '.jpeg'))
+    ] if os.path.isdir(IMAGE_PROCESSED_DIR) else []
+    if left:
+        print(f"Left {len(left)} processed images in {IMAGE_PROCESSED_DIR}, without a raw image or already stored.")
+
+    return len(files)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print(__doc__.strip())
+        sys.exit(1)
+
+    import_flat(metadata_store.connect())
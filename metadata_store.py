@@ -0,0 +1,426 @@
+"""
+Indexed SQLite store for image metadata, replacing the monolithic images.json
+
+Each image is one row keyed by filename, with the full record kept as JSON next to indexed
+columns for the GUID, label and capture time. Inserting a page or updating a label only
+touches the affected rows instead of rewriting the whole archive. The same database holds the
+trigger events (see events.py) and the index of stored image files (see image_store.py).
+
+Usage:
+    python metadata_store.py import [images.json]
+    python metadata_store.py export [images.json]
+"""
+
+import os
+import sys
+import json
+import sqlite3
+
+IMAGES_DB = os.getenv("IMAGES_DB", "images.db")
+IMAGE_JSON = os.getenv("IMAGES_JSON", "images.json")
+
+# WAL needs shared memory, so a store shared by hosts over a network filesystem needs DELETE
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE") or "WAL"
+
+# Seconds a write waits for another process's transaction, work_queue.py runs many writers
+BUSY_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    full_filename TEXT,
+    image_guid TEXT,
+    created_date_time TEXT,
+    label TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_full_filename ON images (full_filename);
+CREATE INDEX IF NOT EXISTS images_image_guid ON images (image_guid);
+CREATE INDEX IF NOT EXISTS images_label ON images (label);
+CREATE INDEX IF NOT EXISTS images_created_date_time ON images (created_date_time);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    filename TEXT PRIMARY KEY,
+    event_id TEXT NOT NULL,
+    frame INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_event_id ON events (event_id);
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    image_guid TEXT,
+    key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_key ON files (key);
+CREATE INDEX IF NOT EXISTS files_image_guid ON files (image_guid);
+CREATE TABLE IF NOT EXISTS blobs (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    processed TEXT,
+    phash TEXT,
+    duplicate_of TEXT,
+    deduped INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+def connect(path: str = IMAGES_DB) -> sqlite3.Connection:
+    """
+    Open the metadata store, creating it if needed.
+
+    A new store is seeded from IMAGES_JSON when that file exists, so existing archives
+    carry over without a separate migration step. The connection may be shared between
+    threads as long as callers serialize access.
+
+    Args:
+        path (str): Path to the SQLite database.
+
+    Returns:
+        sqlite3.Connection: The open store.
+    """
+    is_new = not os.path.exists(path)
+
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+
+    # Stores from before events.py saved hashes, when only duplicate removal hashed images
+    if "deduped" not in {row[1] for row in conn.execute("PRAGMA table_info(blobs)")}:
+        with conn:
+            conn.execute("ALTER TABLE blobs ADD COLUMN deduped INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE blobs SET deduped = 1 WHERE phash IS NOT NULL")
+
+    if is_new and os.path.exists(IMAGE_JSON):
+        print(f"Importing existing metadata from {IMAGE_JSON}...")
+        import_json(conn, IMAGE_JSON)
+
+    return conn
+
+def to_row(filename: str, image: dict) -> tuple:
+    """
+    Flatten an image record into a row of the images table.
+
+    The signed 'imageUrl' is dropped since it expires and is only needed while downloading.
+
+    Args:
+        filename (str): The image's filename, without extension.
+        image (dict): The image record as returned by `image_collection.get_image_range`.
+
+    Returns:
+        tuple: The row values.
+    """
+    record = {k: v for k, v in image.items() if k != "imageUrl"}
+    tags = record.get("newTags")
+
+    return (
+        filename,
+        record.get("fullFilename"),
+        record.get("imageGuid"),
+        record.get("createdDateTime"),
+        tags[0] if tags else None,
+        json.dumps(record),
+    )
+
+def add_images(conn: sqlite3.Connection, images: dict) -> None:
+    """
+    Insert image records, leaving images that are already stored (and their labels) untouched.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        images (dict): Image records keyed by filename.
+    """
+    conn.executemany(
+        "INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+        [to_row(filename, image) for filename, image in images.items()],
+    )
+
+def put_images(conn: sqlite3.Connection, images: dict) -> None:
+    """
+    Insert or replace image records.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        images (dict): Image records keyed by filename.
+    """
+    conn.executemany(
+        "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+        [to_row(filename, image) for filename, image in images.items()],
+    )
+
+def get_image(conn: sqlite3.Connection, filename: str) -> dict:
+    """
+    Look up one image record.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        filename (str): The image's filename, without extension.
+
+    Returns:
+        dict: The image record, or None if it isn't stored.
+    """
+    row = conn.execute("SELECT record FROM images WHERE filename = ?", (filename,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def get_images(conn: sqlite3.Connection, filenames) -> dict:
+    """
+    Look up several image records at once.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        filenames (iterable): Filenames to look up, without extension.
+
+    Returns:
+        dict: The stored records keyed by filename, images that aren't stored are left out.
+    """
+    filenames = list(filenames)
+    images = dict()
+
+    # SQLite caps the number of bound parameters per statement
+    for i in range(0, len(filenames), 500):
+        chunk = filenames[i:i + 500]
+        rows = conn.execute(f"SELECT filename, record FROM images WHERE filename IN ({','.join('?' * len(chunk))})", chunk)
+        images.update((filename, json.loads(record)) for filename, record in rows)
+
+    return images
+
+def iter_labels(conn: sqlite3.Connection):
+    """
+    Iterate over every stored image's label without decoding the records.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+
+    Yields:
+        tuple: (filename, label) pairs in the order images were added, label is None when unlabeled.
+    """
+    yield from conn.execute("SELECT filename, label FROM images ORDER BY rowid")
+
+def iter_images(conn: sqlite3.Connection, label: str = None, labeled: bool = None):
+    """
+    Iterate over stored images in the order they were added.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        label (str): Only yield images with this label.
+        labeled (bool): Only yield labeled (True) or unlabeled (False) images.
+
+    Yields:
+        tuple: (filename, record) pairs.
+    """
+    query = "SELECT filename, record FROM images"
+    params = ()
+
+    if label is not None:
+        query += " WHERE label = ?"
+        params = (label,)
+
+    elif labeled is not None:
+        query += " WHERE label IS NOT NULL" if labeled else " WHERE label IS NULL"
+
+    for filename, record in conn.execute(query + " ORDER BY rowid", params):
+        yield filename, json.loads(record)
+
+def iter_filenames(conn: sqlite3.Connection):
+    """
+    Iterate over stored filenames without decoding the records.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+
+    Yields:
+        tuple: (filename, fullFilename) pairs.
+    """
+    yield from conn.execute("SELECT filename, full_filename FROM images ORDER BY rowid")
+
+def count_images(conn: sqlite3.Connection) -> int:
+    """
+    Count the stored images.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+
+    Returns:
+        int: The number of images.
+    """
+    return conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+def known_filenames(conn: sqlite3.Connection, filenames) -> set:
+    """
+    Find which of the given filenames are already stored.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        filenames (iterable): Filenames to check, without extension.
+
+    Returns:
+        set: The subset of `filenames` that is stored.
+    """
+    filenames = list(filenames)
+    known = set()
+
+    # SQLite caps the number of bound parameters per statement
+    for i in range(0, len(filenames), 500):
+        chunk = filenames[i:i + 500]
+        rows = conn.execute(f"SELECT filename FROM images WHERE filename IN ({','.join('?' * len(chunk))})", chunk)
+        known.update(row[0] for row in rows)
+
+    return known
+
+def set_tags(conn: sqlite3.Connection, filename: str, tags: list) -> None:
+    """
+    Set the labels of one image.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        filename (str): The image's filename, without extension.
+        tags (list): The new tags, stored as 'newTags'.
+    """
+    record = get_image(conn, filename)
+    if record is None:
+        raise KeyError(filename)
+
+    record["newTags"] = tags
+    conn.execute(
+        "UPDATE images SET label = ?, record = ? WHERE filename = ?",
+        (tags[0] if tags else None, json.dumps(record), filename),
+    )
+
+def update_fields(conn: sqlite3.Connection, filename: str, fields: dict) -> None:
+    """
+    Set fields of one image record, such as a predicted probability.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        filename (str): The image's filename, without extension.
+        fields (dict): Fields to add or overwrite in the record.
+    """
+    record = get_image(conn, filename)
+    if record is None:
+        raise KeyError(filename)
+
+    record.update(fields)
+    conn.execute("UPDATE images SET record = ? WHERE filename = ?", (json.dumps(record), filename))
+
+def delete_images(conn: sqlite3.Connection, filenames) -> None:
+    """
+    Remove image records.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        filenames (iterable): Filenames to remove, without extension.
+    """
+    conn.executemany("DELETE FROM images WHERE filename = ?", [(f,) for f in filenames])
+
+def get_state(conn: sqlite3.Connection, key: str, default=None):
+    """
+    Read a JSON value from the state table, such as a sync checkpoint.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        key (str): The state key.
+        default: Returned when the key isn't set.
+
+    Returns:
+        The stored value.
+    """
+    row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def set_state(conn: sqlite3.Connection, key: str, value) -> None:
+    """
+    Write a JSON value to the state table.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        key (str): The state key.
+        value: Any JSON serializable value.
+    """
+    conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, json.dumps(value)))
+
+def set_events(conn: sqlite3.Connection, events: list) -> None:
+    """
+    Replace the trigger events images are grouped into.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        events (list): Each event's filenames in capture order, the first one naming the event.
+    """
+    conn.execute("DELETE FROM events")
+    conn.executemany(
+        "INSERT INTO events VALUES (?, ?, ?)",
+        [(filename, frames[0], frame) for frames in events for frame, filename in enumerate(frames)],
+    )
+
+def load_events(conn: sqlite3.Connection) -> dict:
+    """
+    Load the trigger events images are grouped into.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+
+    Returns:
+        dict: Each event's filenames in capture order, keyed by event id.
+    """
+    events = dict()
+    for event_id, filename in conn.execute("SELECT event_id, filename FROM events ORDER BY event_id, frame"):
+        events.setdefault(event_id, []).append(filename)
+
+    return events
+
+def import_json(conn: sqlite3.Connection, path: str = IMAGE_JSON) -> int:
+    """
+    Import an images.json file, replacing stored records with the same filename.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        path (str): Path to the JSON file.
+
+    Returns:
+        int: The number of imported images.
+    """
+    with open(path, 'r') as f:
+        images = json.load(f)
+
+    with conn:
+        put_images(conn, images)
+
+    print(f"Imported {len(images)} images from {path}")
+
+    return len(images)
+
+def export_json(conn: sqlite3.Connection, path: str = IMAGE_JSON) -> int:
+    """
+    Export the store to an images.json file in the original format.
+
+    Args:
+        conn (sqlite3.Connection): The open store.
+        path (str): Path to the JSON file.
+
+    Returns:
+        int: The number of exported images.
+    """
+    images = dict(iter_images(conn))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(images, f, indent=6)
+
+    os.replace(tmp_path, path)
+
+    print(f"Exported {len(images)} images to {path}")
+
+    return len(images)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("import", "export"):
+        print(__doc__.strip())
+        sys.exit(1)
+
+    json_path = sys.argv[2] if len(sys.argv) > 2 else IMAGE_JSON
+
+    if sys.argv[1] == "import":
+        import_json(connect(), json_path)
+    else:
+        export_json(connect(), json_path)
@@ -0,0 +1,268 @@
+"""
+Shared counters, latency histograms and gauges for the pipeline stages
+
+Stages record what they do here instead of printing a line per image. A reporter thread
+prints one summary line every METRICS_INTERVAL seconds and, when METRICS_FILE is set, writes
+every metric to it: in Prometheus text format for a .prom file, JSON otherwise.
+
+Per-image messages go through `debug` and only show with LOG_LEVEL=debug.
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info").lower()
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL") or 10)
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+lock = threading.Lock()
+counters = dict()
+histograms = dict()
+gauges = dict()
+tracked = dict()
+
+def debug(message: str) -> None:
+    """
+    Print a message only at debug level, for per-image progress.
+
+    Args:
+        message (str): The message.
+    """
+    if LOG_LEVEL == "debug":
+        print(message)
+
+def inc(name: str, value: float = 1) -> None:
+    """
+    Add to a counter.
+
+    Args:
+        name (str): The counter, ending in '_total' by convention.
+        value (float): The amount to add.
+    """
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+def set_gauge(name: str, value: float) -> None:
+    """
+    Set a gauge to its current value.
+
+    Args:
+        name (str): The gauge.
+        value (float): The value.
+    """
+    with lock:
+        gauges[name] = value
+
+def add_gauge(name: str, delta: float) -> None:
+    """
+    Move a gauge up or down, such as a count of busy workers.
+
+    Args:
+        name (str): The gauge.
+        delta (float): The change.
+    """
+    with lock:
+        gauges[name] = gauges.get(name, 0) + delta
+
+def track(name: str, fn) -> None:
+    """
+    Register a gauge that is read when metrics are reported, such as a queue's depth.
+
+    Args:
+        name (str): The gauge.
+        fn (function): Returns the current value.
+    """
+    with lock:
+        tracked[name] = fn
+
+def untrack(name: str) -> None:
+    """
+    Stop reading a gauge registered with `track`, keeping its last value.
+
+    Args:
+        name (str): The gauge.
+    """
+    with lock:
+        fn = tracked.pop(name, None)
+
+    if fn is not None:
+        set_gauge(name, fn())
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Record one latency in a histogram.
+
+    Args:
+        name (str): The histogram, ending in '_seconds' by convention.
+        seconds (float): The latency.
+    """
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = {"buckets": [0] * (len(BUCKETS) + 1), "count": 0, "sum": 0.0}
+
+        histogram["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+@contextmanager
+def timer(name: str):
+    """
+    Record how long a block takes in a histogram.
+
+    Args:
+        name (str): The histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def quantile(histogram: dict, q: float) -> float:
+    """
+    Estimate a quantile from a histogram as the upper bound of the bucket it falls in.
+
+    Args:
+        histogram (dict): A histogram from `snapshot`.
+        q (float): The quantile, between 0 and 1.
+
+    Returns:
+        float: The estimate in seconds, infinity past the last bucket.
+    """
+    target = q * histogram["count"]
+    seen = 0
+
+    for bound, count in zip(BUCKETS + (float("inf"),), histogram["buckets"]):
+        seen += count
+        if seen >= target:
+            return bound
+
+    return float("inf")
+
+def snapshot() -> dict:
+    """
+    Copy every metric, reading the tracked gauges.
+
+    Returns:
+        dict: 'counters', 'gauges' and 'histograms' keyed by name.
+    """
+    with lock:
+        readers = dict(tracked)
+
+    values = {name: fn() for name, fn in readers.items()}
+
+    with lock:
+        return {
+            "counters": dict(counters),
+            "gauges": {**gauges, **values},
+            "histograms": {name: {**h, "buckets": list(h["buckets"])} for name, h in histograms.items()},
+        }
+
+def summary_line(stage: str) -> str:
+    """
+    Format every metric as one line.
+
+    Args:
+        stage (str): The stage the line is reported for.
+
+    Returns:
+        str: The summary.
+    """
+    metrics = snapshot()
+    parts = [f"{name}={value:.10g}" for name, value in sorted(metrics["counters"].items())]
+    parts += [f"{name}={value:.10g}" for name, value in sorted(metrics["gauges"].items())]
+
+    for name, histogram in sorted(metrics["histograms"].items()):
+        mean = histogram["sum"] / max(histogram["count"], 1)
+        parts.append(f"{name}[n={histogram['count']} mean={mean * 1000:.1f}ms "
+                     f"p50<={quantile(histogram, 0.5) * 1000:g}ms p99<={quantile(histogram, 0.99) * 1000:g}ms]")
+
+    return f"[{stage}] {' '.join(parts)}"
+
+def prometheus_text(metrics: dict) -> str:
+    """
+    Format metrics in the Prometheus text exposition format.
+
+    Args:
+        metrics (dict): Metrics from `snapshot`.
+
+    Returns:
+        str: The exposition.
+    """
+    lines = list()
+
+    for name, value in sorted(metrics["counters"].items()):
+        lines += [f"# TYPE deer_{name} counter", f"deer_{name} {value:.10g}"]
+
+    for name, value in sorted(metrics["gauges"].items()):
+        lines += [f"# TYPE deer_{name} gauge", f"deer_{name} {value:.10g}"]
+
+    for name, histogram in sorted(metrics["histograms"].items()):
+        lines.append(f"# TYPE deer_{name} histogram")
+
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), histogram["buckets"]):
+            cumulative += count
+            lines.append(f'deer_{name}_bucket{{le="{"+Inf" if bound == float("inf") else f"{bound:g}"}"}} {cumulative}')
+
+        lines += [f"deer_{name}_sum {histogram['sum']:g}", f"deer_{name}_count {histogram['count']}"]
+
+    return "\n".join(lines) + "\n"
+
+def write_metrics(path: str = METRICS_FILE) -> None:
+    """
+    Atomically write every metric to a file, Prometheus text for .prom and JSON otherwise.
+
+    Args:
+        path (str): The metrics file.
+    """
+    metrics = snapshot()
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        if path.endswith(".prom"):
+            f.write(prometheus_text(metrics))
+        else:
+            json.dump({**metrics, "buckets": list(BUCKETS), "time": time.time()}, f, indent=4)
+
+    os.replace(tmp_path, path)
+
+def start_reporter(stage: str, interval: float = METRICS_INTERVAL):
+    """
+    Print a summary line, and write METRICS_FILE when set, every `interval` seconds on a background thread.
+
+    Args:
+        stage (str): The stage being reported, shown on each line.
+        interval (float): Seconds between reports.
+
+    Returns:
+        function: Stops the reporter after one final report.
+    """
+    stopped = threading.Event()
+
+    def report():
+        print(summary_line(stage))
+        if METRICS_FILE:
+            write_metrics(METRICS_FILE)
+
+    def run():
+        while not stopped.wait(interval):
+            report()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def stop():
+        stopped.set()
+        thread.join()
+        report()
+
+    return stop
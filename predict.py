@@ -0,0 +1,422 @@
+"""
+Batched offline prediction over processed images
+
+Streams processed images through a saved image-only or combined model in large batches,
+decoding the next batches on a thread pool while the current one is scored, and writes each
+image's deer probability back to the metadata store as 'deerProbability'.
+
+With --by-event, only one frame per trigger event (see events.py) is scored when the model
+is confident about it, and its probability is spread to the rest of the burst.
+
+With --cascade, the metadata-only model scores every image from its metadata first, and
+only images whose probability falls inside the uncertainty band are decoded and run through
+the image model. `helper/cascade_sweep.py` shows what each band costs in accuracy.
+
+With --new, images that already have a probability are left alone, so a scheduled run only
+scores what was collected since the last one.
+
+Usage:
+    python predict.py [--model MODEL] [--dir DIR] [--batch-size N] [--csv PATH] [--by-event]
+                      [--cascade [--metadata-model MODEL] [--band LOW HIGH]] [--new]
+"""
+
+import os
+import csv
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import metadata_store
+import image_store
+import features
+import events
+import metrics
+from dataset import decode_image
+
+MODEL_PATH = os.getenv("MODEL_PATH", os.path.join("models", "combined_model.keras"))
+METADATA_MODEL_PATH = os.getenv("METADATA_MODEL_PATH", os.path.join("models", "metadata_model.keras"))
+
+# Large batches amortize the per-call overhead that dominates small predictions
+BATCH_SIZE = int(os.getenv("PREDICT_BATCH_SIZE") or 256)
+
+# Decoded batches kept ready ahead of the model
+PREFETCH = 2
+
+# With --by-event, a representative frame this close to 0 or 1 decides its whole event
+EVENT_CONFIDENCE = float(os.getenv("EVENT_CONFIDENCE") or 0.9)
+
+# With --cascade, metadata model probabilities strictly between these go on to the image model
+CASCADE_LOW = float(os.getenv("CASCADE_LOW") or 0.2)
+CASCADE_HIGH = float(os.getenv("CASCADE_HIGH") or 0.8)
+
+def load_model(model_path: str = MODEL_PATH):
+    """
+    Load a model saved by the notebook.
+
+    Args:
+        model_path (str): Path to the saved Keras model.
+
+    Returns:
+        tf.keras.Model: The model.
+    """
+    import tensorflow as tf
+
+    return tf.keras.models.load_model(model_path)
+
+def is_combined(model) -> bool:
+    """
+    Check whether a model takes metadata features next to the image.
+
+    Args:
+        model (tf.keras.Model): The model.
+
+    Returns:
+        bool: True for the combined (image plus metadata) models.
+    """
+    return len(model.inputs) == 2
+
+def feature_spec_path(model_path: str) -> str:
+    """
+    Get the path of the feature spec saved next to a model.
+
+    Args:
+        model_path (str): Path to the saved model.
+
+    Returns:
+        str: The spec path.
+    """
+    return f'{os.path.splitext(model_path)[0]}.features.json'
+
+def load_spec(model_path: str) -> dict:
+    """
+    Load the feature spec saved next to a combined or metadata-only model.
+
+    Args:
+        model_path (str): Path to the saved model.
+
+    Returns:
+        dict: The spec from `features.fit_feature_spec`.
+
+    Raises:
+        FileNotFoundError: If the model was saved without its spec. Fitting a new one would
+            normalize the features differently than the model was trained with.
+    """
+    spec_path = feature_spec_path(model_path)
+    if not os.path.exists(spec_path):
+        raise FileNotFoundError(
+            f"No feature spec at {spec_path}. Save the spec {model_path} was trained with next to it, "
+            f"as the notebook does with features.save_feature_spec(spec, '{spec_path}')."
+        )
+
+    return features.load_feature_spec(spec_path)
+
+def find_images(conn, image_dir: str = None) -> list:
+    """
+    List the images to score.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store.
+        image_dir (str): Score every image in this directory, otherwise every stored image
+            the image store's index lists as processed.
+
+    Returns:
+        list: (filename, file path, record) tuples, record is None for unknown images.
+    """
+    if image_dir:
+        names = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+        return [
+            (os.path.splitext(name)[0], os.path.join(image_dir, name), metadata_store.get_image(conn, os.path.splitext(name)[0]))
+            for name in names
+        ]
+
+    paths = image_store.processed_paths(conn)
+
+    images = list()
+    for filename, record in metadata_store.iter_images(conn):
+        file_path = paths.get(record.get("fullFilename"))
+        if file_path is not None:
+            images.append((filename, file_path, record))
+
+    return images
+
+def iter_decoded(images: list, batch_size: int = BATCH_SIZE, workers: int = None, prefetch: int = PREFETCH):
+    """
+    Decode images in batches on a background thread, up to `prefetch` batches ahead.
+
+    Images that fail to decode are reported and left out of their batch.
+
+    Args:
+        images (list): (filename, file path, record) tuples from `find_images`.
+        batch_size (int): Images per batch.
+        workers (int): Decoding threads, defaults to the CPU count.
+        prefetch (int): Batches decoded ahead of the consumer.
+
+    Yields:
+        tuple: (items, pixels) with the decoded items and their (n, height, width, 3) float32 array.
+    """
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def decode(item):
+        try:
+            return decode_image(item[1])
+        except ValueError as e:
+            print(f"Skipping {item[0]}: {e}")
+            return None
+
+    def produce():
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            for start in range(0, len(images), batch_size):
+                if stop.is_set():
+                    break
+
+                chunk = images[start:start + batch_size]
+                decoded = [(item, img) for item, img in zip(chunk, executor.map(decode, chunk)) if img is not None]
+                if not decoded:
+                    continue
+
+                pixels = np.stack([img for _, img in decoded]).astype(np.float32)
+                pixels *= 1 / 255.0  # Normalize pixel values to [0, 1], as in training
+
+                batches.put(([item for item, _ in decoded], pixels))
+
+        batches.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while (batch := batches.get()) is not None:
+            yield batch
+
+    finally:
+        stop.set()
+
+        # Unblock the producer if the consumer stopped early
+        while producer.is_alive():
+            try:
+                batches.get_nowait()
+            except queue.Empty:
+                producer.join(0.01)
+
+def plan_events(conn, images: list) -> tuple:
+    """
+    Split images into the frames scored first, one per trigger event, and the rest.
+
+    Args:
+        conn (sqlite3.Connection): The metadata store, with events from `events.build_events`.
+        images (list): (filename, file path, record) tuples from `find_images`.
+
+    Returns:
+        tuple: (representatives, followers) where followers maps each representative's
+            filename to the other frames of its event. Images in no event represent themselves.
+    """
+    by_filename = {item[0]: item for item in images}
+    representatives = list()
+    followers = dict()
+    grouped = set()
+
+    for frames in metadata_store.load_events(conn).values():
+        frames = [filename for filename in frames if filename in by_filename]
+        if not frames:
+            continue
+
+        first = events.representative(frames)
+        representatives.append(by_filename[first])
+        followers[first] = [by_filename[filename] for filename in frames if filename != first]
+        grouped.update(frames)
+
+    representatives.extend(item for item in images if item[0] not in grouped)
+
+    return representatives, followers
+
+def gate_scores(images: list, gate_path: str = METADATA_MODEL_PATH):
+    """
+    Score images with the metadata-only model, encoding the features of their records in memory
+    so no image is decoded.
+
+    Args:
+        images (list): (filename, file path, record) tuples from `find_images`.
+        gate_path (str): Path to the saved metadata-only model.
+
+    Returns:
+        numpy.ndarray: The probability of each image, NaN where its metadata is incomplete.
+    """
+    gate = load_model(gate_path)
+    spec = load_spec(gate_path)
+
+    usable = np.array([record is not None and features.is_complete(record) for _, _, record in images], dtype=bool)
+    records = [item[2] for item, is_usable in zip(images, usable) if is_usable]
+
+    scores = np.full(len(images), np.nan)
+    if records:
+        scores[usable] = np.asarray(gate.predict_on_batch(features.encode_features(records, spec))).reshape(-1)
+
+    return scores
+
+def predict(model_path: str = MODEL_PATH, image_dir: str = None, batch_size: int = BATCH_SIZE, csv_path: str = None,
+            by_event: bool = False, cascade: bool = False, gate_path: str = METADATA_MODEL_PATH,
+            band: tuple = (CASCADE_LOW, CASCADE_HIGH), only_new: bool = False) -> int:
+    """
+    Score images with a saved model and record the deer probability of each.
+
+    With `by_event`, one representative frame per trigger event is scored first. When its
+    probability is outside the uncertain band (within EVENT_CONFIDENCE of 0 or 1) it is
+    spread to the event's other frames, which are only scored themselves otherwise. Each
+    frame also records the 'scoredFrame' its probability came from.
+
+    With `cascade`, the metadata-only model decides every image it scores at or below the
+    band's low end or at or above its high end, and only the rest are decoded and scored by
+    the image model. Each image also records whether it was 'scoredBy' the 'metadata' or 'image' model.
+
+    Args:
+        model_path (str): Path to the saved model.
+        image_dir (str): Score this directory instead of the stored images.
+        batch_size (int): Images per batch.
+        csv_path (str): Optionally also write 'filename,deerProbability' rows here.
+        by_event (bool): Score one frame per trigger event where it is confident.
+        cascade (bool): Gate the image model with the metadata-only model.
+        gate_path (str): Path to the saved metadata-only model.
+        band (tuple): (low, high) metadata model probabilities left to the image model.
+        only_new (bool): Only score stored images without a 'deerProbability' yet.
+
+    Returns:
+        int: The number of images scored by the image model.
+    """
+    conn = metadata_store.connect()
+    images = find_images(conn, image_dir)
+
+    if only_new:
+        # Images without a record can't keep a probability, so they would count as new on every run
+        images = [item for item in images if item[2] is not None and "deerProbability" not in item[2]]
+
+    # Loading the model imports TensorFlow, which an incremental run with nothing new shouldn't wait on
+    if not images:
+        print("No images to score.")
+        return 0
+
+    model = load_model(model_path)
+    combined = is_combined(model)
+    spec = load_spec(model_path) if combined else None
+
+    if combined:
+        # The combined model can't score images without complete metadata
+        skipped = sum(1 for _, _, record in images if record is None or not features.is_complete(record))
+        images = [item for item in images if item[2] is not None and features.is_complete(item[2])]
+        if skipped:
+            print(f"Skipping {skipped} images without complete metadata")
+
+    csv_file = open(csv_path, 'w', newline='') if csv_path else None
+    writer = csv.writer(csv_file) if csv_file else None
+    if writer:
+        writer.writerow(["filename", "deerProbability"])
+
+    def save(items, probabilities, sources, scored_by="image"):
+        with conn:
+            for (filename, _, record), probability, source in zip(items, probabilities, sources):
+                if record is not None:
+                    fields = {"deerProbability": round(float(probability), 6)}
+                    if by_event:
+                        fields["scoredFrame"] = source
+                    if cascade:
+                        fields["scoredBy"] = scored_by
+
+                    metadata_store.update_fields(conn, filename, fields)
+
+        if writer:
+            writer.writerows((item[0], f'{probability:.6f}') for item, probability in zip(items, probabilities))
+
+    if cascade:
+        low, high = band
+        scores = gate_scores(images, gate_path)
+
+        # NaN scores compare False, so images the metadata model can't score go on to the image model
+        decided = (scores <= low) | (scores >= high)
+        gated = [item for item, is_decided in zip(images, decided) if is_decided]
+        save(gated, scores[decided], [item[0] for item in gated], "metadata")
+        metrics.inc("cascade_gated_total", len(gated))
+
+        images = [item for item, is_decided in zip(images, decided) if not is_decided]
+        print(f"Metadata model decided {len(gated)} images, {len(images)} inside the band ({low:g}, {high:g}) go on to the image model")
+
+    if by_event:
+        todo, followers = plan_events(conn, images)
+        print(f"Scoring {len(todo)} event frames of {len(images)} images with {model_path} in batches of {batch_size}...")
+    else:
+        todo, followers = images, dict()
+        print(f"Scoring {len(images)} images with {model_path} in batches of {batch_size}...")
+
+    latencies = list()
+    scored = spread = 0
+    start = time.perf_counter()
+
+    try:
+        # Uncertain events get their other frames scored in a second pass
+        while todo:
+            uncertain = list()
+
+            for items, pixels in iter_decoded(todo, batch_size):
+                batch_start = time.perf_counter()
+
+                if combined:
+                    inputs = [pixels, features.encode_features([item[2] for item in items], spec)]
+                else:
+                    inputs = pixels
+
+                # predict_on_batch skips the per-call dataset setup of model.predict
+                probabilities = np.asarray(model.predict_on_batch(inputs)).reshape(-1)
+                latencies.append(time.perf_counter() - batch_start)
+
+                save(items, probabilities, [item[0] for item in items])
+
+                for item, probability in zip(items, probabilities):
+                    others = followers.get(item[0])
+                    if not others:
+                        continue
+
+                    if min(probability, 1 - probability) <= 1 - EVENT_CONFIDENCE:
+                        save(others, [probability] * len(others), [item[0]] * len(others))
+                        spread += len(others)
+                        metrics.inc("event_frames_spread_total", len(others))
+                    else:
+                        uncertain.extend(others)
+
+                scored += len(items)
+                print(f"Scored {scored}/{len(images)} images")
+
+            todo, followers = uncertain, dict()
+
+    finally:
+        if csv_file:
+            csv_file.close()
+
+    elapsed = time.perf_counter() - start
+
+    if latencies:
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"Scored {scored} images in {elapsed:.2f}s ({scored / max(elapsed, 1e-9):.1f} images/sec)")
+        print(f"Batch latency p50: {p50 * 1000:.1f}ms, p99: {p99 * 1000:.1f}ms over {len(latencies)} batches")
+        if by_event:
+            print(f"Spread confident event scores to {spread} more images")
+    else:
+        print("No images to score.")
+
+    return scored
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score processed images with a saved model.")
+    parser.add_argument("--model", default=MODEL_PATH, help="Saved Keras model (default: MODEL_PATH)")
+    parser.add_argument("--dir", help="Score every image in this directory instead of the metadata store's images")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Images per batch")
+    parser.add_argument("--csv", help="Also write the probabilities to this CSV file")
+    parser.add_argument("--by-event", action="store_true", help="Score one frame per trigger event where it is confident")
+    parser.add_argument("--cascade", action="store_true", help="Only run the image model on images the metadata-only model is unsure about")
+    parser.add_argument("--metadata-model", default=METADATA_MODEL_PATH, help="Saved metadata-only model (default: METADATA_MODEL_PATH)")
+    parser.add_argument("--band", nargs=2, type=float, default=(CASCADE_LOW, CASCADE_HIGH), metavar=("LOW", "HIGH"),
+                        help="Metadata model probabilities between these go on to the image model")
+    parser.add_argument("--new", action="store_true", help="Only score images that haven't been scored yet")
+    args = parser.parse_args()
+
+    predict(args.model, args.dir, args.batch_size, args.csv, args.by_event, args.cascade, args.metadata_model, tuple(args.band), args.new)
@@ -0,0 +1,213 @@
+"""
+Adaptive per-host concurrency for the camera API client
+
+Each host gets a limit on requests in flight that is tuned AIMD-style from what the host
+reports back: every successful request adds 1/limit (one more slot per round trip), a
+smoothed latency climbing well above the host's baseline shrinks the limit a little, and a
+429, 5xx or connection error halves it. A Retry-After header pauses every request to the host
+until it has passed. Decreases happen at most once per round trip, so one burst of errors
+counts once.
+
+MAX_IN_FLIGHT is where each host starts, MAX_CONCURRENCY the ceiling it can grow to.
+"""
+
+import os
+import re
+import time
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+import metrics
+
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT") or 5)
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY") or 32)
+
+# Multiplicative decreases on an error response and on a latency spike
+ERROR_DECREASE = 0.5
+LATENCY_DECREASE = 0.9
+
+# A smoothed latency this many times the host's baseline counts as congestion
+LATENCY_TOLERANCE = 3.0
+
+# How fast the latency baseline is allowed to creep up, per request
+BASELINE_DRIFT = 0.01
+
+# Weight of each request in the smoothed latency
+LATENCY_SMOOTHING = 0.1
+
+def is_throttle(status) -> bool:
+    """
+    Check whether a response status means the host is overloaded.
+
+    Args:
+        status (int): The HTTP status, None for a connection error.
+
+    Returns:
+        bool: True for connection errors, 429 and 5xx.
+    """
+    return status is None or status == 429 or status >= 500
+
+def retry_after(response) -> float:
+    """
+    Read a Retry-After header.
+
+    Args:
+        response (requests.Response): The response, may be None.
+
+    Returns:
+        float: Seconds to wait, None without a usable header.
+    """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the requests in flight to one host.
+
+    Args:
+        name (str): The host, used for the limit gauge.
+        initial (int): The starting limit.
+        maximum (int): The largest limit.
+    """
+
+    def __init__(self, name: str, initial: int = MAX_IN_FLIGHT, maximum: int = MAX_CONCURRENCY):
+        self.name = name
+        self.limit = float(max(min(initial, maximum), 1))
+        self.maximum = maximum
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.baseline = None
+        self.latency = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+        self.gauge = f'concurrency_limit_{re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")}'
+        metrics.set_gauge(self.gauge, self.limit)
+
+    def acquire(self) -> None:
+        """Wait for a free slot and for any Retry-After pause to pass."""
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+
+                self.condition.wait(wait if wait > 0 else None)
+
+    def cancel(self) -> None:
+        """Free a slot without judging the host, for a request that failed on our side."""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def release(self, seconds: float, status: int = 200, pause: float = None) -> None:
+        """
+        Free a slot and adjust the limit from the request's outcome.
+
+        Args:
+            seconds (float): How long the request took.
+            status (int): The response status, None for a connection error.
+            pause (float): A Retry-After the host sent, in seconds.
+        """
+        now = time.monotonic()
+
+        with self.condition:
+            self.in_flight -= 1
+
+            if pause:
+                self.paused_until = max(self.paused_until, now + pause)
+
+            # One decrease per round trip, the requests already in flight were sent at the old limit
+            can_decrease = now - self.last_decrease > (self.latency or seconds)
+
+            if is_throttle(status):
+                metrics.inc("requests_throttled_total")
+
+                if can_decrease:
+                    self.limit = max(self.limit * ERROR_DECREASE, 1.0)
+                    self.last_decrease = now
+
+            elif status < 400:
+                if self.baseline is None:
+                    self.baseline = self.latency = seconds
+
+                # The baseline is the lowest smoothed latency seen, so single fast requests don't set it
+                self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+                self.baseline = min(self.baseline * (1 + BASELINE_DRIFT), self.latency)
+
+                if self.latency > LATENCY_TOLERANCE * self.baseline:
+                    if can_decrease:
+                        self.limit = max(self.limit * LATENCY_DECREASE, 1.0)
+                        self.last_decrease = now
+
+                else:
+                    self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+            metrics.set_gauge(self.gauge, self.limit)
+            self.condition.notify_all()
+
+    @contextmanager
+    def request(self):
+        """
+        Hold a slot for one request, adjusting the limit from how it went.
+
+        Raises:
+            Exception: Whatever the request raised, after the outcome is recorded.
+        """
+        self.acquire()
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        except requests.RequestException as e:
+            response = getattr(e, "response", None)
+            self.release(time.perf_counter() - start, getattr(response, "status_code", None), retry_after(response))
+            raise
+
+        except IOError:
+            # A truncated or corrupted body, treated like a dropped connection
+            self.release(time.perf_counter() - start, None)
+            raise
+
+        except BaseException:
+            self.cancel()
+            raise
+
+        else:
+            self.release(time.perf_counter() - start)
+
+limiters = dict()
+limiters_lock = threading.Lock()
+
+def limiter_for(url: str) -> AdaptiveLimiter:
+    """
+    Get the limiter of a URL's host, creating it on first use.
+
+    Args:
+        url (str): The request URL.
+
+    Returns:
+        AdaptiveLimiter: The host's limiter.
+    """
+    host = urlparse(url).netloc
+
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = AdaptiveLimiter(host)
+
+        return limiters[host]
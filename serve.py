@@ -0,0 +1,261 @@
+"""
+Local HTTP service scoring images with a saved model, batching concurrent requests
+
+The model is loaded once. Requests that arrive together are grouped into one micro-batch,
+which is run as soon as it is full or its oldest request has waited MAX_WAIT_MS, so the
+per-call overhead of the model is shared by the whole batch.
+
+Endpoints:
+- POST /predict with a JSON body holding the base64 encoded 'image' plus the image's metadata
+  fields as returned by `image_collection.get_image_range` (moonPhase, pressure, temperature,
+  ...). Set 'raw' to true for an original camera image, which is cropped first.
+  Responds with {"deerProbability": p}.
+- GET /health
+
+Usage:
+    python serve.py [--model MODEL] [--port 8080] [--max-batch 32] [--max-wait-ms 10]
+"""
+
+import os
+import json
+import time
+import queue
+import base64
+import argparse
+import binascii
+import threading
+import numpy as np
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import features
+import predict
+from dataset import decode_image_bytes, prepare_image
+
+SERVE_PORT = int(os.getenv("SERVE_PORT") or 8080)
+
+# Largest micro-batch, and how long the first request of a batch waits for others to join
+MAX_BATCH = int(os.getenv("MAX_BATCH") or 32)
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS") or 10)
+
+# Seconds a request waits for its batch before giving up
+REQUEST_TIMEOUT = 30
+
+class MicroBatcher:
+    """
+    Groups submitted inputs into batches on a single worker thread that owns the model.
+    """
+
+    def __init__(self, model, max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS):
+        self.model = model
+        self.combined = predict.is_combined(model)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.pending = queue.Queue()
+        self.batches = 0
+        self.batched = 0
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, pixels, metadata=None) -> Future:
+        """
+        Queue one image for the next batch.
+
+        Args:
+            pixels (numpy.ndarray): The normalized (height, width, 3) float32 image.
+            metadata (numpy.ndarray): The image's encoded metadata features, for combined models.
+
+        Returns:
+            Future: Resolves to the deer probability.
+        """
+        future = Future()
+        self.pending.put((pixels, metadata, future))
+
+        return future
+
+    def next_batch(self) -> list:
+        """
+        Block for the next request, then collect more until the batch is full or the deadline passes.
+
+        Returns:
+            list: (pixels, metadata, future) tuples.
+        """
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+
+            try:
+                # Requests already queued join without waiting
+                batch.append(self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self) -> None:
+        """Score batches until the process exits."""
+        while True:
+            batch = self.next_batch()
+
+            try:
+                pixels = np.stack([item[0] for item in batch])
+                inputs = [pixels, np.stack([item[1] for item in batch])] if self.combined else pixels
+
+                probabilities = np.asarray(self.model.predict_on_batch(inputs)).reshape(-1)
+
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.batched += len(batch)
+
+            for (_, _, future), probability in zip(batch, probabilities):
+                future.set_result(float(probability))
+
+def parse_request(body: dict, spec: dict):
+    """
+    Decode the image and encode the metadata of a /predict request.
+
+    Args:
+        body (dict): The request body.
+        spec (dict): The feature spec for combined models, otherwise None.
+
+    Returns:
+        tuple: (pixels, metadata), metadata is None without a spec.
+
+    Raises:
+        ValueError: If the image or metadata is missing or invalid.
+    """
+    try:
+        data = base64.b64decode(body["image"], validate=True)
+    except (KeyError, TypeError, binascii.Error):
+        raise ValueError("Expected a base64 encoded 'image'.")
+
+    if body.get("raw"):
+        # Imported here so a service scoring processed images doesn't load the processing stack
+        import image_processing
+
+        img = prepare_image(image_processing.crop_image(*image_processing.decode_image(data)))
+    else:
+        img = decode_image_bytes(data)
+
+    pixels = img.astype(np.float32) * (1 / 255.0)  # Normalize pixel values to [0, 1], as in training
+
+    if spec is None:
+        return pixels, None
+
+    if not features.is_complete(body):
+        raise ValueError(f"Missing metadata, expected createdDateTime, {', '.join(features.NUMERIC_FIELDS + features.CATEGORICAL_FIELDS)}.")
+
+    return pixels, features.encode_features([body], spec)[0]
+
+def make_handler(batcher: MicroBatcher, spec: dict):
+    """
+    Create a request handler class scoring images through `batcher`.
+
+    Args:
+        batcher (MicroBatcher): The batcher owning the model.
+        spec (dict): The feature spec for combined models, otherwise None.
+
+    Returns:
+        type: A `BaseHTTPRequestHandler` subclass.
+    """
+    class PredictHandler(BaseHTTPRequestHandler):
+        # HTTP/1.1 so clients can keep connections alive
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self.send_json(404, {"error": "Not found"})
+                return
+
+            self.send_json(200, {
+                "status": "ok",
+                "batches": batcher.batches,
+                "meanBatchSize": round(batcher.batched / max(batcher.batches, 1), 2),
+            })
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_json(404, {"error": "Not found"})
+                return
+
+            length = int(self.headers.get("Content-Length") or 0)
+
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+                pixels, metadata = parse_request(body, spec)
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+
+            try:
+                probability = batcher.submit(pixels, metadata).result(timeout=REQUEST_TIMEOUT)
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+                return
+
+            self.send_json(200, {"deerProbability": probability})
+
+    return PredictHandler
+
+class PredictServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is expected, not worth a traceback
+        pass
+
+def start_server(model_path: str = predict.MODEL_PATH, port: int = SERVE_PORT, max_batch: int = MAX_BATCH,
+                 max_wait_ms: float = MAX_WAIT_MS, model=None):
+    """
+    Load the model and start the service on a background thread.
+
+    Args:
+        model_path (str): Path to the saved model.
+        port (int): The port to listen on, 0 picks a free one.
+        max_batch (int): Largest micro-batch.
+        max_wait_ms (float): Longest a request waits for its batch to fill.
+        model (tf.keras.Model): An already loaded model, to share one between servers.
+
+    Returns:
+        ThreadingHTTPServer: The running server, stop it with `shutdown()`.
+    """
+    model = model or predict.load_model(model_path)
+    spec = predict.load_spec(model_path) if predict.is_combined(model) else None
+
+    batcher = MicroBatcher(model, max_batch, max_wait_ms)
+    server = PredictServer(("127.0.0.1", port), make_handler(batcher, spec))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve deer predictions over HTTP.")
+    parser.add_argument("--model", default=predict.MODEL_PATH, help="Saved Keras model (default: MODEL_PATH)")
+    parser.add_argument("--port", type=int, default=SERVE_PORT)
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="Largest micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS, help="Longest a request waits for its batch to fill")
+    args = parser.parse_args()
+
+    server = start_server(args.model, args.port, args.max_batch, args.max_wait_ms)
+    print(f'Serving {args.model} on http://127.0.0.1:{server.server_address[1]} (batches of up to {args.max_batch}, {args.max_wait_ms}ms wait)')
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
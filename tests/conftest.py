@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "helper"))
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    Run the pipeline in an empty working directory.
+
+    Modules resolve their directories when imported, so the store's are pointed at the
+    workspace here. Relative paths such as the metadata store's follow the working directory.
+    """
+    import image_store
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(image_store, "IMAGE_DIR", str(tmp_path / "images"))
+    monkeypatch.setattr(image_store, "IMAGE_PROCESSED_DIR", str(tmp_path / "processed-images"))
+    monkeypatch.setattr(image_store, "PROCESSED_MANIFEST", str(tmp_path / "processed-manifest.json"))
+
+    return tmp_path
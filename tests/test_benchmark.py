@@ -0,0 +1,80 @@
+import json
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import benchmark
+from stub_api import start_stub_server
+
+@pytest.fixture
+def stub(request):
+    server = start_stub_server(7, width=32, height=24, **getattr(request, "param", {}))
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+
+    server.shutdown()
+    server.server_close()
+
+def post(url, body):
+    request = urllib.request.Request(url, json.dumps(body).encode(), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+def test_stub_pages_newest_first(stub):
+    assert post(f"{stub}/api/v3/file-manager/images/count", {}) == 7
+
+    page = post(f"{stub}/api/v4/file-manager/images", {"skipcount": 5, "takeCount": 5})["images"]
+    assert [image["filename"] for image in page] == ["STC_0000005", "STC_0000006"]
+    assert page[0]["createdDateTime"] > page[1]["createdDateTime"]
+
+    with urllib.request.urlopen(page[0]["imageUrl"], timeout=10) as response:
+        body = response.read()
+        assert body[:2] == b"\xff\xd8"
+        assert response.headers["ETag"] == f'"{hashlib.md5(body).hexdigest()}"'
+
+@pytest.mark.parametrize("stub", [{"throttle": {"capacity": 1, "retryAfter": 2, "latency": 0.2}}], indirect=True)
+def test_stub_throttles_beyond_capacity(stub):
+    statuses = list()
+
+    def fetch():
+        try:
+            with urllib.request.urlopen(f"{stub}/files/STC_0000000.JPG", timeout=10) as response:
+                statuses.append((response.status, None))
+        except urllib.error.HTTPError as e:
+            statuses.append((e.code, e.headers["Retry-After"]))
+
+    clients = [threading.Thread(target=fetch) for _ in range(3)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    assert sorted(statuses, key=str) == [(200, None), (429, "2"), (429, "2")]
+
+def test_compare_flags_regressions(capsys):
+    def run(commit, collect, events):
+        return {"commit": commit, "sizes": {"1000": {
+            "collect": {"seconds": 1, "items": 1000, "perSecond": collect},
+            "events": {"seconds": 1, "items": 1000, "perSecond": events},
+        }}}
+
+    baseline = run("abc1234", 100.0, 100.0)
+
+    assert benchmark.compare(run("def5678", 85.0, 150.0), baseline, tolerance=0.2)
+    assert not benchmark.compare(run("def5678", 75.0, 150.0), baseline, tolerance=0.2)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [line for line in lines if "REGRESSION" in line] == [lines[-2]]
+    assert "collect" in lines[-2]
+
+    # Stages missing from the baseline aren't compared
+    assert benchmark.compare(run("def5678", 75.0, 150.0), {"commit": "old", "sizes": {}}, tolerance=0.2)
+
+def test_timed_counts_items_after_the_stage():
+    done = list()
+    result = benchmark.timed(lambda: done.extend(range(5)), lambda: len(done))
+
+    assert result["items"] == 5
+    assert result["perSecond"] == pytest.approx(5 / result["seconds"])
@@ -0,0 +1,173 @@
+import os
+import hashlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import metadata_store
+import image_store
+import dataset
+
+def store_image(conn, name, color=None, tags=None, created="2024-11-02T04:30:00Z"):
+    """Store a record and a processed image for it, an unreadable one without a color."""
+    key = hashlib.sha1(name.encode()).hexdigest()
+    path = image_store.processed_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if color is None:
+        with open(path, 'wb') as f:
+            f.write(b"truncated")
+    else:
+        Image.new("RGB", (32, 24), color).save(path)
+
+    with conn:
+        metadata_store.add_images(conn, {name: {"fullFilename": f'{name}.jpg', "createdDateTime": created, "newTags": tags}})
+        image_store.index_files(conn, {f'{name}.jpg': (key, None, os.path.getsize(path))})
+        image_store.set_processed(conn, [key], image_store.SIZE_TAG)
+
+def test_corrupt_image_left_out(workspace, monkeypatch):
+    monkeypatch.setattr(dataset, "SHARD_SIZE", 2)
+    conn = metadata_store.connect("images.db")
+
+    store_image(conn, "a", (255, 0, 0), ["deer"])
+    store_image(conn, "b", None, ["deer"])
+    store_image(conn, "c", (0, 0, 255), ["not-deer"])
+
+    assert dataset.build_dataset(str(workspace / "dataset")) == 2
+
+    ds = dataset.PackedDataset(str(workspace / "dataset"))
+    assert ds.filenames.tolist() == ["a", "c"]
+    assert ds.labels.tolist() == [1, 0]
+
+    # Packed as RGB, the way Keras loads images
+    assert np.argmax(ds.image(0)[0, 0]) == 0
+    assert np.argmax(ds.image(1)[0, 0]) == 2
+
+    # The corrupt image is tried again once it is fixed
+    store_image(conn, "b", (0, 255, 0), ["deer"])
+    assert dataset.build_dataset(str(workspace / "dataset")) == 3
+
+def test_rebuild_decodes_only_new_images(workspace, monkeypatch):
+    monkeypatch.setattr(dataset, "SHARD_SIZE", 2)
+    conn = metadata_store.connect("images.db")
+    dataset_dir = str(workspace / "dataset")
+
+    for name in ["a", "b", "c"]:
+        store_image(conn, name, (255, 0, 0), ["deer"])
+    assert dataset.build_dataset(dataset_dir) == 3
+
+    decoded = list()
+    decode_image = dataset.decode_image
+
+    def recording_decode_image(file_path):
+        decoded.append(file_path)
+        return decode_image(file_path)
+
+    monkeypatch.setattr(dataset, "decode_image", recording_decode_image)
+    first_shard = os.path.getmtime(os.path.join(dataset_dir, "images-00000.npy"))
+
+    store_image(conn, "d", (0, 0, 255), ["not-deer"])
+    assert dataset.build_dataset(dataset_dir) == 4
+
+    # Only the last, partly filled shard is rewritten
+    assert decoded == [image_store.processed_path(hashlib.sha1(b"d").hexdigest())]
+    assert os.path.getmtime(os.path.join(dataset_dir, "images-00000.npy")) == first_shard
+
+    # Relabeling rewrites the labels, not the images
+    with conn:
+        metadata_store.set_tags(conn, "a", ["not-deer"])
+    assert dataset.build_dataset(dataset_dir) == 4
+    assert len(decoded) == 1
+
+    ds = dataset.load_dataset(dataset_dir)
+    assert ds.filenames.tolist() == ["a", "b", "c", "d"]
+    assert ds.labels.tolist() == [0, 1, 1, 0]
+    assert [shard.shape[0] for shard in ds.shards] == [2, 2]
+
+def test_modified_image_repacked(workspace, monkeypatch):
+    monkeypatch.setattr(dataset, "SHARD_SIZE", 2)
+    conn = metadata_store.connect("images.db")
+    dataset_dir = str(workspace / "dataset")
+
+    for name in ["a", "b", "c", "d", "e"]:
+        store_image(conn, name, (255, 0, 0), ["deer"])
+    dataset.build_dataset(dataset_dir)
+
+    store_image(conn, "b", (0, 0, 255), ["deer"])
+    assert dataset.build_dataset(dataset_dir) == 5
+
+    # The old row stays in its shard, marked invalid, and the new one is appended
+    assert len(dataset.load_manifest(dataset_dir)["rows"]) == 6
+
+    ds = dataset.load_dataset(dataset_dir)
+    assert ds.filenames.tolist() == ["a", "c", "d", "e", "b"]
+    assert np.argmax(ds.image(4)[0, 0]) == 2
+
+    # Beyond MAX_STALE_FRACTION of stale rows, the dataset is packed again from scratch
+    store_image(conn, "c", (0, 0, 255), ["deer"])
+    store_image(conn, "d", (0, 0, 255), ["deer"])
+    assert dataset.build_dataset(dataset_dir) == 5
+
+    assert [row[0] for row in dataset.load_manifest(dataset_dir)["rows"]] == ["a", "b", "c", "d", "e"]
+    assert sorted(os.listdir(dataset_dir)) == [
+        "created.npy", "images-00000.npy", "images-00001.npy", "images-00002.npy", "labels.npy", "manifest.json", "valid.npy",
+    ]
+
+@pytest.fixture
+def packed(workspace, monkeypatch):
+    """A packed dataset of seven labeled images over three shards, each a different shade of red."""
+    monkeypatch.setattr(dataset, "SHARD_SIZE", 3)
+    conn = metadata_store.connect("images.db")
+
+    for i in range(7):
+        store_image(conn, f"img{i}", (40 * i, 0, 0), ["deer" if i % 2 else "not-deer"])
+    dataset.build_dataset(str(workspace / "dataset"))
+
+    return dataset.load_dataset(str(workspace / "dataset"))
+
+def test_train_val_split_matches_train_test_split():
+    model_selection = pytest.importorskip("sklearn.model_selection")
+
+    for count in [5, 10, 37]:
+        train, val = model_selection.train_test_split(np.arange(count), test_size=0.2, random_state=42)
+        ours = dataset.train_val_split(count)
+
+        assert ours[0].tolist() == train.tolist()
+        assert ours[1].tolist() == val.tolist()
+
+def test_batches_stream_every_row_normalized(packed):
+    indices = np.array([6, 0, 3, 4, 1])
+    batches = list(dataset.iter_batches(packed, indices, batch_size=2, workers=2, prefetch=1))
+
+    assert [len(labels) for _, labels in batches] == [2, 2, 1]
+
+    images = np.concatenate([images for images, _ in batches])
+    assert images.dtype == np.float32
+    np.testing.assert_allclose(images[:, 0, 0, 0], [240 / 255, 0, 120 / 255, 160 / 255, 40 / 255], atol=1 / 255)
+    assert np.concatenate([labels for _, labels in batches]).tolist() == [0, 0, 1, 0, 1]
+
+def test_shuffled_batches_reproducible_per_seed(packed):
+    def epoch(seed):
+        return [
+            (round(float(pixel) * 255 / 40), label)
+            for images, labels in dataset.iter_batches(packed, np.arange(7), batch_size=3, shuffle=True, seed=seed, chunk_size=2)
+            for pixel, label in zip(images[:, 0, 0, 0], labels)
+        ]
+
+    first = epoch(0)
+
+    assert sorted(first) == [(i, i % 2) for i in range(7)]
+    assert epoch(0) == first
+    assert epoch(1) != first
+
+def test_batches_with_metadata_and_early_stop(packed):
+    metadata = np.arange(14, dtype=np.float32).reshape(7, 2)
+    batches = dataset.iter_batches(packed, np.arange(7), metadata=metadata, batch_size=2, prefetch=1)
+
+    (images, batch_metadata), labels = next(batches)
+    assert images.shape[0] == 2
+    assert batch_metadata.tolist() == [[0, 1], [2, 3]]
+
+    # Stopping early doesn't leave the producer blocked on a full queue
+    batches.close()
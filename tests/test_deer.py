@@ -0,0 +1,52 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+import deer
+import startup_benchmark
+
+@pytest.fixture
+def env(workspace):
+    """The environment of a fresh run in the empty workspace, as cron starts it."""
+    return dict(
+        os.environ,
+        PYTHONPATH=startup_benchmark.REPO_DIR,
+        IMAGES_DB="images.db",
+        IMAGES_JSON="images.json",
+        IMAGE_PROCESSED_DIR="processed-images",
+    )
+
+@pytest.mark.parametrize("args, deferred", [
+    (["--help"], {"cv2", "tensorflow"}),
+    (["process"], {"cv2", "tensorflow"}),
+    (["dedup"], {"cv2", "tensorflow"}),
+    (["predict", "--new"], {"tensorflow"}),
+])
+def test_nothing_new_skips_heavy_imports(workspace, env, args, deferred):
+    result = subprocess.run([sys.executable, deer.__file__, *args], cwd=workspace, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    assert not deferred & startup_benchmark.imported_modules([deer.__file__, *args], str(workspace), env)
+
+def test_options_passed_to_scripts(monkeypatch):
+    runs = list()
+    monkeypatch.setattr(deer, "run_script", lambda path, args: runs.append((os.path.basename(path), args)))
+
+    deer.main(["predict", "--new", "--batch-size", "8"])
+    deer.main(["bench", "--startup", "--repeats", "2"])
+    deer.main(["export", "models", "a.keras"])
+
+    assert runs == [
+        ("predict.py", ["--new", "--batch-size", "8"]),
+        ("startup_benchmark.py", ["--repeats", "2"]),
+        ("export_model.py", ["export", "a.keras"]),
+    ]
+
+def test_unknown_options_rejected(capsys):
+    with pytest.raises(SystemExit) as e:
+        deer.main(["process", "--fast"])
+
+    assert e.value.code == 2
+    assert "unrecognized arguments: --fast" in capsys.readouterr().err
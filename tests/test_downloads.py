@@ -0,0 +1,88 @@
+import os
+import base64
+import hashlib
+
+import pytest
+
+import image_collection
+import image_store
+
+class FakeResponse:
+    """A streamed image response, optionally cut short or with the wrong checksum headers."""
+
+    def __init__(self, body, headers=None, sent=None):
+        self.body = body
+        self.headers = {"Content-Length": str(len(body)), **(headers or {})}
+        self.sent = body if sent is None else sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.sent), chunk_size):
+            yield self.sent[i:i + chunk_size]
+
+@pytest.fixture
+def downloads(workspace, monkeypatch):
+    """Serve each download from a list of responses, the last one repeating."""
+    responses = list()
+
+    def get(url, stream, timeout):
+        return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    monkeypatch.setattr(image_collection.session, "get", get)
+    monkeypatch.setattr(image_collection, "IMAGE_DIR", image_store.IMAGE_DIR)
+    monkeypatch.setattr(image_collection, "DOWNLOAD_CHUNK", 4)
+    monkeypatch.setattr(image_collection, "DOWNLOAD_RETRIES", 0)
+    monkeypatch.setattr(image_collection, "DOWNLOAD_BACKOFF", 0)
+    os.makedirs(image_store.IMAGE_DIR)
+
+    return responses
+
+def stored_files():
+    return sorted(name for _, _, names in os.walk(image_store.IMAGE_DIR) for name in names)
+
+def test_download_stored_by_content(downloads):
+    body = b"a complete jpeg body"
+    downloads.append(FakeResponse(body, {"ETag": f'"{hashlib.md5(body).hexdigest()}"'}))
+
+    key, size = image_collection.get_image("http://camera.test/a.JPG", "a.JPG")
+
+    assert (key, size) == (hashlib.sha1(body).hexdigest(), len(body))
+    with open(image_store.raw_path(key), 'rb') as f:
+        assert f.read() == body
+    assert stored_files() == [os.path.basename(image_store.raw_path(key))]
+
+def test_truncated_download_leaves_nothing(downloads):
+    body = b"a complete jpeg body"
+    downloads.append(FakeResponse(body, sent=body[:10]))
+
+    with pytest.raises(IOError, match="Truncated"):
+        image_collection.get_image("http://camera.test/a.JPG", "a.JPG")
+
+    assert stored_files() == []
+
+def test_checksum_mismatch_leaves_nothing(downloads):
+    body = b"a complete jpeg body"
+    downloads.append(FakeResponse(body, {"Content-MD5": base64.b64encode(hashlib.md5(b"other").digest()).decode()}))
+
+    with pytest.raises(IOError, match="Checksum"):
+        image_collection.get_image("http://camera.test/a.JPG", "a.JPG")
+
+    assert stored_files() == []
+
+def test_failed_attempt_retried(downloads, monkeypatch):
+    monkeypatch.setattr(image_collection, "DOWNLOAD_RETRIES", 1)
+    body = b"a complete jpeg body"
+    downloads.extend([FakeResponse(body, sent=body[:10]), FakeResponse(body)])
+
+    key, _ = image_collection.get_image("http://camera.test/a.JPG", "a.JPG")
+
+    assert key == hashlib.sha1(body).hexdigest()
+    assert stored_files() == [os.path.basename(image_store.raw_path(key))]
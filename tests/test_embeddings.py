@@ -0,0 +1,117 @@
+import os
+import hashlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import metadata_store
+import image_store
+import dataset
+import embeddings
+
+class MeanBackbone:
+    """Stands in for ResNet50, embedding each image as its mean color and counting the images it sees."""
+
+    def __init__(self):
+        self.seen = 0
+
+    def predict_on_batch(self, batch):
+        self.seen += len(batch)
+        return batch.mean(axis=(1, 2))
+
+def store_image(conn, name, color):
+    """Store a record and a processed image of a single color for it."""
+    key = hashlib.sha1(name.encode()).hexdigest()
+    path = image_store.processed_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new("RGB", (32, 24), color).save(path)
+
+    with conn:
+        metadata_store.add_images(conn, {name: {"fullFilename": f'{name}.jpg', "newTags": ["deer"]}})
+        image_store.index_files(conn, {f'{name}.jpg': (key, None, os.path.getsize(path))})
+        image_store.set_processed(conn, [key], image_store.SIZE_TAG)
+
+@pytest.fixture
+def backbone(workspace, monkeypatch):
+    model = MeanBackbone()
+    monkeypatch.setattr(embeddings, "load_backbone", lambda: model)
+    monkeypatch.setattr(dataset, "IMAGE_SIZE", (32, 24))
+
+    return model
+
+def test_embeddings_computed_once_per_content(workspace, backbone, monkeypatch):
+    monkeypatch.setattr(embeddings, "SHARD_SIZE", 2)
+    conn = metadata_store.connect("images.db")
+    dataset_dir = str(workspace / "dataset")
+    embeddings_dir = str(workspace / "embeddings")
+
+    # b is a copy of a, under another name
+    for name, color in [("a", (200, 0, 0)), ("b", (200, 0, 0)), ("c", (0, 100, 0)), ("d", (0, 0, 50))]:
+        store_image(conn, name, color)
+    dataset.build_dataset(dataset_dir)
+
+    assert embeddings.build_embeddings(embeddings_dir, dataset_dir, batch_size=1) == 3
+    assert backbone.seen == 3
+    assert sorted(os.listdir(embeddings.cache_dir(embeddings_dir))) == [
+        "keys-00000.npy", "keys-00001.npy", "sources.json", "vectors-00000.npy", "vectors-00001.npy",
+    ]
+
+    vectors = embeddings.load_embeddings(["d", "a", "b", "c"], embeddings_dir)
+    assert vectors.dtype == np.float32
+    np.testing.assert_allclose(vectors, [[0, 0, 50], [200, 0, 0], [200, 0, 0], [0, 100, 0]], atol=1)
+
+    # Nothing new, nothing computed
+    assert embeddings.build_embeddings(embeddings_dir, dataset_dir) == 0
+    assert backbone.seen == 3
+
+    # A new image only adds its own embedding
+    store_image(conn, "e", (0, 0, 150))
+    dataset.build_dataset(dataset_dir)
+
+    assert embeddings.build_embeddings(embeddings_dir, dataset_dir) == 1
+    assert backbone.seen == 4
+    np.testing.assert_allclose(embeddings.load_embeddings(["e"], embeddings_dir), [[0, 0, 150]], atol=1)
+
+def test_unchanged_sources_not_hashed_again(workspace, backbone, monkeypatch):
+    conn = metadata_store.connect("images.db")
+    dataset_dir = str(workspace / "dataset")
+    embeddings_dir = str(workspace / "embeddings")
+
+    store_image(conn, "a", (200, 0, 0))
+    store_image(conn, "b", (0, 100, 0))
+    dataset.build_dataset(dataset_dir)
+    embeddings.build_embeddings(embeddings_dir, dataset_dir)
+
+    hashed = list()
+    content_key = embeddings.content_key
+
+    def recording_content_key(pixels):
+        hashed.append(pixels[0, 0].tolist())
+        return content_key(pixels)
+
+    monkeypatch.setattr(embeddings, "content_key", recording_content_key)
+
+    # Only the image whose source changed is hashed, and its new content embedded
+    store_image(conn, "b", (0, 0, 50))
+    dataset.build_dataset(dataset_dir)
+
+    assert embeddings.build_embeddings(embeddings_dir, dataset_dir) == 1
+    assert hashed == [[0, 0, 50]]
+    np.testing.assert_allclose(embeddings.load_embeddings(["a", "b"], embeddings_dir), [[200, 0, 0], [0, 0, 50]], atol=1)
+
+def test_missing_embeddings_raise(workspace, backbone):
+    conn = metadata_store.connect("images.db")
+    dataset_dir = str(workspace / "dataset")
+    embeddings_dir = str(workspace / "embeddings")
+
+    store_image(conn, "a", (200, 0, 0))
+    dataset.build_dataset(dataset_dir)
+
+    with pytest.raises(ValueError, match="1 images have no cached embedding"):
+        embeddings.load_embeddings(["a"], embeddings_dir)
+
+    embeddings.build_embeddings(embeddings_dir, dataset_dir)
+
+    with pytest.raises(ValueError, match="1 images have no cached embedding"):
+        embeddings.load_embeddings(["a", "unknown"], embeddings_dir)
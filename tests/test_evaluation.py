@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import evaluation
+
+def test_cascade_sweep_tied_scores():
+    y_true = np.array([1, 0, 1, 0])
+    gate_score = np.array([0.5, 0.5, 0.5, 0.9])
+    model_score = np.array([0.9, 0.1, 0.9, 0.1])
+    thresholds = np.array([0.3, 0.5, 0.7])
+
+    sweep = evaluation.cascade_sweep(y_true, gate_score, model_score, thresholds, thresholds)
+
+    # Bands of zero width would count the tied images as both auto-negative and auto-positive
+    assert np.all(sweep["low"] < sweep["high"])
+    assert np.all((sweep["decoded"] >= 0) & (sweep["decoded"] <= 1))
+    assert np.all((sweep["accuracy"] >= 0) & (sweep["accuracy"] <= 1))
+
+    # Scores at the low end go to the gate, which calls all three tied images not deer
+    at = (sweep["low"] == 0.5) & (sweep["high"] == 0.7)
+    assert sweep["decoded"][at] == [0]
+    assert sweep["accuracy"][at] == [0.25]
+
+    at = (sweep["low"] == 0.3) & (sweep["high"] == 0.7)
+    assert sweep["decoded"][at] == [0.75]
+    assert sweep["accuracy"][at] == [0.75]
+
+def scored(count=500, seed=0):
+    """Labels and scores of a decent model, rounded so many scores tie."""
+    rng = np.random.default_rng(seed)
+    y_true = rng.integers(0, 2, count)
+    y_score = np.clip(np.round(0.35 * y_true + rng.uniform(0, 0.65, count), 2), 0, 1)
+
+    return y_true, y_score
+
+def test_evaluate_matches_sklearn():
+    metrics = pytest.importorskip("sklearn.metrics")
+    y_true, y_score = scored()
+    y_pred = y_score > 0.5
+
+    result = evaluation.evaluate(y_true, y_score)
+
+    assert result["confusion"] == metrics.confusion_matrix(y_true, y_pred).tolist()
+    assert result["accuracy"] == pytest.approx(metrics.accuracy_score(y_true, y_pred))
+    assert result["precision"] == pytest.approx(metrics.precision_score(y_true, y_pred))
+    assert result["recall"] == pytest.approx(metrics.recall_score(y_true, y_pred))
+    assert result["f1"] == pytest.approx(metrics.f1_score(y_true, y_pred))
+    assert result["auc"] == pytest.approx(metrics.roc_auc_score(y_true, y_score))
+
+def test_undefined_metrics_are_zero():
+    result = evaluation.evaluate([0, 0, 1], [0.1, 0.2, 0.3])
+
+    assert (result["precision"], result["recall"], result["f1"]) == (0, 0, 0)
+    assert np.isnan(evaluation.evaluate([1, 1], [0.2, 0.9])["auc"])
+
+def test_threshold_sweep_matches_each_threshold():
+    y_true, y_score = scored(200)
+    sweep = evaluation.threshold_sweep(y_true, y_score)
+
+    assert sweep["threshold"].tolist() == sorted(set(y_score.tolist()), reverse=True)
+
+    for i, threshold in enumerate(sweep["threshold"]):
+        (tn, fp), (fn, tp) = evaluation.confusion_matrix(y_true, y_score >= threshold)
+        assert (sweep["tn"][i], sweep["fp"][i], sweep["fn"][i], sweep["tp"][i]) == (tn, fp, fn, tp)
+
+    best = evaluation.best_threshold(sweep)
+    assert sweep["f1"][sweep["threshold"] == best][0] == sweep["f1"].max()
+
+def test_cascade_sweep_matches_each_band():
+    y_true, gate_score = scored(300, seed=1)
+    _, model_score = scored(300, seed=2)
+    bands = np.round(np.linspace(0, 1, 11), 2)
+
+    sweep = evaluation.cascade_sweep(y_true, gate_score, model_score, bands, bands)
+
+    for low, high, accuracy, decoded in zip(sweep["low"], sweep["high"], sweep["accuracy"], sweep["decoded"]):
+        in_band = (gate_score > low) & (gate_score < high)
+        prediction = np.where(in_band, model_score, gate_score) > 0.5
+
+        assert accuracy == pytest.approx(np.mean(prediction == y_true))
+        assert decoded == pytest.approx(np.mean(in_band))
+
+def test_slices_break_down_every_group():
+    y_true = np.array([1, 0, 1, 1, 0, 0])
+    y_score = np.array([0.9, 0.8, 0.2, 0.7, 0.1, 0.6])
+    codes = np.array([0, 0, 1, 1, -1, 1])
+
+    result = evaluation.evaluate(y_true, y_score, {"time": (codes, ["day", "night"])})
+    rows = {row["slice"]: row for row in result["slices"]["time"]}
+
+    assert list(rows) == ["day", "night", "unknown"]
+    assert [rows["day"][k] for k in ("count", "tn", "fp", "fn", "tp")] == [2, 0, 1, 0, 1]
+    assert [rows["night"][k] for k in ("count", "tn", "fp", "fn", "tp")] == [3, 0, 1, 1, 1]
+    assert rows["night"]["auc"] == pytest.approx(0.5)
+    assert rows["unknown"]["accuracy"] == 1
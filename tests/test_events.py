@@ -0,0 +1,121 @@
+import os
+import hashlib
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import metadata_store
+import image_store
+import image_dedup
+import metrics
+import events
+
+def store_frame(conn, name, pixels, created):
+    """Index a processed camera frame, returning its content key."""
+    key = hashlib.sha1(name.encode()).hexdigest()
+    path = image_store.processed_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(pixels).save(path)
+
+    with conn:
+        metadata_store.add_images(conn, {
+            os.path.splitext(name)[0]: {"fullFilename": name, "createdDateTime": created, "cameraId": "cam"},
+        })
+        image_store.index_files(conn, {name: (key, None, os.path.getsize(path))})
+        image_store.set_processed(conn, [key], image_store.SIZE_TAG)
+
+    return key
+
+def test_event_hashes_saved_and_still_deduplicated(workspace, monkeypatch):
+    conn = metadata_store.connect("images.db")
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)
+
+    store_frame(conn, "a.jpg", pixels, "2024-11-02T04:30:00Z")
+    duplicate = store_frame(conn, "b.jpg", pixels, "2024-11-02T04:30:05Z")
+
+    assert events.build_events(conn) == 1
+    assert set(image_store.name_hashes(conn)) == {"a.jpg", "b.jpg"}
+
+    # Later builds, and duplicate removal, reuse the saved hashes
+    def phash(path):
+        raise AssertionError("Saved hashes shouldn't be computed again")
+
+    monkeypatch.setattr(image_dedup, "phash", phash)
+    assert events.build_events(conn) == 1
+
+    # Hashed by events.py, but not checked for duplicates yet
+    assert image_store.count_unchecked(conn) == 2
+    assert image_dedup.remove_duplicates() == [("b.jpg", "a.jpg")]
+    assert image_store.count_unchecked(conn) == 0
+    assert not os.path.exists(image_store.processed_path(duplicate))
+
+def test_unreadable_frames_are_events_of_their_own(workspace, monkeypatch):
+    conn = metadata_store.connect("images.db")
+    pixels = np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+
+    for i in range(4):
+        store_frame(conn, f"{i}.jpg", pixels, f"2024-11-02T04:30:0{i}Z")
+
+    missing = store_frame(conn, "missing.jpg", pixels, "2024-11-02T04:30:05Z")
+    os.remove(image_store.processed_path(missing))
+
+    phash = image_dedup.phash
+    errors = {"1.jpg": OSError("Input/output error"), "2.jpg": cv2.error("Corrupt JPEG data")}
+
+    def failing_phash(path):
+        for name, error in errors.items():
+            if path == image_store.processed_path(hashlib.sha1(name.encode()).hexdigest()):
+                raise error
+        return phash(path)
+
+    monkeypatch.setattr(image_dedup, "phash", failing_phash)
+    failures = metrics.snapshot()["counters"].get("event_hash_failures_total", 0)
+
+    # 0.jpg and 3.jpg are 3 seconds apart, close enough to join one event
+    assert events.build_events(conn) == 4
+    assert metrics.snapshot()["counters"]["event_hash_failures_total"] - failures == 3
+    assert set(image_store.name_hashes(conn)) == {"0.jpg", "3.jpg"}
+
+def test_frames_grouped_by_time_and_scene():
+    scene, other = 0, (1 << 40) - 1
+    frames = [
+        # Out of order, and interleaved with another camera
+        ("a2", 105, "cam1", scene ^ 0b11),
+        ("a1", 100, "cam1", scene),
+        ("b1", 101, "cam2", scene),
+        ("a3", 112, "cam1", scene),
+        # Too long after a3
+        ("a4", 123, "cam1", scene),
+        # Seconds later, but a different scene
+        ("a5", 125, "cam1", other),
+        ("b2", 104, "cam2", scene),
+        # No capture time or no hash, events of their own
+        ("c1", -1, "cam1", scene),
+        ("c2", 106, "cam1", None),
+    ]
+
+    assert sorted(events.group_frames(frames, gap=10, max_distance=16)) == sorted([
+        ["a1", "a2", "a3"], ["a4"], ["a5"], ["b1", "b2"], ["c1"], ["c2"],
+    ])
+
+def test_long_bursts_split():
+    frames = [(f"{i}", i, "cam", 0) for i in range(7)]
+
+    assert events.group_frames(frames, max_frames=3) == [["0", "1", "2"], ["3", "4", "5"], ["6"]]
+    assert events.representative(["0", "1", "2"]) == "1"
+    assert events.representative(["3", "4"]) == "4"
+
+def test_events_saved_in_capture_order(workspace):
+    conn = metadata_store.connect("images.db")
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)
+
+    store_frame(conn, "b.jpg", pixels, "2024-11-02T04:30:04Z")
+    store_frame(conn, "a.jpg", pixels, "2024-11-02T04:30:00Z")
+    store_frame(conn, "c.jpg", rng.integers(0, 256, (64, 64, 3), dtype=np.uint8), "2024-11-02T04:30:06Z")
+    store_frame(conn, "d.jpg", pixels, "2024-11-02T05:00:00Z")
+
+    assert events.build_events(conn) == 3
+    assert sorted(metadata_store.load_events(conn).values()) == [["a", "b"], ["c"], ["d"]]
@@ -0,0 +1,100 @@
+import os
+import hashlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import metadata_store
+import image_store
+import features
+import export_model
+
+RECORD = {
+    "createdDateTime": "2024-11-02T04:30:00Z",
+    "pressure": 30.1,
+    "temperature": 41,
+    "wind": 5,
+    "windDirection": 180,
+    "moonPhase": "Waxing Gibbous",
+    "pressureTendency": "Rising",
+}
+
+def store_image(conn, name, record):
+    """Store a record and a gray processed image for it."""
+    key = hashlib.sha1(name.encode()).hexdigest()
+    path = image_store.processed_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new("RGB", (32, 24), (51, 51, 51)).save(path, format="PNG")
+
+    with conn:
+        metadata_store.add_images(conn, {name: {"fullFilename": f'{name}.jpg', **record}})
+        image_store.index_files(conn, {f'{name}.jpg': (key, None, os.path.getsize(path))})
+        image_store.set_processed(conn, [key], image_store.SIZE_TAG)
+
+@pytest.mark.parametrize("quantization", export_model.QUANTIZATIONS)
+def test_variants_named_after_their_model(quantization):
+    model_path = os.path.join("models", "combined_model.keras")
+    path = export_model.tflite_path(model_path, quantization)
+
+    assert path == os.path.join("models", f"combined_model.{quantization}.tflite")
+    assert export_model.source_model(path) == model_path
+    assert export_model.source_model(model_path) == model_path
+
+def test_calibration_samples_complete_images(workspace):
+    conn = metadata_store.connect("images.db")
+    for i in range(6):
+        store_image(conn, f"img{i}", RECORD if i % 3 else {**RECORD, "pressure": None})
+
+    spec = features.fit_feature_spec([RECORD])
+    inputs = export_model.calibration_inputs(conn, spec, samples=3)
+
+    assert len(inputs) == 3
+    for pixels, metadata in inputs:
+        assert pixels.dtype == np.float32
+        np.testing.assert_allclose(pixels[0, 0], [0.2, 0.2, 0.2], atol=1 / 255)
+        np.testing.assert_array_equal(metadata, features.encode_features([RECORD], spec)[0])
+
+    # Images only, and the same sample every time
+    assert len(export_model.calibration_inputs(conn, None, samples=10)) == 6
+    assert [p.tolist() for p, _ in export_model.calibration_inputs(conn, spec, samples=3)] == [p.tolist() for p, _ in inputs]
+
+def test_keras_variant_scores_one_image():
+    class CombinedModel:
+        inputs = [None, None]
+
+        def predict_on_batch(self, inputs):
+            pixels, metadata = inputs
+            return pixels.mean(axis=(1, 2, 3)) + metadata.sum(axis=1)
+
+    score = export_model.load_variant("combined_model.keras", CombinedModel())
+
+    assert score(np.full((4, 4, 3), 0.25, np.float32), np.array([0.5, 0.125], np.float32)) == pytest.approx(0.875)
+
+def test_exported_variants_agree_with_keras(workspace):
+    tf = pytest.importorskip("tensorflow")
+
+    conn = metadata_store.connect("images.db")
+    for i in range(4):
+        store_image(conn, f"img{i}", RECORD)
+
+    width, height = export_model.dataset.IMAGE_SIZE
+    model = tf.keras.Sequential([
+        tf.keras.Input((height, width, 3)),
+        tf.keras.layers.Conv2D(4, 3, strides=4, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(1, activation="sigmoid"),
+    ])
+
+    os.makedirs("models")
+    model_path = os.path.join("models", "image_model.keras")
+    model.save(model_path)
+
+    paths = export_model.export_model(model_path)
+    assert paths == [export_model.tflite_path(model_path, q) for q in export_model.QUANTIZATIONS]
+
+    pixels = np.random.default_rng(0).random((height, width, 3), dtype=np.float32)
+    expected = export_model.load_variant(model_path)(pixels)
+
+    for path in paths:
+        assert export_model.load_variant(path)(pixels) == pytest.approx(expected, abs=0.05)
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+import metadata_store
+import features
+import feature_store
+
+MOON_PHASES = ["New Moon", "Waxing Crescent", "First Quarter", "Full Moon"]
+TENDENCIES = ["Rising", "Falling", "Steady"]
+
+def records(count, seed=0):
+    """Image records with every kind of value the features handle, some incomplete."""
+    rng = np.random.default_rng(seed)
+    images = dict()
+
+    for i in range(count):
+        record = {
+            "fullFilename": f"img{seed}-{i}.jpg",
+            "createdDateTime": f"2024-11-{1 + i % 28:02d}T{rng.integers(0, 24):02d}:{rng.integers(0, 60):02d}:00Z",
+            "pressure": round(float(rng.uniform(29, 31)), 2),
+            "temperature": int(rng.integers(-10, 90)),
+            "wind": int(rng.integers(0, 20)),
+            "windDirection": int(rng.integers(0, 360)),
+            "moonPhase": MOON_PHASES[rng.integers(0, len(MOON_PHASES))],
+            "pressureTendency": TENDENCIES[rng.integers(0, len(TENDENCIES))],
+            "cameraId": f"CAM{rng.integers(0, 3)}",
+            "imageTags": [{"name": "Buck"}] if i % 4 == 0 else [],
+        }
+
+        if i % 7 == 3:
+            record["pressure"] = None
+        if i % 5 == 0:
+            record["newTags"] = ["deer" if i % 2 else "not-deer"]
+
+        images[f"img{seed}-{i}"] = record
+
+    return images
+
+@pytest.fixture
+def built(workspace):
+    conn = metadata_store.connect("images.db")
+    images = records(60)
+    with conn:
+        metadata_store.add_images(conn, images)
+
+    feature_store.build_feature_store(str(workspace / "feature-store"))
+
+    return conn, images, feature_store.load_feature_store(str(workspace / "feature-store"))
+
+def test_matrix_matches_encode_features(built, workspace):
+    _, images, store = built
+
+    labeled = [record for record in images.values() if record.get("newTags") and features.is_complete(record)]
+    spec = features.fit_feature_spec(labeled)
+
+    saved = feature_store.load_spec(str(workspace / "feature-store"))
+    assert saved["categories"] == spec["categories"]
+    for field, scaler in spec["scaler"].items():
+        assert saved["scaler"][field] == pytest.approx(scaler)
+
+    # Every complete row, encoded with a spec fitted on the labeled ones
+    complete = np.flatnonzero(store["complete"])
+    expected = features.encode_features([images[f] for f in store["filename"][complete]], spec)
+    np.testing.assert_allclose(feature_store.feature_matrix(store, spec, complete), expected, rtol=1e-6)
+
+def test_matrix_with_a_spec_from_other_records(built):
+    _, images, store = built
+
+    # Categories the spec doesn't know encode like its dropped first one
+    spec = features.fit_feature_spec([record for record in records(10, seed=1).values() if features.is_complete(record)])
+    spec["categories"]["moonPhase"] = ["First Quarter", "Full Moon", "Harvest Moon"]
+
+    complete = np.flatnonzero(store["complete"])
+    expected = features.encode_features([images[f] for f in store["filename"][complete]], spec)
+    np.testing.assert_allclose(feature_store.feature_matrix(store, spec, complete), expected, rtol=1e-6)
+
+def test_rebuild_adds_new_images_and_refreshes_labels(built, workspace, monkeypatch):
+    conn, images, store = built
+    unlabeled = "img0-2"
+    assert not images[unlabeled].get("newTags")
+
+    with conn:
+        metadata_store.add_images(conn, records(5, seed=2))
+        metadata_store.set_tags(conn, unlabeled, ["deer"])
+        metadata_store.delete_images(conn, ["img0-1"])
+
+    get_images = metadata_store.get_images
+    decoded = list()
+
+    def recording_get_images(conn, filenames):
+        decoded.extend(filenames)
+        return get_images(conn, filenames)
+
+    monkeypatch.setattr(metadata_store, "get_images", recording_get_images)
+    assert feature_store.build_feature_store(str(workspace / "feature-store")) == 64
+
+    rebuilt = feature_store.load_feature_store(str(workspace / "feature-store"))
+
+    assert decoded == [f"img2-{i}" for i in range(5)]
+    assert rebuilt["label"][feature_store.rows_for(rebuilt, [unlabeled])[0]] == 1
+    assert feature_store.rows_for(rebuilt, ["img0-1"]).tolist() == [-1]
+
+    # Vocabularies only grow, so the codes of kept rows still mean the same
+    assert rebuilt["camera_vocab"][:len(store["camera_vocab"])].tolist() == store["camera_vocab"].tolist()
+    kept = feature_store.rows_for(store, rebuilt["filename"][:59])
+    assert rebuilt["moonPhase"][:59].tolist() == store["moonPhase"][kept].tolist()
+
+def test_columns_decode_the_records(built):
+    _, images, store = built
+    record = images["img0-4"]
+    row = feature_store.rows_for(store, ["img0-4"])[0]
+
+    assert store["vendor_deer"][row] and not store["vendor_deer"][row + 1]
+    assert store["camera_vocab"][store["camera"][row]] == record["cameraId"]
+    assert store["moonPhase_vocab"][store["moonPhase"][row]] == record["moonPhase"]
+    assert store["hour"][row] == int(record["createdDateTime"][11:13])
+    assert np.isnan(store["pressure"][feature_store.rows_for(store, ["img0-3"])[0]])
@@ -0,0 +1,231 @@
+import os
+
+import pytest
+
+import image_collection
+import image_store
+import metadata_store
+from stub_api import start_stub_server
+
+@pytest.fixture
+def stub(workspace, monkeypatch):
+    server = start_stub_server(20, width=64, height=48)
+
+    monkeypatch.setattr(image_collection, "API_URL", f'http://127.0.0.1:{server.server_address[1]}')
+    monkeypatch.setattr(image_collection, "API_BEARER", "test")
+    monkeypatch.setattr(image_collection, "IMAGE_TOTAL", 20)
+    monkeypatch.setattr(image_collection, "IMAGE_DIR", image_store.IMAGE_DIR)
+    monkeypatch.setattr(image_collection, "PROCESS_ON_DOWNLOAD", False)
+    monkeypatch.setattr(image_collection, "DOWNLOAD_RETRIES", 0)
+    monkeypatch.setattr(image_collection, "REQUEUE_LIMIT", 0)
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+def test_failed_download_is_retried_next_run(stub, monkeypatch):
+    filename, image = next(iter(image_collection.get_image_range(0, 1).items()))
+    failing = {image["fullFilename"]}
+    get_image = image_collection.get_image
+
+    def flaky_get_image(url, full_filename):
+        if full_filename in failing:
+            raise IOError("Injected failure")
+        return get_image(url, full_filename)
+
+    monkeypatch.setattr(image_collection, "get_image", flaky_get_image)
+
+    image_collection.build_images()
+    conn = metadata_store.connect()
+
+    assert metadata_store.count_images(conn) == 19
+    assert metadata_store.get_image(conn, filename) is None
+    assert image_store.locate(conn, image["fullFilename"]) is None
+
+    failing.clear()
+    image_collection.build_images()
+
+    assert metadata_store.count_images(conn) == 20
+    assert image_store.locate(conn, image["fullFilename"]) is not None
+
+def test_images_waiting_on_failed_processing_fail_with_it(stub, monkeypatch):
+    import time
+
+    import image_processing
+
+    monkeypatch.setattr(image_collection, "PROCESS_ON_DOWNLOAD", True)
+    monkeypatch.setattr(image_collection, "KEEP_RAW", False)
+    monkeypatch.setattr(image_processing, "IMAGE_PROCESSED_DIR", image_store.IMAGE_PROCESSED_DIR)
+
+    images = image_collection.get_image_range(0, 20)
+    keys = {filename: image_store.content_key(image_collection.fetch_image(image["imageUrl"], image["fullFilename"]))
+            for filename, image in images.items()}
+
+    # The stub repeats its content, so other images wait on the claim of the one that fails
+    failing_key = next(iter(keys.values()))
+    sharing = {filename for filename, key in keys.items() if key == failing_key}
+    assert len(sharing) > 1
+
+    process_image_bytes = image_processing.process_image_bytes
+    failing = [True]
+
+    def flaky_process_image_bytes(data, processed_file_path):
+        if failing[0] and image_store.content_key(data) == failing_key:
+            time.sleep(0.2)
+            raise ValueError("Injected failure")
+        return process_image_bytes(data, processed_file_path)
+
+    monkeypatch.setattr(image_processing, "process_image_bytes", flaky_process_image_bytes)
+
+    image_collection.build_images()
+    conn = metadata_store.connect()
+
+    assert metadata_store.count_images(conn) == 20 - len(sharing)
+    assert all(metadata_store.get_image(conn, filename) is None for filename in sharing)
+    assert metadata_store.get_state(conn, "sync")["newest"] is None
+    assert failing_key not in image_store.processed_keys(conn, image_processing.SIZE_TAG)
+
+    failing[0] = False
+    image_collection.build_images()
+
+    assert metadata_store.count_images(conn) == 20
+    assert failing_key in image_store.processed_keys(conn, image_processing.SIZE_TAG)
+
+def test_pages_commit_in_order(stub, monkeypatch):
+    import time
+
+    monkeypatch.setattr(image_collection, "TAKE_AMOUNT", 5)
+    get_image = image_collection.get_image
+
+    # The first page's downloads finish last
+    def slow_get_image(url, full_filename):
+        if full_filename < "STC_0000005":
+            time.sleep(0.2)
+        return get_image(url, full_filename)
+
+    committed = list()
+    add_images = metadata_store.add_images
+
+    def recording_add_images(conn, images):
+        committed.append(sorted(images))
+        add_images(conn, images)
+
+    monkeypatch.setattr(image_collection, "get_image", slow_get_image)
+    monkeypatch.setattr(metadata_store, "add_images", recording_add_images)
+
+    image_collection.build_images()
+
+    assert [page[0] for page in committed] == [f"STC_{i:07d}" for i in range(0, 20, 5)]
+    assert metadata_store.count_images(metadata_store.connect()) == 20
+
+def test_page_fetcher_stays_ahead_by_prefetch(stub, monkeypatch):
+    import queue
+    import threading
+    import time
+
+    requested = list()
+    get_image_range = image_collection.get_image_range
+
+    def recording_get_image_range(skip, take):
+        requested.append(skip)
+        return get_image_range(skip, take)
+
+    monkeypatch.setattr(image_collection, "get_image_range", recording_get_image_range)
+
+    pages = queue.Queue(maxsize=2)
+    fetcher = threading.Thread(target=image_collection.fetch_pages, args=(0, 4, 20, None, pages, threading.Event()))
+    fetcher.start()
+    time.sleep(0.3)
+
+    # Two pages queued, and the third waiting for room
+    assert requested == [0, 4, 8]
+
+    received = list()
+    while (page := pages.get()) is not None:
+        received.append((page[0], sorted(page[2])))
+    fetcher.join()
+
+    assert [skip for skip, _ in received] == [0, 4, 8, 12, 16]
+    assert received[-1][1] == [f"STC_{i:07d}" for i in range(16, 20)]
+
+def test_interrupted_sync_resumes_from_checkpoint(stub, monkeypatch):
+    import requests
+
+    monkeypatch.setattr(image_collection, "TAKE_AMOUNT", 5)
+    requested = list()
+    failing = [10]
+    get_image_range = image_collection.get_image_range
+
+    def flaky_get_image_range(skip, take):
+        requested.append(skip)
+        if skip in failing:
+            raise requests.ConnectionError("Injected failure")
+        return get_image_range(skip, take)
+
+    monkeypatch.setattr(image_collection, "get_image_range", flaky_get_image_range)
+
+    with pytest.raises(requests.ConnectionError):
+        image_collection.build_images()
+
+    conn = metadata_store.connect()
+    assert metadata_store.count_images(conn) == 10
+    assert metadata_store.get_state(conn, "sync")["skip"] == 10
+
+    failing.clear()
+    requested.clear()
+    image_collection.build_images()
+
+    assert requested == [10, 15]
+    assert metadata_store.count_images(conn) == 20
+    assert metadata_store.get_state(conn, "sync")["skip"] == 0
+
+def test_later_syncs_stop_at_the_newest_image(stub, monkeypatch):
+    monkeypatch.setattr(image_collection, "TAKE_AMOUNT", 5)
+    image_collection.build_images()
+
+    conn = metadata_store.connect()
+    assert metadata_store.get_state(conn, "sync")["newest"]["imageGuid"] == "00000000-0000-4000-8000-000000000000"
+
+    requested = list()
+    get_image_range = image_collection.get_image_range
+
+    def recording_get_image_range(skip, take):
+        requested.append(skip)
+        return get_image_range(skip, take)
+
+    def get_image(url, full_filename):
+        raise AssertionError("Nothing new should be downloaded")
+
+    monkeypatch.setattr(image_collection, "get_image_range", recording_get_image_range)
+    monkeypatch.setattr(image_collection, "get_image", get_image)
+    image_collection.build_images()
+
+    assert requested == [0]
+    assert metadata_store.count_images(conn) == 20
+
+def test_fused_mode_processes_each_content_once(stub, monkeypatch):
+    import image_processing
+
+    monkeypatch.setattr(image_collection, "PROCESS_ON_DOWNLOAD", True)
+    monkeypatch.setattr(image_collection, "KEEP_RAW", False)
+    monkeypatch.setattr(image_processing, "IMAGE_PROCESSED_DIR", image_store.IMAGE_PROCESSED_DIR)
+
+    processed = list()
+    process_image_bytes = image_processing.process_image_bytes
+
+    def recording_process_image_bytes(data, processed_file_path):
+        processed.append(processed_file_path)
+        process_image_bytes(data, processed_file_path)
+
+    monkeypatch.setattr(image_processing, "process_image_bytes", recording_process_image_bytes)
+    image_collection.build_images()
+
+    conn = metadata_store.connect()
+    keys = image_store.processed_keys(conn, image_processing.SIZE_TAG)
+
+    # The stub serves 8 distinct images, no raw copies are kept
+    assert metadata_store.count_images(conn) == 20
+    assert len(keys) == len(processed) == len(set(processed)) == 8
+    assert all(os.path.exists(image_store.processed_path(key)) for key in keys)
+    assert not any(files for _, _, files in os.walk(image_store.IMAGE_DIR))
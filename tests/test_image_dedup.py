@@ -0,0 +1,97 @@
+import os
+import hashlib
+
+import numpy as np
+from PIL import Image
+
+import metadata_store
+import image_store
+import image_dedup
+
+def store_image(conn, name, pixels):
+    """Index a processed image, returning its content key."""
+    key = hashlib.sha1(name.encode()).hexdigest()
+    path = image_store.processed_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(pixels).save(path)
+
+    with conn:
+        metadata_store.add_images(conn, {os.path.splitext(name)[0]: {"fullFilename": name}})
+        image_store.index_files(conn, {name: (key, None, os.path.getsize(path))})
+        image_store.set_processed(conn, [key], image_store.SIZE_TAG)
+
+    return key
+
+def test_unreadable_image_skipped(workspace):
+    conn = metadata_store.connect("images.db")
+    pixels = np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+
+    store_image(conn, "a.jpg", pixels)
+    broken = store_image(conn, "b.jpg", pixels)
+    store_image(conn, "c.jpg", pixels)
+
+    with open(image_store.processed_path(broken), 'wb') as f:
+        f.write(b"truncated")
+
+    assert image_dedup.remove_duplicates() == [("c.jpg", "a.jpg")]
+
+    # Left for the next run
+    assert image_store.count_unchecked(conn) == 1
+
+def test_duplicate_already_deleted(workspace):
+    conn = metadata_store.connect("images.db")
+    pixels = np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+
+    kept = store_image(conn, "a.jpg", pixels)
+    duplicate = store_image(conn, "b.jpg", pixels)
+
+    # Hashed by an earlier run that stopped after deleting the file
+    with conn:
+        image_store.set_hashes(conn, {duplicate: image_dedup.phash(image_store.processed_path(duplicate))})
+    os.remove(image_store.processed_path(duplicate))
+
+    assert image_dedup.remove_duplicates() == [("b.jpg", "a.jpg")]
+    assert image_store.count_unchecked(conn) == 0
+    assert image_store.processed_paths(conn, unique=False) == {"a.jpg": image_store.processed_path(kept)}
+
+def test_bk_tree_matches_a_full_scan():
+    rng = np.random.default_rng(0)
+    base = [int(v) for v in rng.integers(0, 2 ** 63, 20, dtype=np.int64)]
+
+    # Clusters of near hashes around each base, a few bits apart
+    values = [b ^ (1 << int(bit)) ^ (1 << int(other)) for b in base for bit, other in rng.integers(0, 64, (10, 2))]
+
+    tree = image_dedup.BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, f"{i:03d}")
+
+    for query in base:
+        expected = sorted(((query ^ v).bit_count(), f"{i:03d}") for i, v in enumerate(values) if (query ^ v).bit_count() <= 4)
+        assert sorted(tree.search(query, 4)) == expected
+
+def test_only_new_images_checked(workspace, monkeypatch):
+    conn = metadata_store.connect("images.db")
+    rng = np.random.default_rng(0)
+
+    store_image(conn, "a.jpg", rng.integers(0, 256, (64, 64, 3), dtype=np.uint8))
+    store_image(conn, "b.jpg", rng.integers(0, 256, (64, 64, 3), dtype=np.uint8))
+    assert image_dedup.remove_duplicates() == []
+
+    hashed = list()
+    phash = image_dedup.phash
+
+    def recording_phash(path):
+        hashed.append(path)
+        return phash(path)
+
+    monkeypatch.setattr(image_dedup, "phash", recording_phash)
+
+    # A near-duplicate of a, slightly brighter, found from the saved hashes of the first run
+    with Image.open(image_store.processed_path(image_store.locate(conn, "a.jpg"))) as img:
+        brighter = np.clip(np.asarray(img).astype(int) + 4, 0, 255).astype(np.uint8)
+    new = store_image(conn, "c.jpg", brighter)
+
+    assert image_dedup.remove_duplicates() == [("c.jpg", "a.jpg")]
+    assert hashed == [image_store.processed_path(new)]
+    assert image_dedup.remove_duplicates() == []
+    assert len(hashed) == 1
@@ -0,0 +1,213 @@
+import sqlite3
+
+import pytest
+
+import metadata_store
+import image_labeling
+
+@pytest.fixture
+def labeling(workspace, monkeypatch):
+    """The labeling tool's store and journal, without its window."""
+    store = metadata_store.connect("images.db")
+    with store:
+        metadata_store.add_images(store, {f"img{i}": {"fullFilename": f"img{i}.jpg"} for i in range(3)})
+
+    monkeypatch.setattr(image_labeling, "LABEL_JOURNAL", str(workspace / "labels.journal"))
+    monkeypatch.setattr(image_labeling, "store", store, raising=False)
+    monkeypatch.setattr(image_labeling, "image_data", {f"img{i}": {} for i in range(3)}, raising=False)
+    monkeypatch.setattr(image_labeling, "journal", open(image_labeling.LABEL_JOURNAL, 'a'), raising=False)
+
+    yield store
+    image_labeling.journal.close()
+
+def test_failed_compaction_keeps_labels(labeling, monkeypatch):
+    set_tags = metadata_store.set_tags
+
+    def failing_set_tags(conn, filename, tags):
+        raise sqlite3.OperationalError("database is locked")
+
+    image_labeling.journal_tags("deer", ["img0"])
+    monkeypatch.setattr(metadata_store, "set_tags", failing_set_tags)
+    with pytest.raises(sqlite3.OperationalError):
+        image_labeling.compact_journal()
+
+    # The next compaction swaps the journal again while the failed one's labels are still pending
+    image_labeling.journal_tags("not deer", ["img1"])
+    monkeypatch.setattr(metadata_store, "set_tags", set_tags)
+    assert image_labeling.compact_journal() == 2
+
+    assert metadata_store.get_image(labeling, "img0")["newTags"] == ["deer"]
+    assert metadata_store.get_image(labeling, "img1")["newTags"] == ["not deer"]
+
+def test_pending_labels_retried_without_new_ones(labeling, monkeypatch):
+    set_tags = metadata_store.set_tags
+
+    def failing_set_tags(conn, filename, tags):
+        raise sqlite3.OperationalError("database is locked")
+
+    image_labeling.journal_tags("deer", ["img2"])
+    monkeypatch.setattr(metadata_store, "set_tags", failing_set_tags)
+    with pytest.raises(sqlite3.OperationalError):
+        image_labeling.compact_journal()
+
+    monkeypatch.setattr(metadata_store, "set_tags", set_tags)
+    assert image_labeling.compact_journal() == 1
+    assert metadata_store.get_image(labeling, "img2")["newTags"] == ["deer"]
+
+@pytest.fixture
+def thumbnails(workspace, monkeypatch):
+    """A processed image and a thumbnail directory for it."""
+    from PIL import Image
+
+    image_path = workspace / "img0.jpg"
+    Image.new("RGB", (224, 224), (40, 90, 30)).save(image_path)
+
+    monkeypatch.setattr(image_labeling, "THUMBNAIL_DIR", str(workspace / "thumbnails"))
+    monkeypatch.setattr(image_labeling, "image_data", {"img0": {"fullFilename": "img0.jpg"}}, raising=False)
+    monkeypatch.setattr(image_labeling, "image_paths", {"img0.jpg": str(image_path)}, raising=False)
+
+    return workspace
+
+def test_thumbnail_written_atomically(thumbnails):
+    img = image_labeling.decode_image("img0")
+
+    assert img.size == image_labeling.DISPLAY_SIZE
+    assert sorted(p.name for p in (thumbnails / "thumbnails").iterdir()) == ["img0.jpg"]
+
+def test_corrupt_thumbnail_rebuilt(thumbnails):
+    image_labeling.decode_image("img0")
+    thumbnail_path = thumbnails / "thumbnails" / "img0.jpg"
+    thumbnail_path.write_bytes(thumbnail_path.read_bytes()[:100])
+
+    assert image_labeling.decode_image("img0").size == image_labeling.DISPLAY_SIZE
+    assert thumbnail_path.stat().st_size > 100
+
+def test_corrupt_image_not_raised(thumbnails, monkeypatch):
+    monkeypatch.setattr(image_labeling, "THUMBNAIL_DIR", None)
+    (thumbnails / "img0.jpg").write_bytes(b"not a jpeg")
+
+    assert image_labeling.load_image("img0") is None
+
+def test_missing_image_reported(thumbnails, monkeypatch, capsys):
+    monkeypatch.setattr(image_labeling, "image_paths", {}, raising=False)
+
+    assert image_labeling.load_image("img0") is None
+    assert capsys.readouterr().out.strip() == "Image not found: No processed image for img0"
+
+def test_journal_left_by_a_crash_recovered(labeling, monkeypatch):
+    monkeypatch.setattr(image_labeling, "compactor_stop", None, raising=False)
+    image_labeling.journal.close()
+
+    # The last append was cut short by the crash
+    with open(image_labeling.LABEL_JOURNAL, 'w') as f:
+        f.write('{"id": "img0", "tags": ["deer"]}\n{"id": "img0", "tags": ["not deer"]}\n{"id": "img1", "ta')
+
+    image_labeling.open_journal()
+    image_labeling.compactor_stop.set()
+
+    assert metadata_store.get_image(labeling, "img0")["newTags"] == ["not deer"]
+    assert "newTags" not in metadata_store.get_image(labeling, "img1")
+    assert image_labeling.journal.tell() == 0
+
+def test_navigation_keeps_event_frames_together(labeling, monkeypatch):
+    import image_store
+
+    with labeling:
+        metadata_store.add_images(labeling, {"img3": {"fullFilename": "img3.jpg"}})
+        image_store.index_files(labeling, {f"img{i}.jpg": (f"k{i}", None, 1) for i in range(4)})
+        image_store.set_processed(labeling, [f"k{i}" for i in range(4)], image_store.SIZE_TAG)
+        metadata_store.set_events(labeling, [["img3", "img1"], ["img0"], ["img2"]])
+        metadata_store.set_tags(labeling, "img0", ["deer"])
+
+    for name in ("image_ids", "image_positions", "image_events", "image_paths", "untagged_cursor"):
+        monkeypatch.setattr(image_labeling, name, None, raising=False)
+
+    image_data = image_labeling.load_metadata()
+    monkeypatch.setattr(image_labeling, "image_data", image_data)
+
+    assert image_labeling.image_ids == ["img0", "img2", "img3", "img1"]
+    assert image_labeling.image_positions["img1"] == 3
+    assert image_labeling.image_events["img1"] == ["img3", "img1"]
+
+    # The untagged search resumes where it stopped
+    assert image_labeling.next_untagged() == "img2"
+    image_labeling.journal_tags("deer", ["img2"])
+    assert image_labeling.next_untagged() == "img3"
+    assert image_labeling.untagged_cursor == 2
+
+@pytest.fixture
+def cache(monkeypatch):
+    """An empty decoded-image cache."""
+    monkeypatch.setattr(image_labeling, "image_cache", image_labeling.OrderedDict())
+    monkeypatch.setattr(image_labeling, "CACHE_SIZE", 3)
+
+    return image_labeling.image_cache
+
+def test_cache_evicts_least_recently_used(cache):
+    for image_id in ["img0", "img1", "img2"]:
+        image_labeling.cache_image(image_id, image_id.upper())
+
+    assert image_labeling.cached_image("img0") == "IMG0"
+    image_labeling.cache_image("img3", "IMG3")
+
+    assert image_labeling.cached_image("img1") is None
+    assert list(cache) == ["img2", "img0", "img3"]
+
+def test_prefetcher_decodes_around_the_cursor(cache, monkeypatch):
+    import threading
+    import time
+
+    monkeypatch.setattr(image_labeling, "CACHE_SIZE", 10)
+    monkeypatch.setattr(image_labeling, "PREFETCH_AHEAD", 2)
+    monkeypatch.setattr(image_labeling, "PREFETCH_BEHIND", 1)
+    monkeypatch.setattr(image_labeling, "image_ids", [f"img{i}" for i in range(6)], raising=False)
+
+    decoded = list()
+
+    def decode_image(image_id):
+        decoded.append(image_id)
+        if image_id == "img4":
+            raise ValueError("Injected failure")
+        return image_id.upper()
+
+    monkeypatch.setattr(image_labeling, "decode_image", decode_image)
+    image_labeling.cache_image("img1", "IMG1")
+
+    threading.Thread(target=image_labeling.run_prefetcher, daemon=True).start()
+    image_labeling.prefetch_around(2)
+
+    deadline = time.monotonic() + 5
+    while len(decoded) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # Ahead first, then behind, skipping what is cached and going on past a failure
+    assert decoded == ["img3", "img4"]
+    assert sorted(cache) == ["img1", "img3"]
+
+def test_event_frames_labeled_together(labeling, monkeypatch):
+    import image_store
+
+    with labeling:
+        metadata_store.add_images(labeling, {"img3": {"fullFilename": "img3.jpg"}})
+        image_store.index_files(labeling, {f"img{i}.jpg": (f"key{i}", None, 1) for i in range(4)})
+        image_store.set_processed(labeling, [f"key{i}" for i in range(4)], image_store.SIZE_TAG)
+        metadata_store.set_events(labeling, [["img2", "img0"]])
+
+    for name in ("image_ids", "image_positions", "image_events", "image_paths", "untagged_cursor"):
+        monkeypatch.setattr(image_labeling, name, None, raising=False)
+
+    shown = list()
+    monkeypatch.setattr(image_labeling, "show_image", shown.append)
+
+    image_labeling.load_metadata()
+
+    # The frames of an event are shown one after the other
+    assert image_labeling.image_ids == ["img1", "img2", "img0", "img3"]
+
+    image_labeling.tag_event("deer", "img2")
+    assert shown == [3]
+
+    assert image_labeling.compact_journal() == 2
+    assert metadata_store.get_image(labeling, "img0")["newTags"] == ["deer"]
+    assert metadata_store.get_image(labeling, "img2")["newTags"] == ["deer"]
+    assert metadata_store.get_image(labeling, "img1").get("newTags") is None
@@ -0,0 +1,84 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import metadata_store
+import image_store
+import image_processing
+
+def camera_jpeg(width, height, seed=0):
+    """Encode a noisy camera sized frame."""
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return cv2.imencode(".jpg", pixels)[1].tobytes()
+
+def test_jpeg_size_read_from_header():
+    assert image_processing.jpeg_size(camera_jpeg(320, 200)) == (320, 200)
+    assert image_processing.jpeg_size(cv2.imencode(".png", np.zeros((8, 8, 3), np.uint8))[1].tobytes()) is None
+
+@pytest.mark.parametrize("width, height, factor", [
+    (1920, 1080, 8),
+    (960, 540, 4),
+    (480, 300, 2),
+    (200, 150, 1),
+])
+def test_reduced_decode_still_covers_image_size(monkeypatch, width, height, factor):
+    monkeypatch.setattr(image_processing, "IMAGE_SIZE", (120, 80))
+    data = camera_jpeg(width, height)
+
+    assert image_processing.reduction_factor(data) == factor
+
+    img, decoded_factor = image_processing.decode_image(data)
+    assert decoded_factor == factor
+    assert img.shape[:2] == (-(-height // factor), -(-width // factor))
+    assert image_processing.crop_image(img, factor).shape == (80, 120, 3)
+
+def test_processed_images_skipped_next_run(workspace, monkeypatch, capsys):
+    monkeypatch.setattr(image_processing, "IMAGE_PROCESSED_DIR", image_store.IMAGE_PROCESSED_DIR)
+    monkeypatch.setattr(image_processing, "REMOVE_DUPLICATES", False)
+    conn = metadata_store.connect("images.db")
+
+    with conn:
+        files = dict()
+        for i in range(3):
+            data = camera_jpeg(320, 240, seed=i)
+            files[f"{i}.jpg"] = (image_store.store_raw(data), None, len(data))
+
+        metadata_store.add_images(conn, {name[0]: {"fullFilename": name} for name in files})
+        image_store.index_files(conn, files)
+
+    image_processing.process_images()
+
+    keys = [key for key, _, _ in files.values()]
+    assert image_store.processed_keys(conn, image_processing.SIZE_TAG) == set(keys)
+    assert all(cv2.imread(image_store.processed_path(key)).shape[1::-1] == image_processing.IMAGE_SIZE for key in keys)
+
+    capsys.readouterr()
+    image_processing.process_images()
+
+    assert "Skipping 3 processed images, processing 0" in capsys.readouterr().out
+
+def test_clean_metadata_keeps_duplicates(workspace):
+    conn = metadata_store.connect("images.db")
+
+    with conn:
+        metadata_store.add_images(conn, {name: {"fullFilename": f'{name}.jpg'} for name in ["a", "b", "c", "d", "e"]})
+
+        # b is an identical download of a, c a near-duplicate of a, d failed processing, e was never stored
+        image_store.index_files(conn, {
+            "a.jpg": ("ka", None, 1),
+            "b.jpg": ("ka", None, 1),
+            "c.jpg": ("kc", None, 1),
+            "d.jpg": ("kd", None, 1),
+        })
+        image_store.set_processed(conn, ["ka", "kc"], image_store.SIZE_TAG)
+        image_store.set_duplicates(conn, {"kc": "ka"})
+
+    image_processing.clean_metadata()
+
+    # Collection still knows the duplicates, so it doesn't download them again
+    assert metadata_store.known_filenames(conn, ["a", "b", "c", "d", "e"]) == {"a", "b", "c"}
+
+    # Readers see one image
+    assert list(image_store.processed_paths(conn, unique=True)) == ["a.jpg"]
@@ -0,0 +1,107 @@
+import os
+
+import metadata_store
+import image_store
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def test_import_baseline_tree_keeps_processed_images(workspace):
+    # Flat directories as the first version leaves them, without processed-manifest.json
+    write_file(workspace / "images" / "a.jpg", b"raw a")
+    write_file(workspace / "images" / "b.jpg", b"raw b")
+    write_file(workspace / "processed-images" / "a.jpg", b"processed a")
+    write_file(workspace / "processed-images" / "c.jpg", b"processed c")
+
+    conn = metadata_store.connect("images.db")
+    assert image_store.import_flat(conn) == 2
+
+    key_a = image_store.locate(conn, "a.jpg")
+    key_b = image_store.locate(conn, "b.jpg")
+    assert open(image_store.raw_path(key_a), 'rb').read() == b"raw a"
+    assert open(image_store.raw_path(key_b), 'rb').read() == b"raw b"
+
+    # Moved in but not trusted, so it is processed again
+    assert open(image_store.processed_path(key_a), 'rb').read() == b"processed a"
+    assert image_store.pending(conn, image_store.SIZE_TAG) == [key_a, key_b]
+
+    # Nothing to import it with, so it stays where it was
+    assert open(workspace / "processed-images" / "c.jpg", 'rb').read() == b"processed c"
+
+def test_import_carries_current_processed_images(workspace):
+    write_file(workspace / "images" / "a.jpg", b"raw a")
+    write_file(workspace / "processed-images" / "a.jpg", b"processed a")
+    write_file(workspace / "processed-manifest.json", b'{"imageSize": [224, 224], "images": {"a.jpg": {}}}')
+
+    conn = metadata_store.connect("images.db")
+    image_store.import_flat(conn)
+
+    key = image_store.locate(conn, "a.jpg")
+    assert image_store.processed_keys(conn, "224x224") == {key}
+    assert open(image_store.processed_path(key), 'rb').read() == b"processed a"
+
+def test_older_index_keeps_its_duplicate_checks(workspace):
+    import sqlite3
+
+    conn = sqlite3.connect("images.db")
+    conn.execute("CREATE TABLE blobs (key TEXT PRIMARY KEY, size INTEGER NOT NULL, processed TEXT, phash TEXT, duplicate_of TEXT)")
+    conn.execute("INSERT INTO blobs VALUES ('a', 1, '224x224', '00000000000000ff', NULL)")
+    conn.execute("INSERT INTO blobs VALUES ('b', 1, '224x224', NULL, NULL)")
+    conn.commit()
+    conn.close()
+
+    conn = metadata_store.connect("images.db")
+    assert dict(conn.execute("SELECT key, deduped FROM blobs")) == {"a": 1, "b": 0}
+
+def test_identical_content_stored_once(workspace):
+    key = image_store.store_raw(b"raw a")
+
+    assert key == image_store.content_key(b"raw a")
+    assert image_store.raw_path(key) == os.path.join(str(workspace / "images"), key[:2], key[2:4], f'{key}.jpg')
+    assert image_store.store_raw(b"raw a") == key
+
+    # A download of the same content is dropped
+    write_file(workspace / "download.part", b"raw a")
+    assert image_store.store_raw_file(str(workspace / "download.part")) == (key, 5)
+    assert not os.path.exists(workspace / "download.part")
+
+    write_file(workspace / "download.part", b"raw b")
+    other, _ = image_store.store_raw_file(str(workspace / "download.part"))
+    assert open(image_store.raw_path(other), 'rb').read() == b"raw b"
+
+    stored = [os.path.join(d, f) for d, _, files in os.walk(workspace / "images") for f in files]
+    assert sorted(stored) == sorted([image_store.raw_path(key), image_store.raw_path(other)])
+
+def test_index_lookups(workspace):
+    conn = metadata_store.connect("images.db")
+
+    # b.jpg and c.jpg were downloaded with the same content
+    with conn:
+        image_store.index_files(conn, {
+            "b.jpg": ("k1", "guid-b", 5), "c.jpg": ("k1", "guid-c", 5), "a.jpg": ("k2", "guid-a", 5), "d.jpg": ("k3", None, 5),
+        })
+
+    assert image_store.locate(conn, "c.jpg") == "k1"
+    assert image_store.locate(conn, guid="guid-a") == "k2"
+    assert image_store.locate(conn, "e.jpg") is None
+    assert image_store.count_blobs(conn) == 3
+    assert image_store.pending(conn, "224x224") == ["k2", "k1", "k3"]
+
+    with conn:
+        image_store.set_processed(conn, ["k1", "k2"], "224x224")
+        image_store.set_duplicates(conn, {"k2": "k1"})
+
+    assert image_store.pending(conn, "224x224") == ["k3"]
+    assert image_store.count_blobs(conn, processed=True) == 1
+    assert image_store.settled_names(conn) == {"a.jpg", "b.jpg", "c.jpg"}
+
+    # Content stored under several names is read once, unless every name is asked for
+    assert image_store.processed_paths(conn, unique=True) == {"b.jpg": image_store.processed_path("k1")}
+    assert image_store.processed_paths(conn, unique=False) == {
+        "b.jpg": image_store.processed_path("k1"), "c.jpg": image_store.processed_path("k1"),
+    }
+
+    # Another output size processes everything again, near-duplicates aside
+    assert image_store.pending(conn, "299x299") == ["k1", "k3"]
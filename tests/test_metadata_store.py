@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import metadata_store
+
+def record(i, **fields):
+    return {
+        "imageUrl": f"https://signed.test/STC_{i:04d}.JPG?expires=1",
+        "fullFilename": f"STC_{i:04d}.JPG",
+        "imageGuid": f"guid-{i}",
+        "createdDateTime": f"2024-11-02T04:{i % 60:02d}:00Z",
+        **fields,
+    }
+
+def test_new_store_seeded_from_images_json(workspace, monkeypatch):
+    images = {f"STC_{i:04d}": record(i) for i in range(3)}
+    images["STC_0001"]["newTags"] = ["deer"]
+    (workspace / "archive.json").write_text(json.dumps(images))
+    monkeypatch.setattr(metadata_store, "IMAGE_JSON", str(workspace / "archive.json"))
+
+    conn = metadata_store.connect("images.db")
+
+    assert metadata_store.count_images(conn) == 3
+    assert [filename for filename, _ in metadata_store.iter_images(conn, label="deer")] == ["STC_0001"]
+
+    # Signed URLs expire, so they aren't kept
+    assert "imageUrl" not in metadata_store.get_image(conn, "STC_0000")
+
+    # Only a new store is seeded
+    conn.close()
+    (workspace / "archive.json").write_text(json.dumps({"STC_9999": record(9999)}))
+    assert metadata_store.count_images(metadata_store.connect("images.db")) == 3
+
+def test_export_round_trips(workspace):
+    conn = metadata_store.connect("images.db")
+    with conn:
+        metadata_store.add_images(conn, {f"STC_{i:04d}": record(i) for i in range(3)})
+        metadata_store.set_tags(conn, "STC_0002", ["not deer"])
+        metadata_store.update_fields(conn, "STC_0000", {"deerProbability": 0.9})
+
+    assert metadata_store.export_json(conn, "export.json") == 3
+
+    copy = metadata_store.connect("copy.db")
+    assert metadata_store.import_json(copy, "export.json") == 3
+    assert dict(metadata_store.iter_images(copy)) == dict(metadata_store.iter_images(conn))
+    assert list(metadata_store.iter_labels(copy)) == [("STC_0000", None), ("STC_0001", None), ("STC_0002", "not deer")]
+
+def test_adding_known_images_keeps_their_labels(workspace):
+    conn = metadata_store.connect("images.db")
+    with conn:
+        metadata_store.add_images(conn, {"STC_0000": record(0)})
+        metadata_store.set_tags(conn, "STC_0000", ["deer"])
+        metadata_store.add_images(conn, {"STC_0000": record(0), "STC_0001": record(1)})
+
+    assert metadata_store.get_image(conn, "STC_0000")["newTags"] == ["deer"]
+    assert [f for f, _ in metadata_store.iter_images(conn, labeled=False)] == ["STC_0001"]
+
+    with pytest.raises(KeyError):
+        metadata_store.set_tags(conn, "STC_0002", ["deer"])
+
+def test_lookups_beyond_the_parameter_limit(workspace):
+    conn = metadata_store.connect("images.db")
+    with conn:
+        metadata_store.add_images(conn, {f"STC_{i:04d}": record(i) for i in range(0, 1200, 2)})
+
+    filenames = [f"STC_{i:04d}" for i in range(1200)]
+
+    assert metadata_store.known_filenames(conn, filenames) == set(filenames[::2])
+    assert sorted(metadata_store.get_images(conn, filenames)) == filenames[::2]
+
+def test_sync_state_and_events_stored(workspace):
+    conn = metadata_store.connect("images.db")
+    assert metadata_store.get_state(conn, "sync", {}) == {}
+
+    with conn:
+        metadata_store.set_state(conn, "sync", {"skip": 50})
+        metadata_store.set_events(conn, [["b", "a"], ["c"]])
+
+    assert metadata_store.get_state(conn, "sync") == {"skip": 50}
+    assert metadata_store.load_events(conn) == {"b": ["b", "a"], "c": ["c"]}
@@ -0,0 +1,92 @@
+import json
+import threading
+
+import pytest
+
+import metrics
+
+@pytest.fixture(autouse=True)
+def fresh(monkeypatch):
+    """Start every test from no metrics."""
+    for name in ("counters", "histograms", "gauges", "tracked"):
+        monkeypatch.setattr(metrics, name, dict())
+
+def test_counters_add_up_across_threads():
+    def work():
+        for _ in range(1000):
+            metrics.inc("images_total")
+        metrics.inc("bytes_total", 2.5)
+
+    workers = [threading.Thread(target=work) for _ in range(8)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    assert metrics.snapshot()["counters"] == {"images_total": 8000, "bytes_total": 20.0}
+
+def test_histogram_quantiles_are_bucket_bounds():
+    for seconds in [0.0005] * 50 + [0.03] * 49 + [45.0]:
+        metrics.observe("decode_seconds", seconds)
+
+    histogram = metrics.snapshot()["histograms"]["decode_seconds"]
+
+    assert histogram["count"] == 100
+    assert histogram["sum"] == pytest.approx(0.025 + 1.47 + 45)
+    assert metrics.quantile(histogram, 0.5) == 0.001
+    assert metrics.quantile(histogram, 0.99) == 0.05
+    assert metrics.quantile(histogram, 1.0) == float("inf")
+
+def test_tracked_gauge_keeps_its_last_value():
+    depth = [3]
+    metrics.track("queue_depth", lambda: depth[0])
+    metrics.add_gauge("workers_active", 2)
+    metrics.add_gauge("workers_active", -1)
+
+    depth[0] = 5
+    assert metrics.snapshot()["gauges"] == {"queue_depth": 5, "workers_active": 1}
+
+    metrics.untrack("queue_depth")
+    depth[0] = 9
+    assert metrics.snapshot()["gauges"]["queue_depth"] == 5
+
+def test_prometheus_text():
+    metrics.inc("images_total", 3)
+    metrics.set_gauge("workers", 4)
+    metrics.observe("page_seconds", 0.002)
+    metrics.observe("page_seconds", 60)
+
+    text = metrics.prometheus_text(metrics.snapshot())
+    lines = text.splitlines()
+
+    assert lines[:4] == ["# TYPE deer_images_total counter", "deer_images_total 3", "# TYPE deer_workers gauge", "deer_workers 4"]
+    assert 'deer_page_seconds_bucket{le="0.001"} 0' in lines
+    assert 'deer_page_seconds_bucket{le="0.0025"} 1' in lines
+    assert 'deer_page_seconds_bucket{le="30"} 1' in lines
+    assert lines[-3:] == ['deer_page_seconds_bucket{le="+Inf"} 2', "deer_page_seconds_sum 60.002", "deer_page_seconds_count 2"]
+
+def test_reporter_writes_a_final_report(tmp_path, monkeypatch, capsys):
+    metrics_file = tmp_path / "collect.prom"
+    monkeypatch.setattr(metrics, "METRICS_FILE", str(metrics_file))
+
+    stop = metrics.start_reporter("collect", interval=60)
+    metrics.inc("downloads_total", 2)
+    with metrics.timer("download_seconds"):
+        pass
+    stop()
+
+    assert capsys.readouterr().out.startswith("[collect] downloads_total=2 download_seconds[n=1 ")
+    assert "deer_downloads_total 2" in metrics_file.read_text()
+
+    metrics.write_metrics(str(tmp_path / "collect.json"))
+    written = json.loads((tmp_path / "collect.json").read_text())
+    assert written["counters"] == {"downloads_total": 2}
+    assert written["buckets"] == list(metrics.BUCKETS)
+
+def test_debug_only_at_debug_level(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "LOG_LEVEL", "info")
+    metrics.debug("hidden")
+    monkeypatch.setattr(metrics, "LOG_LEVEL", "debug")
+    metrics.debug("shown")
+
+    assert capsys.readouterr().out == "shown\n"
@@ -0,0 +1,194 @@
+import numpy as np
+import pytest
+
+import features
+import predict
+
+RECORD = {
+    "createdDateTime": "2024-11-02T04:30:00Z",
+    "pressure": 30.1,
+    "temperature": 41,
+    "wind": 5,
+    "windDirection": 180,
+    "moonPhase": "Waxing Gibbous",
+    "pressureTendency": "Rising",
+}
+
+class FakeModel:
+    """Scores the night flag, enough to check what the gate was given."""
+
+    def predict_on_batch(self, inputs):
+        return inputs[:, 2:3]
+
+def test_gate_scores_encode_in_memory(workspace, monkeypatch):
+    gate_path = str(workspace / "metadata_model.keras")
+    features.save_feature_spec(features.fit_feature_spec([RECORD]), predict.feature_spec_path(gate_path))
+    monkeypatch.setattr(predict, "load_model", lambda path: FakeModel())
+
+    images = [
+        ("a", "a.jpg", RECORD),
+        ("b", "b.jpg", {**RECORD, "pressure": None}),
+        ("c", "c.jpg", None),
+        ("d", "d.jpg", {**RECORD, "createdDateTime": "2024-11-02T12:00:00Z"}),
+    ]
+    scores = predict.gate_scores(images, gate_path)
+
+    np.testing.assert_array_equal(scores, [1, np.nan, np.nan, 0])
+
+    # Scoring leaves the feature store alone
+    assert sorted(p.name for p in workspace.iterdir()) == ["metadata_model.features.json"]
+
+def test_missing_spec_is_an_error(workspace):
+    with pytest.raises(FileNotFoundError, match="combined_model.features.json"):
+        predict.load_spec(str(workspace / "combined_model.keras"))
+
+def test_new_in_directory_skips_unknown_images(workspace, monkeypatch):
+    import metadata_store
+
+    image_dir = workspace / "to-score"
+    image_dir.mkdir()
+    for name in ["unknown.jpg", "scored.jpg"]:
+        (image_dir / name).write_bytes(b"")
+
+    conn = metadata_store.connect("images.db")
+    with conn:
+        metadata_store.add_images(conn, {"scored": {"fullFilename": "scored.jpg", "deerProbability": 0.9}})
+
+    def load_model(path):
+        raise AssertionError("Nothing is new, the model shouldn't be loaded")
+
+    monkeypatch.setattr(predict, "load_model", load_model)
+    assert predict.predict(image_dir=str(image_dir), only_new=True) == 0
+
+class RedModel:
+    """An image-only model scoring each image by its red channel."""
+
+    inputs = [None]
+
+    def __init__(self):
+        self.batches = list()
+
+    def predict_on_batch(self, pixels):
+        self.batches.append(len(pixels))
+        return pixels[:, 0, 0, 0:1]
+
+def store_image(conn, name, red):
+    """Store a record and a processed image of one shade of red, an unreadable one without a shade."""
+    import os
+    import hashlib
+
+    from PIL import Image
+
+    import metadata_store
+    import image_store
+
+    key = hashlib.sha1(name.encode()).hexdigest()
+    path = image_store.processed_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if red is None:
+        with open(path, 'wb') as f:
+            f.write(b"truncated")
+    else:
+        Image.new("RGB", (32, 24), (red, 0, 0)).save(path, format="PNG")
+
+    with conn:
+        metadata_store.add_images(conn, {name: {"fullFilename": f'{name}.jpg', **RECORD}})
+        image_store.index_files(conn, {f'{name}.jpg': (key, None, os.path.getsize(path))})
+        image_store.set_processed(conn, [key], image_store.SIZE_TAG)
+
+@pytest.fixture
+def red_model(monkeypatch):
+    model = RedModel()
+    monkeypatch.setattr(predict, "load_model", lambda path: model)
+    return model
+
+def test_stored_images_scored_in_batches(workspace, red_model):
+    import csv
+
+    import metadata_store
+
+    conn = metadata_store.connect("images.db")
+    for name, red in [("a", 255), ("b", 0), ("c", None), ("d", 51), ("e", 102)]:
+        store_image(conn, name, red)
+
+    assert predict.predict(batch_size=2, csv_path="scores.csv") == 4
+
+    # The unreadable image is left out of its batch
+    assert red_model.batches == [2, 1, 1]
+    assert {f: r.get("deerProbability") for f, r in metadata_store.iter_images(conn)} == {
+        "a": 1.0, "b": 0.0, "c": None, "d": 0.2, "e": 0.4,
+    }
+
+    with open("scores.csv", newline='') as f:
+        assert list(csv.reader(f)) == [
+            ["filename", "deerProbability"], ["a", "1.000000"], ["b", "0.000000"], ["d", "0.200000"], ["e", "0.400000"],
+        ]
+
+    # Scheduled runs only score what is new
+    store_image(conn, "f", 255)
+    assert predict.predict(batch_size=2, only_new=True) == 1
+
+def test_confident_events_scored_once(workspace, red_model):
+    import metadata_store
+
+    conn = metadata_store.connect("images.db")
+    for name, red in [("a", 0), ("b", 255), ("c", 0), ("d", 255), ("e", 128), ("f", 0), ("g", 51)]:
+        store_image(conn, name, red)
+
+    with conn:
+        metadata_store.set_events(conn, [["a", "b", "c"], ["d", "e", "f"]])
+
+    # b decides its event, e is uncertain so d and f are scored in a second pass, g has no event
+    assert predict.predict(batch_size=8, by_event=True) == 5
+    assert red_model.batches == [3, 2]
+
+    scores = {f: (r["deerProbability"], r["scoredFrame"]) for f, r in metadata_store.iter_images(conn)}
+    assert scores == {
+        "a": (1.0, "b"), "b": (1.0, "b"), "c": (1.0, "b"),
+        "d": (1.0, "d"), "e": (0.501961, "e"), "f": (0.0, "f"),
+        "g": (0.2, "g"),
+    }
+
+class ListModel:
+    """A metadata-only model returning fixed scores, in the order of the records it is given."""
+
+    def __init__(self, scores):
+        self.scores = scores
+
+    def predict_on_batch(self, inputs):
+        assert len(inputs) == len(self.scores)
+        return np.array(self.scores)[:, None]
+
+def test_cascade_decodes_only_uncertain_images(workspace, red_model, monkeypatch):
+    import metadata_store
+
+    gate_path = str(workspace / "metadata_model.keras")
+    features.save_feature_spec(features.fit_feature_spec([RECORD]), predict.feature_spec_path(gate_path))
+
+    gate = ListModel([0.1, 0.5, 0.95, 0.8])
+    monkeypatch.setattr(predict, "load_model", lambda path: gate if path == gate_path else red_model)
+
+    conn = metadata_store.connect("images.db")
+    for name, red in [("a", 255), ("b", 0), ("c", 255), ("d", 51), ("e", 102)]:
+        store_image(conn, name, red)
+
+    # Incomplete metadata, which the gate can't score
+    with conn:
+        metadata_store.update_fields(conn, "e", {"pressure": None})
+
+    assert predict.predict(batch_size=8, cascade=True, gate_path=gate_path, band=(0.2, 0.8)) == 2
+    assert red_model.batches == [2]
+
+    scores = {f: (r["deerProbability"], r["scoredBy"]) for f, r in metadata_store.iter_images(conn)}
+    assert scores == {
+        "a": (0.1, "metadata"), "b": (0.0, "image"), "c": (0.95, "metadata"), "d": (0.8, "metadata"), "e": (0.4, "image"),
+    }
+
+def test_cascade_sweep_frontier():
+    import cascade_sweep
+
+    sweep = {"accuracy": np.array([0.9, 0.8, 0.95, 0.7, 0.85]), "decoded": np.array([0.5, 0.2, 0.9, 0.2, 0.6])}
+
+    # Each band on the frontier decodes more images for better accuracy
+    assert cascade_sweep.frontier(sweep).tolist() == [1, 0, 2]
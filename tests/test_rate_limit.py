@@ -0,0 +1,127 @@
+import time
+import threading
+from email.utils import formatdate
+
+import pytest
+import requests
+
+import metrics
+import rate_limit
+
+def response(status, **headers):
+    """A bare response with a status and headers."""
+    res = requests.Response()
+    res.status_code = status
+    res.headers.update(headers)
+    return res
+
+@pytest.mark.parametrize("status, throttle", [(None, True), (200, False), (404, False), (429, True), (503, True)])
+def test_is_throttle(status, throttle):
+    assert rate_limit.is_throttle(status) == throttle
+
+def test_retry_after():
+    assert rate_limit.retry_after(response(429, **{"Retry-After": "7"})) == 7
+    assert rate_limit.retry_after(response(429, **{"Retry-After": "-3"})) == 0
+    assert 25 < rate_limit.retry_after(response(503, **{"Retry-After": formatdate(time.time() + 30, usegmt=True)})) <= 30
+    assert rate_limit.retry_after(response(429, **{"Retry-After": "soon"})) is None
+    assert rate_limit.retry_after(response(429)) is None
+    assert rate_limit.retry_after(None) is None
+
+def test_limit_grows_by_one_per_round_trip():
+    limiter = rate_limit.AdaptiveLimiter("api.example.com", initial=4, maximum=6)
+
+    # A full window of successes adds one slot
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == pytest.approx(5, abs=0.1)
+
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 6
+    assert limiter.in_flight == 0
+    assert metrics.snapshot()["gauges"]["concurrency_limit_api_example_com"] == 6
+
+def test_errors_halve_the_limit_once_per_round_trip():
+    limiter = rate_limit.AdaptiveLimiter("api.example.com", initial=8)
+    throttled = metrics.snapshot()["counters"].get("requests_throttled_total", 0)
+
+    # A burst of errors from requests sent together counts once
+    for status in [429, 503, None]:
+        limiter.acquire()
+        limiter.release(10.0, status)
+
+    assert limiter.limit == 4
+    assert metrics.snapshot()["counters"]["requests_throttled_total"] == throttled + 3
+
+    # Client errors are the request's fault, not the host's
+    limiter.acquire()
+    limiter.release(0.01, 404)
+    assert limiter.limit == 4
+
+def test_latency_spike_shrinks_the_limit():
+    limiter = rate_limit.AdaptiveLimiter("api.example.com", initial=10, maximum=10)
+
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 10
+
+    limiter.acquire()
+    limiter.release(1.0)
+    assert limiter.limit == pytest.approx(9)
+
+def test_acquire_waits_for_a_free_slot():
+    limiter = rate_limit.AdaptiveLimiter("api.example.com", initial=1)
+    limiter.acquire()
+
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    waiter.start()
+
+    assert not acquired.wait(0.1)
+
+    limiter.release(0.01)
+    assert acquired.wait(1)
+    waiter.join()
+
+def test_retry_after_pauses_the_host():
+    limiter = rate_limit.AdaptiveLimiter("api.example.com", initial=4)
+
+    with pytest.raises(requests.HTTPError):
+        with limiter.request():
+            raise requests.HTTPError(response=response(429, **{"Retry-After": "0.2"}))
+
+    assert limiter.limit == 2
+
+    start = time.monotonic()
+    with limiter.request():
+        pass
+
+    assert time.monotonic() - start >= 0.15
+
+def test_failures_on_our_side_leave_the_limit():
+    limiter = rate_limit.AdaptiveLimiter("api.example.com", initial=4)
+
+    with pytest.raises(KeyError):
+        with limiter.request():
+            raise KeyError("name")
+
+    assert limiter.limit == 4
+    assert limiter.in_flight == 0
+
+    # A truncated body is treated like a dropped connection
+    with pytest.raises(IOError):
+        with limiter.request():
+            raise IOError("truncated")
+
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+def test_one_limiter_per_host(monkeypatch):
+    monkeypatch.setattr(rate_limit, "limiters", dict())
+
+    first = rate_limit.limiter_for("https://api.example.com/api/v4/file-manager/images")
+    assert rate_limit.limiter_for("https://api.example.com/other") is first
+    assert rate_limit.limiter_for("https://cdn.example.com/image.jpg") is not first
@@ -0,0 +1,106 @@
+import json
+import time
+import base64
+import threading
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+import pytest
+
+import serve
+
+class MeanModel:
+    """An image-only model scoring each image by its mean pixel, recording the batch sizes."""
+
+    inputs = [None]
+
+    def __init__(self, fail=False):
+        self.batches = list()
+        self.fail = fail
+
+    def predict_on_batch(self, pixels):
+        self.batches.append(len(pixels))
+        if self.fail:
+            raise RuntimeError("Injected failure")
+        return pixels.reshape(len(pixels), -1).mean(axis=1)
+
+def image(value):
+    return np.full((4, 4, 3), value, dtype=np.float32)
+
+def test_concurrent_requests_share_a_batch():
+    model = MeanModel()
+    batcher = serve.MicroBatcher(model, max_batch=4, max_wait_ms=200)
+
+    futures = [batcher.submit(image(i / 10)) for i in range(5)]
+
+    assert [future.result(timeout=5) for future in futures] == pytest.approx([0, 0.1, 0.2, 0.3, 0.4])
+    assert model.batches == [4, 1]
+    assert (batcher.batches, batcher.batched) == (2, 5)
+
+def test_lone_request_waits_at_most_max_wait():
+    model = MeanModel()
+    batcher = serve.MicroBatcher(model, max_batch=32, max_wait_ms=50)
+
+    start = time.monotonic()
+    assert batcher.submit(image(0.5)).result(timeout=5) == pytest.approx(0.5)
+
+    assert 0.04 <= time.monotonic() - start < 1
+    assert model.batches == [1]
+
+def test_failed_batch_fails_its_requests_only():
+    model = MeanModel(fail=True)
+    batcher = serve.MicroBatcher(model, max_batch=2, max_wait_ms=100)
+
+    futures = [batcher.submit(image(0)) for _ in range(2)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="Injected"):
+            future.result(timeout=5)
+
+    model.fail = False
+    assert batcher.submit(image(0.25)).result(timeout=5) == pytest.approx(0.25)
+
+@pytest.fixture
+def server():
+    server = serve.start_server(port=0, max_batch=8, max_wait_ms=50, model=MeanModel())
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+
+    server.shutdown()
+    server.server_close()
+
+def post(url, body):
+    request = urllib.request.Request(f"{url}/predict", json.dumps(body).encode(), {"Content-Type": "application/json"})
+
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+def test_service_scores_concurrent_requests(server):
+    gray = base64.b64encode(cv2.imencode(".png", np.full((24, 32, 3), 51, np.uint8))[1].tobytes()).decode()
+    results = list()
+
+    def client():
+        results.append(post(server, {"image": gray}))
+
+    clients = [threading.Thread(target=client) for _ in range(6)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    assert [status for status, _ in results] == [200] * 6
+    assert all(body["deerProbability"] == pytest.approx(0.2) for _, body in results)
+
+    with urllib.request.urlopen(f"{server}/health", timeout=10) as response:
+        health = json.load(response)
+
+    # Requests that arrive together are batched
+    assert health["status"] == "ok"
+    assert health["batches"] < 6
+
+def test_service_rejects_invalid_images(server):
+    assert post(server, {"image": "not base64!"}) == (400, {"error": "Expected a base64 encoded 'image'."})
+    assert post(server, {"image": base64.b64encode(b"not an image").decode()})[0] == 400
@@ -0,0 +1,137 @@
+import image_collection
+import work_queue
+
+def listed(conn, count):
+    """The current listing's offsets the account's units cover, as workers shift them."""
+    total = conn.execute("SELECT total FROM plans WHERE account = 'default'").fetchone()[0]
+    offsets = list()
+    for skip, take in conn.execute("SELECT skip, take FROM units WHERE account = 'default' ORDER BY skip"):
+        offsets.extend(range(skip + count - total, skip + count - total + take))
+
+    return offsets
+
+def test_second_plan_adds_new_images(workspace, monkeypatch):
+    count = 100
+    monkeypatch.setattr(image_collection, "IMAGE_TOTAL", None)
+    monkeypatch.setattr(image_collection, "get_image_count", lambda api_url, headers: count)
+
+    conn = work_queue.connect("work-queue.db")
+    accounts = {"default": ("http://stub", {})}
+
+    assert work_queue.plan(conn, accounts, take=10, unit_pages=2) == 5
+    assert listed(conn, count) == list(range(100))
+
+    # Images uploaded since sit in front of the first plan
+    count = 130
+    assert work_queue.plan(conn, accounts, take=10, unit_pages=2) == 2
+    assert listed(conn, count) == list(range(130))
+
+    assert work_queue.plan(conn, accounts, take=10, unit_pages=2) == 0
+
+    count = 135
+    assert work_queue.plan(conn, accounts, take=10, unit_pages=2) == 1
+    assert listed(conn, count) == list(range(135))
+
+    # Newest first
+    assert work_queue.lease(conn, "worker")[1] == -35
+
+def make_units(conn, count, take=10):
+    """Queue units of the default account directly, as planned for `count` images."""
+    conn.execute("INSERT INTO plans VALUES ('default', ?, 0)", (count,))
+    conn.executemany("INSERT INTO units (account, skip, take) VALUES ('default', ?, ?)", [(skip, take) for skip in range(0, count, take)])
+
+def test_workers_lease_different_units(workspace):
+    conn = work_queue.connect("work-queue.db")
+    make_units(conn, 20)
+
+    first = work_queue.lease(conn, "a")
+    second = work_queue.lease(conn, "b")
+
+    assert (first, second) == (("default", 0, 10), ("default", 10, 10))
+    assert work_queue.lease(conn, "c") is None
+    assert work_queue.remaining(conn) == 2
+
+    # Only the lease holder can complete its unit
+    work_queue.complete(conn, first, "b")
+    work_queue.complete(conn, first, "a")
+    assert dict(conn.execute("SELECT owner, status FROM units")) == {"a": "done", "b": "leased"}
+    assert work_queue.remaining(conn) == 1
+
+def test_expired_lease_taken_over(workspace, monkeypatch):
+    monkeypatch.setattr(work_queue, "UNIT_ATTEMPTS", 2)
+    conn = work_queue.connect("work-queue.db")
+    make_units(conn, 10)
+
+    unit = work_queue.lease(conn, "crashed", seconds=-1)
+    assert work_queue.lease(conn, "b", seconds=-1) == unit
+
+    # The first worker finds out it lost the unit when it renews
+    assert not work_queue.renew(conn, unit, "crashed")
+    assert work_queue.renew(conn, unit, "b", seconds=-1)
+
+    # Out of attempts once this lease runs out too
+    assert work_queue.lease(conn, "c") is None
+    assert conn.execute("SELECT status, error FROM units").fetchone() == ("failed", "Lease expired")
+    assert work_queue.remaining(conn) == 0
+
+def test_released_unit_retried_until_out_of_attempts(workspace, monkeypatch):
+    monkeypatch.setattr(work_queue, "UNIT_ATTEMPTS", 2)
+    conn = work_queue.connect("work-queue.db")
+    make_units(conn, 10)
+
+    for status in ["pending", "failed"]:
+        unit = work_queue.lease(conn, "a")
+        work_queue.release(conn, unit, "a", "HTTP 503")
+        assert conn.execute("SELECT status, owner, error FROM units").fetchone() == (status, None, "HTTP 503")
+
+    assert work_queue.lease(conn, "a") is None
+
+def test_accounts_file(workspace):
+    with open("accounts.json", 'w') as f:
+        f.write('[{"name": "north", "apiUrl": "http://north", "apiBearer": "token-n"}, '
+                '{"name": "south", "apiUrl": "http://south", "apiBearer": "token-s"}]')
+
+    accounts = work_queue.load_accounts("accounts.json")
+
+    assert {name: url for name, (url, _) in accounts.items()} == {"north": "http://north", "south": "http://south"}
+    assert accounts["south"][1]["Authorization"] == "Bearer token-s"
+    assert image_collection.post_headers.get("Authorization") != "Bearer token-s"
+
+def test_worker_collects_every_unit(workspace, monkeypatch):
+    import metadata_store
+    import image_store
+    from stub_api import start_stub_server
+
+    server = start_stub_server(20, width=64, height=48)
+    api_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    monkeypatch.setattr(image_collection, "API_URL", api_url)
+    monkeypatch.setattr(image_collection, "API_BEARER", "test")
+    monkeypatch.setattr(image_collection, "IMAGE_TOTAL", None)
+    monkeypatch.setattr(image_collection, "IMAGE_DIR", image_store.IMAGE_DIR)
+    monkeypatch.setattr(image_collection, "TAKE_AMOUNT", 5)
+    monkeypatch.setattr(image_collection, "DOWNLOAD_RETRIES", 0)
+
+    # The first page request fails, so its unit goes back to the queue and is collected again
+    get_image_range = image_collection.get_image_range
+    failures = [IOError("Injected failure")]
+
+    def flaky_get_image_range(skip, take, api_url=None, headers=None):
+        if failures:
+            raise failures.pop()
+        return get_image_range(skip, take, api_url, headers)
+
+    monkeypatch.setattr(image_collection, "get_image_range", flaky_get_image_range)
+
+    try:
+        conn = work_queue.connect("work-queue.db")
+        assert work_queue.plan(conn, work_queue.load_accounts(), take=5, unit_pages=2) == 2
+        assert work_queue.run_worker(process_images=False) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    store = metadata_store.connect()
+    assert metadata_store.count_images(store) == 20
+    assert all(image_store.locate(store, record["fullFilename"]) for _, record in metadata_store.iter_images(store))
+    assert dict(conn.execute("SELECT status, COUNT(*) FROM units GROUP BY status")) == {"done": 2}
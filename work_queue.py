@@ -0,0 +1,479 @@
+"""
+Lease-based work queue for collecting with many processes or hosts
+
+`plan` splits every account's image listing into units of UNIT_PAGES pages and saves them in a
+SQLite queue (WORK_QUEUE_DB), no other service needed. Any number of `work` processes, on one
+host or on several sharing the working directory, lease one unit at a time, download (and with
+--process, process) its images, and commit each page's metadata and image store entries in one
+transaction. Images already in the metadata store are skipped, so a unit done twice, or one
+overlapping a regular `image_collection.py` sync, stores nothing twice.
+
+A lease lasts LEASE_SECONDS and is renewed after every page. Once the lease of a crashed
+worker runs out, another worker leases its unit again, up to UNIT_ATTEMPTS times before the
+unit is marked failed.
+
+The API lists images newest first, so images added after planning shift every offset. A plan
+records each account's image count, and workers move a unit's offsets by the growth since.
+Running `plan` again adds units for the images listed since, so a scheduled plan keeps the
+queue up to date.
+
+Accounts come from ACCOUNTS_FILE, a JSON list of {"name", "apiUrl", "apiBearer"} objects, or
+are the single account 'default' from API_URL and API_BEARER. Tokens never go into the queue.
+Hosts sharing the queue need a filesystem with working SQLite locks, and, since WAL doesn't
+work over a network filesystem, SQLITE_JOURNAL_MODE=DELETE.
+
+Usage:
+    python work_queue.py plan
+    python work_queue.py work [--processes N] [--process]
+    python work_queue.py status
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import image_collection
+import metadata_store
+import image_store
+import metrics
+
+WORK_QUEUE_DB = os.getenv("WORK_QUEUE_DB", "work-queue.db")
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "accounts.json")
+
+# Pages of TAKE_AMOUNT images per unit
+UNIT_PAGES = int(os.getenv("UNIT_PAGES") or 20)
+
+# Seconds a unit stays leased without its worker finishing a page
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS") or 600)
+
+# Leases of a unit before it is marked failed
+UNIT_ATTEMPTS = int(os.getenv("UNIT_ATTEMPTS") or 3)
+
+# Seconds an idle worker waits before checking for expired leases again
+POLL_SECONDS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    account TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    planned_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    account TEXT NOT NULL,
+    skip INTEGER NOT NULL,
+    take INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (account, skip)
+);
+CREATE INDEX IF NOT EXISTS units_status ON units (status, lease_until);
+"""
+
+def connect(path: str = WORK_QUEUE_DB) -> sqlite3.Connection:
+    """
+    Open the work queue, creating it if needed.
+
+    The connection is in autocommit mode, every change is a single statement or an explicit
+    transaction.
+
+    Args:
+        path (str): Path to the SQLite database.
+
+    Returns:
+        sqlite3.Connection: The open queue.
+    """
+    conn = sqlite3.connect(path, timeout=metadata_store.BUSY_TIMEOUT, isolation_level=None)
+    conn.execute(f"PRAGMA journal_mode={metadata_store.SQLITE_JOURNAL_MODE}")
+    conn.executescript(SCHEMA)
+
+    return conn
+
+def load_accounts(path: str = ACCOUNTS_FILE) -> dict:
+    """
+    Load the camera accounts to collect from.
+
+    Args:
+        path (str): The accounts file.
+
+    Returns:
+        dict: Per account name, (API URL, request headers with its token).
+
+    Raises:
+        ValueError: If there is no accounts file and API_URL or API_BEARER is missing.
+    """
+    if not os.path.exists(path):
+        if None in [image_collection.API_URL, image_collection.API_BEARER]:
+            raise ValueError("Missing ENV values")
+
+        return {"default": (image_collection.API_URL, image_collection.post_headers)}
+
+    with open(path, 'r') as f:
+        accounts = json.load(f)
+
+    return {
+        account["name"]: (account["apiUrl"], dict(image_collection.post_headers, Authorization=f'Bearer {account["apiBearer"]}'))
+        for account in accounts
+    }
+
+def plan(conn, accounts: dict, take: int = image_collection.TAKE_AMOUNT, unit_pages: int = UNIT_PAGES) -> int:
+    """
+    Split the listing of every account into units. Accounts planned before get units for the
+    images listed since, in front of their planned ones.
+
+    Offsets stay relative to the listing when the account was first planned, so the images
+    listed since get negative ones and every unit moves by the same growth when it is collected.
+
+    Args:
+        conn (sqlite3.Connection): The work queue.
+        accounts (dict): The accounts, from `load_accounts`.
+        take (int): Images per page.
+        unit_pages (int): Pages per unit.
+
+    Returns:
+        int: The number of units added.
+    """
+    size = take * unit_pages
+    added = 0
+
+    for name, (api_url, headers) in accounts.items():
+        count = image_collection.get_image_count(api_url, headers)
+
+        # Read and extended in one transaction, so planners running at once don't plan an image twice
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            planned = conn.execute("SELECT total FROM plans WHERE account = ?", (name,)).fetchone()
+
+            if planned is None:
+                limit = min(count, image_collection.IMAGE_TOTAL or count)
+                units = [(name, skip, min(size, limit - skip)) for skip in range(0, limit, size)]
+                conn.execute("INSERT INTO plans VALUES (?, ?, ?)", (name, count, time.time()))
+            else:
+                # Everything in front of the first planned unit was listed since the last plan
+                front = min(conn.execute("SELECT MIN(skip) FROM units WHERE account = ?", (name,)).fetchone()[0] or 0, 0)
+                units = [(name, skip, min(size, front - skip)) for skip in range(planned[0] - count, front, size)]
+                conn.execute("UPDATE plans SET planned_at = ? WHERE account = ?", (time.time(), name))
+
+            conn.executemany("INSERT OR IGNORE INTO units (account, skip, take) VALUES (?, ?, ?)", units)
+            conn.execute("COMMIT")
+
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        if planned is not None and not units:
+            print(f"Account {name} has no images listed since it was planned")
+        else:
+            print(f"Planned {len(units)} units of up to {size} images for account {name}")
+
+        added += len(units)
+
+    return added
+
+def lease(conn, owner: str, seconds: int = LEASE_SECONDS):
+    """
+    Lease the next unit, either never leased or left behind by a worker whose lease ran out.
+
+    Args:
+        conn (sqlite3.Connection): The work queue.
+        owner (str): The leasing worker.
+        seconds (int): How long the lease lasts.
+
+    Returns:
+        tuple: (account, skip, take) of the unit, None if no unit is available.
+    """
+    now = time.time()
+
+    # Taking the write lock first, so two workers can't pick the same unit
+    conn.execute("BEGIN IMMEDIATE")
+
+    try:
+        conn.execute(
+            "UPDATE units SET status = 'failed', owner = NULL, lease_until = NULL, error = 'Lease expired' "
+            "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+            (now, UNIT_ATTEMPTS),
+        )
+
+        unit = conn.execute(
+            "SELECT account, skip, take FROM units "
+            "WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) "
+            "ORDER BY skip, account LIMIT 1",
+            (now,),
+        ).fetchone()
+
+        if unit:
+            conn.execute(
+                "UPDATE units SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE account = ? AND skip = ?",
+                (owner, now + seconds, unit[0], unit[1]),
+            )
+
+        conn.execute("COMMIT")
+
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    return unit
+
+def renew(conn, unit: tuple, owner: str, seconds: int = LEASE_SECONDS) -> bool:
+    """
+    Extend a lease.
+
+    Args:
+        conn (sqlite3.Connection): The work queue.
+        unit (tuple): The unit, from `lease`.
+        owner (str): The worker holding the lease.
+        seconds (int): How long the lease lasts from now.
+
+    Returns:
+        bool: False if the lease ran out and another worker has the unit now.
+    """
+    cursor = conn.execute(
+        "UPDATE units SET lease_until = ? WHERE account = ? AND skip = ? AND owner = ? AND status = 'leased'",
+        (time.time() + seconds, unit[0], unit[1], owner),
+    )
+    return cursor.rowcount == 1
+
+def complete(conn, unit: tuple, owner: str) -> None:
+    """
+    Mark a leased unit as done.
+
+    Args:
+        conn (sqlite3.Connection): The work queue.
+        unit (tuple): The unit, from `lease`.
+        owner (str): The worker holding the lease.
+    """
+    conn.execute(
+        "UPDATE units SET status = 'done', lease_until = NULL, error = NULL WHERE account = ? AND skip = ? AND owner = ?",
+        (unit[0], unit[1], owner),
+    )
+
+def release(conn, unit: tuple, owner: str, error: str) -> None:
+    """
+    Give a unit back after an error, or mark it failed once it has used up its attempts.
+
+    Args:
+        conn (sqlite3.Connection): The work queue.
+        unit (tuple): The unit, from `lease`.
+        owner (str): The worker holding the lease.
+        error (str): What went wrong.
+    """
+    conn.execute(
+        "UPDATE units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "owner = NULL, lease_until = NULL, error = ? WHERE account = ? AND skip = ? AND owner = ?",
+        (UNIT_ATTEMPTS, error, unit[0], unit[1], owner),
+    )
+
+def remaining(conn) -> int:
+    """
+    Count the units not done or failed yet.
+
+    Args:
+        conn (sqlite3.Connection): The work queue.
+
+    Returns:
+        int: Pending and leased units.
+    """
+    return conn.execute("SELECT COUNT(*) FROM units WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+def print_status(conn) -> None:
+    """
+    Print the units per account and status.
+
+    Args:
+        conn (sqlite3.Connection): The work queue.
+    """
+    rows = conn.execute("SELECT account, status, COUNT(*), SUM(take) FROM units GROUP BY account, status ORDER BY account, status")
+
+    print(f'{"account":<20} {"status":<8} {"units":>7} {"images":>9}')
+    for account, status, units, images in rows:
+        print(f'{account:<20} {status:<8} {units:>7} {images:>9}')
+
+    for account, skip, error in conn.execute("SELECT account, skip, error FROM units WHERE status = 'failed' ORDER BY account, skip"):
+        print(f"Failed: {account} at {skip}: {error}")
+
+def collect_unit(queue, store, unit: tuple, owner: str, account: tuple, total: int, executor, process) -> bool:
+    """
+    Download the images of a unit page by page, committing each page.
+
+    Args:
+        queue (sqlite3.Connection): The work queue.
+        store (sqlite3.Connection): The metadata store.
+        unit (tuple): The leased unit.
+        owner (str): This worker.
+        account (tuple): (API URL, request headers) of the unit's account.
+        total (int): The account's image count when it was planned.
+        executor (ThreadPoolExecutor): Runs the downloads.
+        process (function): Processes and saves downloaded bytes under a content key, None to
+            only store the raw images.
+
+    Returns:
+        bool: False if the lease was lost, so the unit isn't this worker's to complete.
+    """
+    api_url, headers = account
+    _, skip, take = unit
+
+    # Images listed since planning sit in front of the planned offsets
+    shift = max(image_collection.get_image_count(api_url, headers) - total, 0)
+
+    def download(item):
+        filename, image = item
+
+        try:
+            if process is None:
+                key, size = image_collection.get_image(image.get("imageUrl"), image.get("fullFilename"))
+                return filename, (key, image.get("imageGuid"), size), False
+
+            data = image_collection.fetch_image(image.get("imageUrl"), image.get("fullFilename"))
+            key = image_store.store_raw(data) if image_collection.KEEP_RAW else image_store.content_key(data)
+            return filename, (key, image.get("imageGuid"), len(data)), process(key, data)
+
+        except Exception as e:
+            print(f"Failed to save image {image.get('fullFilename')}: {e}")
+            return filename, None, False
+
+    for page_skip in range(skip, skip + take, image_collection.TAKE_AMOUNT):
+        page_take = min(image_collection.TAKE_AMOUNT, skip + take - page_skip)
+        images = image_collection.get_image_range(page_skip + shift, page_take, api_url, headers)
+
+        known = metadata_store.known_filenames(store, images)
+        images = {k: v for k, v in images.items() if k not in known}
+
+        files = dict()
+        processed = list()
+        for filename, entry, is_processed in executor.map(download, images.items()):
+            if entry is None:
+                continue
+
+            files[filename] = entry
+            if is_processed:
+                processed.append(entry[0])
+
+        # Failed images stay out of the store, so a later run or sync picks them up again
+        with metrics.timer("store_commit_seconds"), store:
+            metadata_store.add_images(store, {k: images[k] for k in files})
+            image_store.index_files(store, {images[k].get("fullFilename"): entry for k, entry in files.items()})
+            image_store.set_processed(store, processed, image_store.SIZE_TAG)
+
+        metrics.inc("pages_committed_total")
+
+        if not renew(queue, unit, owner):
+            return False
+
+    return True
+
+def run_worker(process_images: bool = image_collection.PROCESS_ON_DOWNLOAD) -> int:
+    """
+    Lease and collect units until every unit is done or failed.
+
+    Args:
+        process_images (bool): Process each image as it is downloaded, as with PROCESS_ON_DOWNLOAD.
+
+    Returns:
+        int: The number of units this worker completed.
+    """
+    owner = f'{socket.gethostname()}-{os.getpid()}'
+    queue = connect()
+    store = metadata_store.connect()
+    accounts = load_accounts()
+    totals = dict(queue.execute("SELECT account, total FROM plans"))
+
+    # Downloads are streamed into IMAGE_DIR before they move into the store
+    os.makedirs(image_collection.IMAGE_DIR, exist_ok=True)
+
+    process = None
+    if process_images:
+        import image_processing
+        image_processing.preflight_checks()
+
+        # Content processed at IMAGE_SIZE, other workers may still process the same content once
+        done_keys = image_store.processed_keys(store, image_processing.SIZE_TAG)
+
+        def process(key, data):
+            if key not in done_keys:
+                image_processing.process_image_bytes(data, image_store.processed_path(key))
+                metrics.inc("images_processed_total")
+                done_keys.add(key)
+
+            return True
+
+    executor = ThreadPoolExecutor(max_workers=image_collection.MAX_CONCURRENCY)
+    stop_reporter = metrics.start_reporter(f"work {owner}")
+    completed = 0
+
+    try:
+        while True:
+            unit = lease(queue, owner)
+
+            if unit is None:
+                if not remaining(queue):
+                    break
+
+                # Units leased by other workers may still come back when their lease runs out
+                time.sleep(POLL_SECONDS)
+                continue
+
+            account, skip, take = unit
+            print(f"{owner} leased {account} images {skip}-{skip + take}")
+
+            if account not in accounts:
+                release(queue, unit, owner, f"Unknown account {account}")
+                continue
+
+            try:
+                finished = collect_unit(queue, store, unit, owner, accounts[account], totals[account], executor, process)
+            except Exception as e:
+                print(f"Failed {account} images {skip}-{skip + take}: {e}")
+                release(queue, unit, owner, str(e))
+                continue
+
+            if finished:
+                complete(queue, unit, owner)
+                completed += 1
+                metrics.inc("units_completed_total")
+            else:
+                print(f"{owner} lost its lease on {account} images {skip}-{skip + take}")
+
+    finally:
+        executor.shutdown(wait=True)
+        stop_reporter()
+
+    print(f"{owner} completed {completed} units")
+
+    return completed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect images with many processes or hosts through a shared work queue.")
+    parser.add_argument("command", choices=["plan", "work", "status"])
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to start on this host")
+    parser.add_argument("--process", action="store_true", default=image_collection.PROCESS_ON_DOWNLOAD,
+                        help="Process images as they download (default: PROCESS_ON_DOWNLOAD)")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        plan(connect(), load_accounts())
+        print_status(connect())
+
+    elif args.command == "status":
+        print_status(connect())
+
+    else:
+        workers = [multiprocessing.Process(target=run_worker, args=(args.process,)) for _ in range(args.processes)]
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        print_status(connect())
+        sys.exit(0 if all(worker.exitcode == 0 for worker in workers) else 1)